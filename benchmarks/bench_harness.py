@@ -0,0 +1,455 @@
+"""
+Benchmarks for the overhead of the `testcases` harness itself. The
+harness is pointed (via the COMPOSE and DOCKER env vars) at stub
+`docker` and `docker-compose` executables which print canned output for
+a project of hundreds of containers, and at a stub Consul HTTP server,
+so that no Docker daemon is needed and the time measured is the time
+spent in the harness (plus the cost of spawning a process, which is
+measured on its own as `subprocess`). The `import` benchmark times a new
+interpreter importing testcases (compare with `import.interpreter`), and
+fails if that imports any of the LAZY_MODULES. Ex.
+
+    python3 benchmarks/bench_harness.py --output baseline.json
+    python3 benchmarks/bench_harness.py --baseline baseline.json
+
+Results are written as JSON with the min/p50/mean/max seconds of each
+benchmark. When comparing with a `--baseline`, the command exits with
+status 1 if the p50 of any benchmark is slower than the baseline by more
+than the `--threshold` ratio (and by more than `--min-delta` seconds).
+"""
+import argparse
+import base64
+import http.server
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import consul as pyconsul
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORMAT_VERSION = 1
+""" Version of the results file format, bumped on incompatible changes """
+
+PROJECT = 'bench'
+SERVICE = 'app'
+
+
+# -----------------------------------------
+# stub docker and docker-compose
+
+DOCKER_STUB = """#!/bin/sh
+# stub docker client for benchmarks/bench_harness.py
+case "$1" in
+  ps) exec cat {fixtures}/docker_ps.jsonl ;;
+  inspect) exec cat {fixtures}/inspect.json ;;
+  exec) exec cat {fixtures}/ip_addr.txt ;;
+  events) exec sleep 60 ;;
+esac
+"""
+
+COMPOSE_STUB = """#!/bin/sh
+# stub docker-compose for benchmarks/bench_harness.py
+case "$*" in
+  *" ps -q"*) exec cat {fixtures}/compose_ps_q.txt ;;
+  *" ps"*) exec cat {fixtures}/compose_ps.txt ;;
+esac
+"""
+
+IP_ADDR = """\
+1: lo    inet 127.0.0.1/8 scope host lo\\       valid_lft forever preferred_lft forever
+2: eth0    inet 10.0.0.2/16 scope global eth0\\       valid_lft forever preferred_lft forever
+3: eth1    inet 72.2.115.34/24 scope global eth1\\       valid_lft forever preferred_lft forever
+"""
+
+def _container_id(i):
+    return '{:064x}'.format(i + 1)
+
+def _private_ip(i):
+    return '10.0.{}.{}'.format(i // 250, i % 250 + 2)
+
+def _write(path, content, mode=None):
+    with open(path, 'w') as f:
+        f.write(content)
+    if mode:
+        os.chmod(path, mode)
+
+def write_stubs(directory, count):
+    """
+    Writes the stub executables and their canned output for a project
+    with `count` containers of the `app` service (plus one of `consul`)
+    into `directory`. Returns the (docker, docker-compose) paths.
+    """
+    fixtures = os.path.join(directory, 'fixtures')
+    os.makedirs(fixtures)
+    names = [('consul', 1)] + [(SERVICE, i) for i in range(1, count + 1)]
+
+    rows = []
+    for i, (service, number) in enumerate(names):
+        labels = ','.join(['com.docker.compose.project={}'.format(PROJECT),
+                           'com.docker.compose.service={}'.format(service),
+                           'com.docker.compose.container-number={}'
+                           .format(number),
+                           'com.docker.compose.oneoff=False'])
+        rows.append(json.dumps({
+            'ID': _container_id(i),
+            'Names': '{}_{}_{}'.format(PROJECT, service, number),
+            'Command': '"/usr/local/bin/containerpilot"',
+            'Status': 'Up 5 minutes (healthy)' if i % 2 else 'Up 5 minutes',
+            'Ports': '80/tcp, 0.0.0.0:{}->8080/tcp'.format(30000 + i),
+            'Labels': labels}))
+    _write(os.path.join(fixtures, 'docker_ps.jsonl'), '\n'.join(rows) + '\n')
+
+    table = ['{:<24}{:<40}{:<8}{}'.format('Name', 'Command', 'State',
+                                          'Ports'),
+             '-' * 96]
+    for i, (service, number) in enumerate(names):
+        table.append('{:<24}{:<40}{:<8}{}'.format(
+            '{}_{}_{}'.format(PROJECT, service, number),
+            '/usr/local/bin/containerpilot', 'Up',
+            '80/tcp, 0.0.0.0:{}->8080/tcp'.format(30000 + i)))
+    _write(os.path.join(fixtures, 'compose_ps.txt'), '\n'.join(table) + '\n')
+
+    _write(os.path.join(fixtures, 'compose_ps_q.txt'),
+           '\n'.join(_container_id(i) for i in range(1, len(names))) + '\n')
+
+    _write(os.path.join(fixtures, 'inspect.json'), json.dumps([
+        {'Id': _container_id(i),
+         'Name': '/{}_{}_{}'.format(PROJECT, service, number),
+         'NetworkSettings': {
+             'IPAddress': '',
+             'Networks': {
+                 '{}_default'.format(PROJECT): {'IPAddress': _private_ip(i)},
+                 'public': {'IPAddress': '72.2.{}.{}'.format(
+                     i // 250, i % 250 + 2)}}}}
+        for i, (service, number) in enumerate(names)]))
+
+    _write(os.path.join(fixtures, 'ip_addr.txt'), IP_ADDR)
+
+    executable = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP
+    docker = os.path.join(directory, 'docker')
+    compose = os.path.join(directory, 'docker-compose')
+    _write(docker, DOCKER_STUB.format(fixtures=fixtures), executable)
+    _write(compose, COMPOSE_STUB.format(fixtures=fixtures), executable)
+    return docker, compose
+
+
+# -----------------------------------------
+# stub Consul
+
+def _consul_responses(count):
+    """
+    Returns a dict of {path: JSON body} for the Consul HTTP API endpoints
+    used by the harness, describing `count` healthy `app` instances.
+    """
+    nodes = []
+    checks = []
+    for i in range(count):
+        node = 'node{}'.format(i)
+        service_id = '{}-{}'.format(SERVICE, _container_id(i + 1)[-12:])
+        service_check = {'Node': node, 'CheckID': 'service:' + service_id,
+                         'Status': 'passing', 'ServiceID': service_id,
+                         'ServiceName': SERVICE}
+        node_check = {'Node': node, 'CheckID': 'serfHealth',
+                      'Status': 'passing', 'ServiceID': '',
+                      'ServiceName': ''}
+        checks.extend([node_check, service_check])
+        nodes.append({
+            'Node': {'Node': node, 'Address': _private_ip(i + 1)},
+            'Service': {'ID': service_id, 'Service': SERVICE,
+                        'Address': _private_ip(i + 1), 'Port': 80},
+            'Checks': [node_check, service_check]})
+    catalog = [{'Node': n['Node']['Node'], 'ServiceID': n['Service']['ID'],
+                'ServiceAddress': n['Service']['Address']} for n in nodes]
+    value = base64.b64encode(b'{"primary": "node0"}').decode('ascii')
+    return {
+        '/v1/health/service/{}'.format(SERVICE): nodes,
+        '/v1/health/state/any': checks,
+        '/v1/catalog/services': {SERVICE: [], 'consul': []},
+        '/v1/catalog/service/{}'.format(SERVICE): catalog,
+        '/v1/kv/{}-primary'.format(SERVICE): [
+            {'Key': '{}-primary'.format(SERVICE), 'Value': value,
+             'Flags': 0, 'CreateIndex': 1, 'ModifyIndex': 1}],
+    }
+
+def serve_consul(count):
+    """
+    Starts a stub Consul agent on a thread and returns the server. Every
+    response carries the same index, and blocking queries return at once.
+    """
+    bodies = {path: json.dumps(body).encode('utf-8')
+              for path, body in _consul_responses(count).items()}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # otherwise keep-alive requests stall on delayed ACKs
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = bodies.get(self.path.split('?')[0])
+            self.send_response(200 if body is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Consul-Index', '42')
+            self.send_header('X-Consul-Knownleader', 'true')
+            self.send_header('X-Consul-Lastcontact', '0')
+            self.send_header('Content-Length', str(len(body or b'')))
+            self.end_headers()
+            self.wfile.write(body or b'')
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# -----------------------------------------
+# benchmarks
+
+def _stats(samples):
+    samples = sorted(samples)
+    return OrderedDict([
+        ('n', len(samples)),
+        ('min', samples[0]),
+        ('p50', samples[len(samples) // 2]),
+        ('mean', sum(samples) / len(samples)),
+        ('max', samples[-1]),
+    ])
+
+def _benchmarks(testcases, test, count):
+    """
+    Returns an ordered dict of {name: (fn, setup)} where `fn` is the call
+    being measured and `setup`, if not None, runs before each call
+    without being measured.
+    """
+    # parses canned output without running the stubs
+    parser = type(test)()
+    docker_ps = test.docker('ps')
+    compose_ps = test.compose('ps')
+
+    def parse_inventory():
+        parser.docker = lambda *args, **kwargs: docker_ps
+        return parser.container_inventory()
+
+    def parse_compose_ps():
+        parser.compose = lambda *args, **kwargs: compose_ps
+        return parser._compose_ps_text()
+
+    def compose_ps_text():
+        return test._compose_ps_text()
+
+    def forget_inspect():
+        test._invalidate_inspect()
+
+    def forget_snapshot():
+        test._consul_snapshot = None
+
+    calls = iter(range(sys.maxsize))
+
+    return OrderedDict([
+        ('subprocess', (lambda: subprocess.run(
+            [testcases.DOCKER, 'version'], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, check=True,
+            universal_newlines=True), None)),
+        ('compose', (lambda: test.compose('version'), None)),
+        ('docker', (lambda: test.docker('version'), None)),
+        ('docker_exec', (lambda: test.docker_exec('app_1', 'ip -o addr'),
+                         None)),
+        ('compose_ps.text', (compose_ps_text, None)),
+        ('compose_ps.text.parse', (parse_compose_ps, None)),
+        ('container_inventory', (test.container_inventory, None)),
+        ('container_inventory.parse', (parse_inventory, None)),
+        ('container_inventory.ips', (lambda: test.container_inventory(
+            ips=True), forget_inspect)),
+        ('get_service_ips.exec', (lambda: test.get_service_ips(SERVICE),
+                                  None)),
+        ('get_service_ips.inspect', (lambda: test.get_service_ips(
+            SERVICE, method='inspect'), forget_inspect)),
+        ('wait_for_containers', (test.wait_for_containers, None)),
+        ('poll', (lambda: test.poll(lambda: True), None)),
+        ('poll.5_attempts', (lambda: test.poll(
+            lambda: next(calls) % 5 == 4, interval=0), None)),
+        ('wait_for_service', (lambda: test.wait_for_service(
+            SERVICE, count=count), None)),
+        ('wait_for_services', (lambda: test.wait_for_services(
+            {SERVICE: count}), None)),
+        ('get_consul_key', (lambda: test.get_consul_key(
+            '{}-primary'.format(SERVICE)), None)),
+        ('consul_snapshot', (test.consul_snapshot, forget_snapshot)),
+        ('import.interpreter', (_python('pass'), None)),
+        ('import', (_python(IMPORT_CHECK), None)),
+    ])
+
+LAZY_MODULES = ('consul', 'IPy', 'asyncio', 'concurrent.futures',
+                'multiprocessing')
+""" Modules that importing testcases mustn't import """
+
+IMPORT_CHECK = """
+import sys
+import testcases
+eager = [name for name in {!r} if name in sys.modules]
+if eager:
+    sys.exit('import testcases imported ' + ', '.join(eager))
+""".format(LAZY_MODULES)
+
+def _python(code):
+    """
+    Returns a function that runs `code` in a new interpreter which can
+    import testcases (and write its bytecode cache, so that the first
+    run warms it up).
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return lambda: subprocess.run([sys.executable, '-c', code], env=env,
+                                  check=True)
+
+def run_benchmarks(testcases, count, repeat, consul_port, only=None):
+    """
+    Runs each benchmark `repeat` times (after one untimed warm-up call)
+    and returns an ordered dict of {name: stats}.
+    """
+    class BenchmarkTest(testcases.AutopilotPatternTest):
+        project_name = PROJECT
+        _consul = pyconsul.Consul(host='127.0.0.1', port=consul_port)
+
+        def runTest(self):
+            pass
+
+    test = BenchmarkTest()
+    results = OrderedDict()
+    for name, (fn, setup) in _benchmarks(testcases, test, count).items():
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        samples = []
+        for i in range(repeat + 1):
+            test.instrumented_commands = []
+            if setup:
+                setup()
+            start = time.perf_counter()
+            fn()
+            if i:
+                samples.append(time.perf_counter() - start)
+        results[name] = _stats(samples)
+        sys.stderr.write('{:<28} p50 {:.6f}s\n'.format(
+            name, results[name]['p50']))
+    return results
+
+
+# -----------------------------------------
+# results
+
+def compare(results, baseline, threshold, min_delta=0):
+    """
+    Compares the p50 of each benchmark in `results` with the `baseline`
+    results, and returns a list of (name, baseline p50, p50, ratio,
+    regressed) rows for the benchmarks found in both. A benchmark has
+    regressed if its ratio is over `threshold` and it got slower by more
+    than `min_delta` seconds, so that noise in the fastest benchmarks
+    isn't reported.
+    """
+    rows = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50']
+        after = stats['p50']
+        ratio = after / before if before else float('inf')
+        rows.append((name, before, after, ratio,
+                     ratio > threshold and after - before > min_delta))
+    return rows
+
+def _load_harness(docker, compose):
+    """
+    Imports `testcases` from the root of the repo, pointed at the stub
+    executables. This has to happen after they're written because the
+    COMPOSE and DOCKER env vars are read at import time.
+    """
+    os.environ['DOCKER'] = docker
+    os.environ['COMPOSE'] = compose
+    sys.path.insert(0, ROOT)
+    import testcases
+    return testcases
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the overhead of the testcases harness.')
+    parser.add_argument('--containers', type=int, default=200,
+                        help='number of app containers in the stub project')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='timed calls per benchmark')
+    parser.add_argument('--only', action='append',
+                        help='only run benchmarks with this name prefix')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='p50 ratio over the baseline that fails')
+    parser.add_argument('--min-delta', type=float, default=0.001,
+                        help='ignore regressions smaller than this (seconds)')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='bench_harness')
+    server = serve_consul(args.containers)
+    try:
+        docker, compose = write_stubs(directory, args.containers)
+        testcases = _load_harness(docker, compose)
+        results = run_benchmarks(testcases, args.containers, args.repeat,
+                                 server.server_address[1], args.only)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = OrderedDict([
+        ('version', FORMAT_VERSION),
+        ('meta', OrderedDict([
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('containers', args.containers),
+            ('repeat', args.repeat),
+            ('time', time.time()),
+        ])),
+        ('benchmarks', results),
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+            f.write('\n')
+
+    if not args.baseline:
+        if not args.output:
+            json.dump(output, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('version') != FORMAT_VERSION:
+        sys.stderr.write('baseline format version {} is not {}\n'.format(
+            baseline.get('version'), FORMAT_VERSION))
+        return 2
+    if baseline['meta']['containers'] != args.containers:
+        sys.stderr.write('warning: baseline was run with {} containers\n'
+                         .format(baseline['meta']['containers']))
+    rows = compare(results, baseline['benchmarks'], args.threshold,
+                   args.min_delta)
+    sys.stdout.write('{:<28} {:<12} {:<12} {}\n'.format(
+        'benchmark', 'baseline', 'p50', 'ratio'))
+    for name, before, after, ratio, regressed in rows:
+        sys.stdout.write('{:<28} {:<12.6f} {:<12.6f} {:.2f}{}\n'.format(
+            name, before, after, ratio, '  REGRESSED' if regressed else ''))
+    return 1 if any(row[-1] for row in rows) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,4 +2,4 @@ from distutils.core import setup
 
 setup(name='testcases',
       version='0.1',
-      py_modules=['testcases'])
+      py_modules=['testcases', 'testcases_async'])
@@ -2,22 +2,65 @@
 The testcases module is for use by Autopilot Pattern application tests
 to run integration tests using Docker and Compose as its driver.
 """
-from collections import defaultdict, namedtuple
-from functools import wraps
-import inspect
+from collections import defaultdict, deque, namedtuple, OrderedDict
+import csv
+import gzip
+import hashlib
+import importlib
+import io
 import json
 import logging
+import http.client
+import math
 import os
+import queue
+import random
 import re
-import subprocess
+import selectors
+import shutil
+import socket
 import string
+import struct
+import subprocess
 import sys
 import tempfile
+import threading
 import time
+import traceback
 import unittest
-
-import consul as pyconsul
-from IPy import IP
+import urllib.parse
+
+# python-Consul, IPy and the asyncio variant of the test case are
+# imported when they're first needed (see `__getattr__`), so that
+# importing this module stays fast
+_LAZY_IMPORTS = {
+    'pyconsul': ('consul', None),
+    'IP': ('IPy', 'IP'),
+    'AsyncAutopilotPatternTest': ('testcases_async',
+                                  'AsyncAutopilotPatternTest'),
+    'AsyncConsul': ('testcases_async', 'AsyncConsul'),
+    'async_http_get': ('testcases_async', 'async_http_get'),
+    'async_http_request': ('testcases_async', 'async_http_request'),
+    'async_stream_output': ('testcases_async', 'async_stream_output'),
+    'async_wait_for_output': ('testcases_async', 'async_wait_for_output'),
+    'run_process': ('testcases_async', 'run_process'),
+}
+
+def __getattr__(name):
+    """
+    Imports the names in _LAZY_IMPORTS on first use, so that ex.
+    `from testcases import AsyncAutopilotPatternTest` still works
+    (PEP 562).
+    """
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError('module {!r} has no attribute {!r}'
+                             .format(__name__, name))
+    module, attr = _LAZY_IMPORTS[name]
+    value = importlib.import_module(module)
+    if attr:
+        value = getattr(value, attr)
+    globals()[name] = value
+    return value
 
 # -----------------------------------------
 # helpers
@@ -31,16 +74,539 @@ COMPOSE_FILE = os.environ.get('COMPOSE_FILE', 'docker-compose.yml')
 DOCKER = os.environ.get('DOCKER', 'docker')
 """ Optionally override path to docker via DOCKER env var """
 
-Container = namedtuple('Container', ['name', 'command', 'state', 'ports'])
-""" Named tuple describing a container from the output of docker-compose ps """
+Container = namedtuple('Container', ['name', 'command', 'state', 'ports',
+                                     'service', 'number', 'health', 'ips',
+                                     'id'])
+"""
+Named tuple describing a container as listed by `docker-compose ps`. The
+`service`, `number`, `health` (None if the container has no healthcheck),
+`ips` and `id` fields are only available from
+`AutopilotPatternTest.container_inventory`.
+"""
+Container.__new__.__defaults__ = (None,) * 5
+
+Convergence = namedtuple('Convergence', ['containers', 'nodes', 'timings'])
+"""
+Named tuple returned by `AutopilotPatternTest.scale_and_converge` with
+the service's running `Container` list (including their `ips`), its
+healthy Consul nodes, and an OrderedDict of the seconds from the start
+of the call to the end of each phase ('scale', 'containers',
+'registered' and 'converged'), in the order they finished.
+"""
+
+PROJECT_LABEL = 'com.docker.compose.project'
+""" Label that Compose applies to each container of a project """
+
+SERVICE_LABEL = 'com.docker.compose.service'
+""" Label that Compose applies to each container of a service """
+
+NUMBER_LABEL = 'com.docker.compose.container-number'
+""" Label that Compose applies with the instance number of a container """
+
+ONEOFF_LABEL = 'com.docker.compose.oneoff'
+""" Label that Compose applies to `docker-compose run` containers """
+
+LIFECYCLE_COMMANDS = frozenset(['create', 'down', 'kill', 'pause', 'restart',
+                                'rm', 'scale', 'start', 'stop', 'unpause',
+                                'up'])
+"""
+Compose and docker subcommands that change containers, and so
+invalidate the cached results of `AutopilotPatternTest.docker_inspect`
+"""
+
+HEALTH_REGEX = re.compile(r'\((healthy|unhealthy|health: starting)\)')
+""" Pre-compiled regex for the health in `docker ps` status column """
 
 IP_REGEX = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
 """ Pre-compiled regex for getting IPv4 addresses. """
 
+TIMING_REPORT = os.environ.get('TIMING_REPORT', '')
+"""
+Optionally write each test's timing records to this file via the
+TIMING_REPORT env var, for aggregating across runs with
+`summarize_timings`. Records are written as CSV if the file name ends
+in .csv or TIMING_REPORT_FORMAT=csv, and as JSON lines otherwise.
+"""
+
+TIMING_REPORT_FORMAT = os.environ.get('TIMING_REPORT_FORMAT', '')
+""" Optionally force the TIMING_REPORT format ('jsonl' or 'csv') """
+
+Timing = namedtuple('Timing', ['name', 'args', 'elapsed', 'start', 'status',
+                               'output_size', 'test_id', 'attempts'])
+"""
+Named tuple describing a call recorded by `AutopilotPatternTest.instrument`
+or `AutopilotPatternTest.poll`. The `status` is the exit code of a process
+or the exception name of a failed call, `output_size` is the length of
+the captured output, and `attempts` is the number of times a condition
+was checked by `poll`.
+"""
+Timing.__new__.__defaults__ = (None,)
+
+_TIMING_FIELDS = ['test_id', 'type', 'task', 'start', 'elapsed',
+                  'status', 'output_size', 'attempts']
+
+_TIMING_ALIASES = {'stream_output': 'run',
+                   'run_process': 'run',
+                   'async_stream_output': 'run',
+                   'async_wait_for_output': 'wait_for_output',
+                   'async_http_get': 'http_get'}
+"""
+Names under which instrumented functions are recorded, so that calls
+that stream their output and the coroutines awaited by
+`AsyncAutopilotPatternTest.instrument` are reported the same way as the
+calls they replace.
+"""
+
+def _timing_name(fn):
+    """
+    Returns the name that a call to the instrumented function `fn` is
+    recorded under. Calls to the Docker Engine API are recorded as the
+    docker commands they replace (ex. 'docker exec'), so that both
+    backends are aggregated together by `timing_type`.
+    """
+    if isinstance(getattr(fn, '__self__', None), DockerClient):
+        return '{} {}'.format(os.path.basename(DOCKER), fn.__name__)
+    return _TIMING_ALIASES.get(fn.__name__, fn.__name__)
+
 class WaitTimeoutError(Exception):
     """ Exception raised when a timeout occurs. """
     pass
 
+class ContainerCommandError(subprocess.CalledProcessError):
+    """
+    CalledProcessError raised by `AutopilotPatternTest.fan_out` when a
+    command fails, with the `container` it was run against.
+    """
+    def __init__(self, container, ex):
+        super().__init__(ex.returncode, ex.cmd, output=ex.output,
+                         stderr=ex.stderr)
+        self.container = container
+
+    def __str__(self):
+        return '{} (container: {})'.format(super().__str__(), self.container)
+
+def _enqueue_lines(stream, lines):
+    """
+    Reads `stream` line-by-line onto the `lines` queue, followed by
+    None when the stream is closed. Intended as a thread target so that
+    we can read a subprocess' output with a timeout.
+    """
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+def _start_thread(target, *args):
+    """
+    Starts `target(*args)` on a daemon thread, which won't keep the
+    process alive if it's still running when the tests finish.
+    """
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _output_size(output):
+    """ Returns the length of the output of an instrumented call. """
+    if hasattr(output, 'output_size'):
+        return output.output_size
+    output = getattr(output, 'stdout', output)
+    if isinstance(output, (str, bytes)):
+        return len(output)
+    return None
+
+def timing_task(timing):
+    """
+    Returns a human-readable description of the command for a `Timing`.
+    """
+    if timing.name == 'run':
+        return " ".join([str(arg) for arg in timing.args[0]])
+    # we don't want check_output to appear for our external
+    # calls to docker and docker-compose, but if a subclass
+    # instruments a function we want to catch that name
+    args = []
+    for arg in timing.args:
+        args.extend(arg if isinstance(arg, list) else [arg])
+    task = " ".join([str(arg) for arg in args])
+    if timing.attempts is not None:
+        task = '{} ({} attempts)'.format(task, timing.attempts)
+    return '{}: {}'.format(timing.name, task)
+
+def timing_type(timing):
+    """
+    Returns the type of command for a `Timing` so that calls can be
+    aggregated, ex. 'docker exec' or 'docker-compose up'. Instrumented
+    functions other than external processes use the function name.
+    """
+    if timing.name != 'run':
+        return timing.name
+    cmd = [str(arg) for arg in timing.args[0]]
+    words = [os.path.basename(cmd[0])]
+    skip = False
+    for arg in cmd[1:]:
+        if skip:
+            skip = False
+        elif arg in ('-f', '--file', '-p', '--project-name'):
+            skip = True
+        elif not arg.startswith('-'):
+            words.append(arg)
+            break
+    return ' '.join(words)
+
+def _timing_format(filename):
+    if TIMING_REPORT_FORMAT:
+        return TIMING_REPORT_FORMAT
+    return 'csv' if filename.endswith('.csv') else 'jsonl'
+
+def write_timings(filename, timings):
+    """
+    Appends the list of `Timing` records to `filename` as JSON lines or
+    CSV (see `TIMING_REPORT`).
+    """
+    _write_timing_rows(filename, _timing_rows(timings))
+
+def _timing_rows(timings):
+    return [dict(test_id=t.test_id, type=timing_type(t), task=timing_task(t),
+                 start=t.start, elapsed=t.elapsed, status=t.status,
+                 output_size=t.output_size, attempts=t.attempts)
+            for t in timings]
+
+def _write_timing_rows(filename, rows):
+    with open(filename, 'a', newline='') as report:
+        if _timing_format(filename) == 'csv':
+            writer = csv.DictWriter(report, fieldnames=_TIMING_FIELDS)
+            if report.tell() == 0:
+                writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                report.write(json.dumps(row) + '\n')
+
+def read_timings(filename):
+    """
+    Reads the timing records written by `write_timings` as a list of
+    dicts, with `elapsed` parsed as a float.
+    """
+    with open(filename, 'r', newline='') as report:
+        if _timing_format(filename) == 'csv':
+            rows = list(csv.DictReader(report))
+        else:
+            rows = [json.loads(line) for line in report if line.strip()]
+    for row in rows:
+        row['elapsed'] = float(row['elapsed'])
+    return rows
+
+def _percentile(values, percent):
+    """ Nearest-rank percentile of a sorted list of values. """
+    rank = max(1, int(math.ceil(percent / 100.0 * len(values))))
+    return values[rank - 1]
+
+def summarize_timings(*filenames):
+    """
+    Aggregates timing reports from any number of runs, returning a dict
+    of {command type: {count, p50, p95, max}} of elapsed seconds.
+    """
+    elapsed = defaultdict(list)
+    for filename in filenames:
+        for row in read_timings(filename):
+            elapsed[row['type']].append(row['elapsed'])
+    summary = {}
+    for cmd_type, values in elapsed.items():
+        values.sort()
+        summary[cmd_type] = dict(count=len(values),
+                                 p50=_percentile(values, 50),
+                                 p95=_percentile(values, 95),
+                                 max=values[-1])
+    return summary
+
+def _label(labels, name):
+    """
+    Returns the value of the label `name` from the comma-separated
+    `key=value` labels column of `docker ps`, or None if missing.
+    """
+    match = re.search(r'(?:^|,){}=([^,]*)'.format(re.escape(name)), labels)
+    return match.group(1) if match else None
+
+def _container_from_ps(row):
+    """
+    Converts a row of `docker ps --format '{{json .}}'` output into a
+    `Container`, with its state formatted the way Compose formats it
+    (ex. 'Up' or 'Exit 1').
+    """
+    status = row.get('Status', '')
+    if status.startswith('Up'):
+        state = 'Paused' if '(Paused)' in status else 'Up'
+    elif status.startswith('Restarting'):
+        state = 'Restarting'
+    else:
+        exit_code = re.search(r'\((-?\d+)\)', status)
+        state = 'Exit {}'.format(exit_code.group(1) if exit_code else 0)
+
+    health = HEALTH_REGEX.search(status)
+    if health:
+        health = health.group(1).replace('health: ', '')
+
+    labels = row.get('Labels', '')
+    number = _label(labels, NUMBER_LABEL)
+    return Container(name=row.get('Names', '').split(',')[0],
+                     command=row.get('Command', '').strip('"'),
+                     state=state,
+                     ports=row.get('Ports', ''),
+                     service=_label(labels, SERVICE_LABEL),
+                     number=int(number) if number else None,
+                     health=health,
+                     ips=None,
+                     id=row.get('ID'))
+
+def _parse_compose_ps(output):
+    """
+    Parses the columns of the output of `docker-compose ps` into a list
+    of `Container`.
+    """
+    # trim header and any warning text
+    lines = re.split('-+\n', output, re.S|re.M)[1].splitlines()
+
+    # Because the output of `docker-compose ps` isn't line-oriented
+    # we have to do a bunch of ugly parsing/regex to force it into lines.
+
+    def _find_column_windows(line):
+        """
+        Figure out where compose split the column. we need to make
+        sure we catch the last bit so add 2 trailing spaces to the line
+        """
+        segments = re.findall('.*?\s\s+', line+'  ')
+        windows = [0]
+        for i, seg in enumerate(segments):
+            windows.append(windows[i] + len(seg))
+        return windows
+
+    def _find_rows_from_lines(lines):
+        """
+        Combined associated lines into rows (each 'row' is itself still
+        a list of strings) which each represent one running container.
+        """
+        rows = []
+        i = -1
+        for line in lines:
+            if not line.startswith(' '):
+                rows.append([line])
+                i += 1
+            else:
+                rows[i].append(line)
+        return rows
+
+    def _find_fields_from_row(row, windows):
+        """
+        Takes a multi-line row of columized text output and returns the
+        text grouped into a list of strings where each string is the
+        cleaned-up text of a single column.
+        """
+        output = [''] * (len(windows) - 1)
+        for line in row:
+            for i in range(len(windows) - 1):
+                output[i] += line[windows[i]:windows[i+1]]
+
+        # this last scrubbing makes sure we don't have big gaps or
+        # split IP addresses with spaces
+        return [re.sub('\. ', '.', re.sub('  +', ' ', field).strip())
+                for field in output]
+
+    windows = _find_column_windows(lines[0])
+    rows = _find_rows_from_lines(lines)
+    return [Container(*_find_fields_from_row(row, windows)) for row in rows]
+
+def _containers_from_ps(output):
+    """
+    Parses the output of `docker ps --format '{{json .}}'` into a list
+    of `Container`, sorted by service and instance number.
+    """
+    # skip any warning text that's been mixed in from stderr
+    containers = [_container_from_ps(json.loads(line))
+                  for line in output.splitlines()
+                  if line.startswith('{')]
+    containers.sort(key=lambda c: (c.service or '', c.number or 0))
+    return containers
+
+def _inspect_ips(insp):
+    """
+    Returns the list of IP addresses of a container from the output of
+    `docker inspect`, across all of the networks it's attached to.
+    """
+    settings = insp.get('NetworkSettings') or {}
+    ips = [settings.get('IPAddress')]
+    ips.extend(network.get('IPAddress')
+               for network in (settings.get('Networks') or {}).values())
+    unique = []
+    for ip in ips:
+        if ip and ip not in unique:
+            unique.append(ip)
+    return unique
+
+def _classify_ips(ips):
+    """
+    Takes a list of IPv4 address strings and returns a pair of `IPy.IP`
+    (public, private), ignoring the loopback and unspecified addresses.
+    """
+    ips = set(ips)
+    ips.discard('127.0.0.1')
+    ips.discard('0.0.0.0')
+    private = None
+    public = None
+    from IPy import IP
+    for ip in [IP(ip) for ip in ips]:
+        if ip.iptype() == 'PRIVATE':
+            private = ip
+        elif ip.iptype() == 'PUBLIC':
+            public = ip
+    return public, private
+
+MAX_LINE_LENGTH = 1024 * 1024
+""" Longest line of output held in memory by `wait_for_output` """
+
+def wait_for_output(args, match, timeout):
+    """
+    Runs the command `args` and reads its combined stdout/stderr as it's
+    written until a line matches `match`, which can be a substring or a
+    compiled regex, and returns that line. The process is killed once a
+    line matches or the `timeout` expires, in which case WaitTimeoutError
+    is raised. Only the current line of output is held in memory.
+    """
+    if hasattr(match, 'search'):
+        matches = lambda line: match.search(line) is not None
+    else:
+        matches = lambda line: match in line
+    deadline = time.monotonic() + timeout
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(proc.stdout, selectors.EVENT_READ)
+            partial = b''
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not selector.select(remaining):
+                    continue
+                chunk = os.read(proc.stdout.fileno(), 65536)
+                lines = (partial + chunk).split(b'\n')
+                # the last piece is an incomplete line unless we're at EOF
+                partial = lines.pop() if chunk else b''
+                if len(partial) > MAX_LINE_LENGTH:
+                    lines.append(partial)
+                    partial = b''
+                for line in lines:
+                    line = line.decode('utf-8', 'replace').rstrip('\r')
+                    if matches(line):
+                        return line
+                if not chunk:
+                    raise WaitTimeoutError(
+                        'Output of `{}` ended without matching {!r}'.format(
+                            ' '.join(args), match))
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+    raise WaitTimeoutError('Timed out waiting for {!r} in output of `{}`'
+                           .format(match, ' '.join(args)))
+
+TEST_LOG_DIR = os.environ.get('TEST_LOG_DIR',
+                              os.path.join(tempfile.gettempdir(), 'testcases'))
+"""
+Optionally override the directory for per-test log files (see
+`AutopilotPatternTest.log_path`) via TEST_LOG_DIR env var
+"""
+
+OUTPUT_TAIL_LINES = int(os.environ.get('OUTPUT_TAIL_LINES', 100))
+""" Lines of streamed output held in memory (see `stream_output`) """
+
+DIAGNOSTICS_TIMEOUT = float(os.environ.get('DIAGNOSTICS_TIMEOUT', 30))
+"""
+Optionally override the number of seconds spent collecting diagnostics
+for a failed test (see `AutopilotPatternTest.collect_diagnostics`) via
+DIAGNOSTICS_TIMEOUT env var, or set it to 0 to disable them.
+"""
+
+DIAGNOSTICS_LOG_LINES = int(os.environ.get('DIAGNOSTICS_LOG_LINES', 1000))
+""" Lines of each container's logs included in the diagnostics """
+
+_TAIL_LINE_LENGTH = 8192
+
+class _OutputTail(object):
+    """
+    Keeps the last `tail_lines` lines (default: OUTPUT_TAIL_LINES) of
+    output that's read in chunks, along with the full length of the
+    output, for `stream_output`.
+    """
+
+    def __init__(self, tail_lines=None):
+        self.lines = deque(maxlen=tail_lines or OUTPUT_TAIL_LINES)
+        self.size = 0
+        self.partial = b''
+
+    def add(self, chunk):
+        self.size += len(chunk)
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE_LENGTH:
+            lines.append(self.partial)
+            self.partial = b''
+        self.lines.extend(line[:_TAIL_LINE_LENGTH] for line in lines)
+
+    def result(self, args, returncode):
+        """
+        Returns a `subprocess.CompletedProcess` with the tail of the
+        output as its stdout, or raises CalledProcessError with the tail
+        as its output if `returncode` is non-zero.
+        """
+        lines = [line.decode('utf-8', 'replace').rstrip('\r')
+                 for line in self.lines]
+        if self.partial:
+            lines.append(self.partial[:_TAIL_LINE_LENGTH]
+                         .decode('utf-8', 'replace'))
+        output = '\n'.join(lines) + \
+            ('\n' if lines and not self.partial else '')
+        if returncode:
+            ex = subprocess.CalledProcessError(returncode, args, output=output)
+            ex.output_size = self.size
+            raise ex
+        result = subprocess.CompletedProcess(args, returncode, stdout=output)
+        result.output_size = self.size
+        return result
+
+def stream_output(args, filename, tail_lines=None):
+    """
+    Runs the command `args` and appends its combined stdout/stderr to
+    the file `filename` as it's written, rather than holding it all in
+    memory. Returns a `subprocess.CompletedProcess` whose stdout is only
+    the last `tail_lines` lines (default: OUTPUT_TAIL_LINES) of the
+    output, and whose `output_size` is the full length of the output.
+    Raises CalledProcessError with the tail as its output if the command
+    exits non-zero.
+    """
+    tail = _OutputTail(tail_lines)
+    with open(filename, 'ab') as f:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        try:
+            while True:
+                chunk = os.read(proc.stdout.fileno(), 65536)
+                if not chunk:
+                    break
+                f.write(chunk)
+                tail.add(chunk)
+            returncode = proc.wait()
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            proc.stdout.close()
+    return tail.result(args, returncode)
+
+def _is_ok(status):
+    """ Whether an HTTP status (or error message) is a 2xx status. """
+    return isinstance(status, int) and 200 <= status < 300
+
 def dump_environment_to_file(filepath):
     """
     Takes the container's environment and dumps it out to a file
@@ -54,6 +620,1066 @@ def dump_environment_to_file(filepath):
             env_file.write(line)
 
 
+def mutates(*services):
+    """
+    Decorator for test methods of an `AutopilotPatternTest` declaring
+    which services the test leaves in a changed state, by tagging the
+    method with `mutated_services`. When the class sets
+    `reuse_environment`, those services are reset before the next test;
+    otherwise the tag has no effect. Ex.
+
+    @mutates('mysql')
+    def test_failover(self):
+        self.docker_stop('mysql_1')
+    """
+    def decorator(fn):
+        fn.mutated_services = services
+        return fn
+    return decorator
+
+
+# -----------------------------------------
+# environment snapshots
+
+SNAPSHOT_DIR = os.environ.get(
+    'SNAPSHOT_DIR', os.path.expanduser('~/.cache/testcases/snapshots'))
+""" Optionally override where snapshots are kept via SNAPSHOT_DIR env var """
+
+SNAPSHOT_MAX_AGE = float(os.environ.get('SNAPSHOT_MAX_AGE', 7 * 24 * 3600))
+""" Age in seconds after which snapshots are evicted (default: 1 week) """
+
+SNAPSHOT_MAX_SIZE = int(os.environ.get('SNAPSHOT_MAX_SIZE', 10 * 1024 ** 3))
+""" Total size in bytes of images and archives kept (default: 10GiB) """
+
+COMPOSE_VERSION_REGEX = re.compile(r'^version:\s*[\'"]?([\d.]+)', re.M)
+""" Pre-compiled regex for the version of a compose file """
+
+def _compose_file_version(filename):
+    """
+    Returns the version of the compose file format, or None for the
+    version 1 format, which has no version key.
+    """
+    with open(filename, 'r') as source:
+        match = COMPOSE_VERSION_REGEX.search(source.read())
+    return match.group(1) if match else None
+
+def export_path(container, path, archive):
+    """
+    Streams the contents of `path` in the container as a tar archive
+    (via `docker cp`) into the gzipped file `archive`. This works against
+    remote Docker hosts because nothing needs to be mounted.
+    """
+    args = [DOCKER, 'cp', '{}:{}'.format(container, path), '-']
+    with gzip.open(archive, 'wb') as target:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        shutil.copyfileobj(proc.stdout, target)
+        _, err = proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args,
+                                            output=err.decode('utf-8'))
+
+def import_path(container, path, archive):
+    """
+    Restores an `archive` written by `export_path` into the container,
+    which can be created but not yet started.
+    """
+    parent = os.path.dirname(path.rstrip('/')) or '/'
+    args = [DOCKER, 'cp', '-', '{}:{}'.format(container, parent)]
+    with gzip.open(archive, 'rb') as source:
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        shutil.copyfileobj(source, proc.stdin)
+        out, _ = proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args,
+                                            output=out.decode('utf-8'))
+
+def _write_tarball(filename, prefix, members):
+    """
+    Writes the gzipped tar archive `filename` with a file under the
+    directory `prefix` for each of the {name: text} `members`. The
+    archive is written to a temporary file first so that a partial
+    archive is never left behind.
+    """
+    import tarfile
+    partial = '{}.partial'.format(filename)
+    with tarfile.open(partial, 'w:gz') as archive:
+        for name, text in members.items():
+            data = text.encode('utf-8', 'replace')
+            info = tarfile.TarInfo('{}/{}'.format(prefix, name))
+            info.size = len(data)
+            info.mtime = time.time()
+            archive.addfile(info, io.BytesIO(data))
+    os.replace(partial, filename)
+
+
+# -----------------------------------------
+# env files
+
+class EnvFile(object):
+    """
+    An environment file (as used by Compose or bash) parsed once into an
+    ordered index of {variable: value}. The file is only parsed again if
+    its modification time or size has changed since it was last read.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._stat = None
+        self._lines = []
+        self._index = OrderedDict()
+
+    def _load(self):
+        """ Parses the file if it's changed since we last read it. """
+        stat = os.stat(self.filename)
+        if (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return
+        with open(self.filename, 'r') as source:
+            lines = source.readlines()
+        index = OrderedDict()
+        for i, line in enumerate(lines):
+            if line.startswith('#') or not line.strip():
+                continue
+            try:
+                var, _ = line.strip().split('=', 1)
+            except ValueError:
+                log.error('env file line "%s" is invalid, skipping' % line)
+                continue
+            index.setdefault(var, []).append(i)
+        self._lines = lines
+        self._index = index
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+
+    def _value(self, var):
+        # the last assignment wins, as it does for bash and Compose
+        return self._lines[self._index[var][-1]].strip().split('=', 1)[1]
+
+    def __getitem__(self, var):
+        self._load()
+        return self._value(var)
+
+    def __contains__(self, var):
+        self._load()
+        return var in self._index
+
+    def get(self, var, default=None):
+        """ Returns the value of `var`, or `default` if it's not set. """
+        self._load()
+        return self._value(var) if var in self._index else default
+
+    def items(self):
+        """ Returns a list of (variable, value) pairs in file order. """
+        self._load()
+        return [(var, self._value(var)) for var in self._index]
+
+    def update(self, substitutions):
+        """
+        Replaces the value of every assignment to each variable in
+        `substitutions` (a dict or an iterable of (variable, value) pairs)
+        in a single pass over the file. Variables that aren't already in
+        the file are ignored. The file is replaced atomically so readers
+        never see a partially-written file.
+        """
+        self._load()
+        lines = list(self._lines)
+        for var, val in dict(substitutions).items():
+            for i in self._index.get(var, []):
+                lines[i] = '{}={}\n'.format(var, val)
+
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.env-')
+        try:
+            with os.fdopen(fd, 'w') as target:
+                target.writelines(lines)
+            os.chmod(tmp, os.stat(self.filename).st_mode & 0o7777)
+            os.replace(tmp, self.filename)
+        except Exception:
+            os.remove(tmp)
+            raise
+        self._lines = lines
+        stat = os.stat(self.filename)
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+
+_env_files = {}
+_env_files_lock = threading.Lock()
+
+def env_file(filename):
+    """
+    Returns the shared `EnvFile` for `filename`, so that repeated reads
+    of an unchanged file don't parse it again.
+    """
+    path = os.path.abspath(filename)
+    with _env_files_lock:
+        if path not in _env_files:
+            _env_files[path] = EnvFile(path)
+        return _env_files[path]
+
+
+# -----------------------------------------
+# Consul health snapshots
+
+class ConsulSnapshot(object):
+    """
+    In-memory index of the state of every health check in Consul and of
+    the catalog of services, built from a single `/v1/health/state/any`
+    and `/v1/catalog/services` query. Answers questions about services,
+    checks and nodes without making further requests, other than one
+    catalog query per service whose addresses are asked for, or whose
+    instances have no checks of their own (ex. Consul's `consul`
+    service). Get an up-to-date snapshot with
+    `AutopilotPatternTest.consul_snapshot`.
+    """
+
+    def __init__(self, consul, index, checks, services):
+        self.consul = consul
+        self.index = index
+        self.services = services
+        self.by_check = defaultdict(list)
+        self.by_node = defaultdict(list)
+        self.by_service = defaultdict(lambda: defaultdict(list))
+        for check in checks or []:
+            self.by_check[check['CheckID']].append(check)
+            self.by_node[check['Node']].append(check)
+            if check.get('ServiceID'):
+                instance = (check['Node'], check['ServiceID'])
+                self.by_service[check['ServiceName']][instance].append(check)
+        self._catalog = {}
+
+    def node_passing(self, node):
+        """ Whether all the node-level checks (ex. serfHealth) pass. """
+        return all(check['Status'] == 'passing'
+                   for check in self.by_node.get(node, [])
+                   if not check.get('ServiceID'))
+
+    def has_service_checks(self, service_name):
+        """
+        Whether any instance of the service has checks of its own. The
+        instances of services without them are read from the catalog.
+        """
+        return service_name in self.by_service
+
+    def catalog_instances(self, service_name):
+        """
+        Returns a dict of {(node, service ID): address} of the instances
+        of the service registered in the catalog, which is queried once
+        per service for this snapshot.
+        """
+        if service_name not in self._catalog:
+            nodes = []
+            if self.in_catalog(service_name):
+                nodes = self.consul.catalog.service(service_name)[1]
+            self._set_catalog(service_name, nodes)
+        return self._catalog[service_name]
+
+    def in_catalog(self, service_name):
+        """
+        Whether the service may be in the catalog: always true if the
+        snapshot wasn't taken with the catalog's list of services.
+        """
+        return self.services is None or service_name in self.services
+
+    def _set_catalog(self, service_name, nodes):
+        """ Stores a `/v1/catalog/service/<service_name>` result. """
+        self._catalog[service_name] = {
+            (node['Node'], node['ServiceID']): node['ServiceAddress']
+            for node in nodes or []}
+
+    def passing_instances(self, service_name):
+        """
+        Returns the (node, service ID) pairs of the instances of the
+        service whose checks and node checks are all passing, the same
+        instances that `health.service(..., passing=True)` returns.
+        """
+        if self.has_service_checks(service_name):
+            instances = self.by_service[service_name]
+        else:
+            instances = dict.fromkeys(self.catalog_instances(service_name),
+                                      ())
+        return sorted(
+            instance for instance, checks in instances.items()
+            if self.node_passing(instance[0])
+            and all(check['Status'] == 'passing' for check in checks))
+
+    def service_instances(self, service_name):
+        """
+        Returns the container names of the passing instances of the
+        service, relying on ContainerPilot's naming convention of
+        injecting the container hostname into the service ID.
+        """
+        prefix = '{}-'.format(service_name)
+        return [service_id.replace(prefix, '', 1) for _, service_id in
+                self.passing_instances(service_name)]
+
+    def service_addresses(self, service_name):
+        """
+        Returns the addresses of the passing instances of the service.
+        The addresses aren't part of the health state, so they're read
+        from the catalog (see `catalog_instances`).
+        """
+        addresses = self.catalog_instances(service_name)
+        return [addresses[instance]
+                for instance in self.passing_instances(service_name)
+                if instance in addresses]
+
+    def is_check_passing(self, key):
+        """
+        Whether the check with the ID `key` is passing. Raises KeyError
+        if there's no such check.
+        """
+        checks = self.by_check.get(key)
+        if not checks:
+            raise KeyError(key)
+        return all(check['Status'] == 'passing' for check in checks)
+
+
+# -----------------------------------------
+# HTTP and Docker Engine API clients
+
+DOCKER_BACKEND = os.environ.get('DOCKER_BACKEND', 'cli')
+"""
+Optionally set DOCKER_BACKEND=api so that `docker_exec`, `docker_inspect`,
+`docker_logs` and `docker_stop` talk to the Docker Engine API over a
+pool of keep-alive connections rather than forking the docker client.
+"""
+
+DURATION_REGEX = re.compile(r'^(\d+(?:\.\d+)?)(ms|s|m|h)$')
+""" Pre-compiled regex for Go-style durations like '10m' """
+
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def _since_timestamp(since):
+    """
+    Converts the `since` argument of `docker logs` (a unix timestamp or
+    a relative duration like '10m') to a unix timestamp for the API.
+    Returns None for formats we don't handle.
+    """
+    since = str(since)
+    match = DURATION_REGEX.match(since)
+    if match:
+        return int(time.time() -
+                   float(match.group(1)) * _DURATION_UNITS[match.group(2)])
+    try:
+        return int(float(since))
+    except ValueError:
+        return None
+
+def _demux(data):
+    """
+    Strips the multiplexing headers from an attached stdout/stderr
+    stream of the Docker API (each frame has an 8 byte header with the
+    stream type and frame size). Streams for containers with a TTY
+    aren't multiplexed and are returned unchanged.
+    """
+    if len(data) < 8 or data[0] not in (0, 1, 2) or data[1:4] != b'\0\0\0':
+        return data
+    output = bytearray()
+    i = 0
+    while i + 8 <= len(data):
+        size = struct.unpack('>I', data[i + 4:i + 8])[0]
+        output += data[i + 8:i + 8 + size]
+        i += 8 + size
+    return bytes(output)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of up to `size` idle keep-alive connections, where
+    `connect` is a function that returns a new `http.client` connection.
+    """
+
+    def __init__(self, connect, size=8):
+        self.connect = connect
+        self._idle = queue.LifoQueue(size)
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Makes a request on an idle connection (or a new one if none are
+        idle) and returns the pair (response, body). A request on an idle
+        connection that the server has since closed is retried once.
+        """
+        headers = headers or {}
+        try:
+            conn, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            conn, reused = self.connect(), False
+        try:
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                if not reused:
+                    raise
+                # the server closed the idle keep-alive connection
+                conn.close()
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        return response, data
+
+    def close(self):
+        """ Closes all the idle connections. """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_http_pools = {}
+_http_pools_lock = threading.Lock()
+
+def http_get(host, port, path, timeout=10):
+    """
+    Makes a GET request for `path` to `host`:`port` on a pooled
+    keep-alive connection and returns the pair (status, body).
+    """
+    key = (str(host), int(port), timeout)
+    with _http_pools_lock:
+        if key not in _http_pools:
+            _http_pools[key] = ConnectionPool(
+                lambda: http.client.HTTPConnection(key[0], key[1],
+                                                   timeout=timeout))
+        pool = _http_pools[key]
+    response, data = pool.request('GET', path)
+    return response.status, data
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTPConnection to the Docker daemon over a unix socket. """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+    """
+    Minimal client for the parts of the Docker Engine API used by
+    `AutopilotPatternTest`. Keeps a pool of keep-alive connections to the
+    daemon at `base_url`, which is either 'unix:///path/to/docker.sock' or
+    'tcp://host:port' (using TLS with the certificates in `cert_path` if
+    it's set). Errors are raised as CalledProcessError so that callers
+    can treat the API and the docker client the same way.
+    """
+
+    def __init__(self, base_url='unix:///var/run/docker.sock',
+                 tls_verify=False, cert_path=None, timeout=None, pool_size=8):
+        self.base_url = base_url
+        self.tls_verify = tls_verify
+        self.cert_path = cert_path
+        self.timeout = timeout
+        self._pool = ConnectionPool(self._connect, pool_size)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Returns a shared client for the daemon configured by DOCKER_HOST,
+        DOCKER_TLS_VERIFY and DOCKER_CERT_PATH (as changed by
+        `AutopilotPatternTest.set_remote_docker_env`).
+        """
+        env = (os.environ.get('DOCKER_HOST') or 'unix:///var/run/docker.sock',
+               bool(os.environ.get('DOCKER_TLS_VERIFY')),
+               os.environ.get('DOCKER_CERT_PATH') or None)
+        with _docker_clients_lock:
+            if env not in _docker_clients:
+                _docker_clients[env] = cls(*env)
+            return _docker_clients[env]
+
+    def _connect(self):
+        if self.base_url.startswith('unix://'):
+            return _UnixHTTPConnection(self.base_url[len('unix://'):],
+                                       timeout=self.timeout)
+        host, _, port = self.base_url.split('://', 1)[-1].partition(':')
+        port = int(port or 2375)
+        if not (self.cert_path or self.tls_verify):
+            return http.client.HTTPConnection(host, port, timeout=self.timeout)
+        import ssl
+        cert_path = self.cert_path or os.path.expanduser('~/.docker')
+        if self.tls_verify:
+            context = ssl.create_default_context(
+                cafile=os.path.join(cert_path, 'ca.pem'))
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(os.path.join(cert_path, 'cert.pem'),
+                                os.path.join(cert_path, 'key.pem'))
+        return http.client.HTTPSConnection(host, port, timeout=self.timeout,
+                                           context=context)
+
+    def request(self, method, path, params=None, body=None, cmd=None):
+        """
+        Makes a request to the daemon and returns the pair (status, body),
+        raising CalledProcessError with the daemon's error message (and
+        `cmd` as the equivalent docker command) on an error status.
+        """
+        if params:
+            path = '{}?{}'.format(path, urllib.parse.urlencode(params))
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        response, data = self._pool.request(method, path, body=body,
+                                            headers=headers)
+        if response.status >= 400:
+            try:
+                message = json.loads(data.decode('utf-8'))['message']
+            except (ValueError, KeyError, TypeError):
+                message = data.decode('utf-8', 'replace')
+            raise subprocess.CalledProcessError(
+                1, cmd or [method, path], output='Error: {}\n'.format(message))
+        return response.status, data
+
+    def exec(self, container, *args):
+        """
+        Runs the command `args` in the container and returns the
+        combined stdout/stderr. Raises CalledProcessError if the command
+        exits non-zero.
+        """
+        cmd = [DOCKER, 'exec', container] + list(args)
+        _, created = self.request(
+            'POST', '/containers/{}/exec'.format(container),
+            body={'AttachStdout': True, 'AttachStderr': True,
+                  'Cmd': list(args)}, cmd=cmd)
+        exec_id = json.loads(created.decode('utf-8'))['Id']
+        _, stream = self.request('POST', '/exec/{}/start'.format(exec_id),
+                                 body={'Detach': False, 'Tty': False},
+                                 cmd=cmd)
+        output = _demux(stream).decode('utf-8', 'replace')
+        _, result = self.request('GET', '/exec/{}/json'.format(exec_id),
+                                 cmd=cmd)
+        exit_code = json.loads(result.decode('utf-8'))['ExitCode']
+        if exit_code:
+            raise subprocess.CalledProcessError(exit_code, cmd, output=output)
+        return output
+
+    def inspect(self, *containers):
+        """
+        Returns a list of the low-level information for the containers,
+        in the same format as `docker inspect`.
+        """
+        inspected = []
+        for container in containers:
+            _, data = self.request('GET', '/containers/{}/json'.format(container),
+                                   cmd=[DOCKER, 'inspect', container])
+            inspected.append(json.loads(data.decode('utf-8')))
+        return inspected
+
+    def logs(self, container, since=None, tail=None):
+        """
+        Returns the combined stdout/stderr logs of the container, since
+        the unix timestamp `since` if it's given, and only the last
+        `tail` lines if it's given.
+        """
+        params = {'stdout': 1, 'stderr': 1}
+        if since is not None:
+            params['since'] = since
+        if tail is not None:
+            params['tail'] = tail
+        _, data = self.request('GET', '/containers/{}/logs'.format(container),
+                               params=params,
+                               cmd=[DOCKER, 'logs', container])
+        return _demux(data).decode('utf-8', 'replace')
+
+    def stop(self, container):
+        """ Stops the container and returns its name like `docker stop`. """
+        self.request('POST', '/containers/{}/stop'.format(container),
+                     cmd=[DOCKER, 'stop', container])
+        return '{}\n'.format(container)
+
+    def close(self):
+        """ Closes all the idle connections in the pool. """
+        self._pool.close()
+
+_docker_clients = {}
+_docker_clients_lock = threading.Lock()
+
+
+# -----------------------------------------
+# container resource telemetry
+
+STATS_INTERVAL = float(os.environ.get('STATS_INTERVAL', 0))
+"""
+Optionally set STATS_INTERVAL to a number of seconds to sample the CPU,
+memory and I/O of the project's containers with `docker stats` for the
+whole of each test, at most once per interval (default: 0, disabled).
+"""
+
+STATS_BUFFER_SIZE = int(os.environ.get('STATS_BUFFER_SIZE', 300))
+""" Samples kept per container by `StatsSampler` """
+
+STATS_MAX_OVERHEAD = float(os.environ.get('STATS_MAX_OVERHEAD', 0.02))
+"""
+Fraction of a CPU that `StatsSampler` may spend parsing samples before it
+backs off by doubling its interval.
+"""
+
+Sample = namedtuple('Sample', ['time', 'cpu', 'mem', 'net_rx', 'net_tx',
+                               'block_read', 'block_write'])
+"""
+Named tuple for one sample of a container's resource usage: the CPU use
+in percent of one core, memory use in bytes, and the bytes of network and
+block I/O since the container started.
+"""
+
+SIZE_REGEX = re.compile(r'([\d.]+)\s*([kKMGTP]?)(i?)B')
+""" Pre-compiled regex for sizes in `docker stats` output like '1.5MiB' """
+
+_SIZE_UNITS = {'': 0, 'k': 1, 'K': 1, 'M': 2, 'G': 3, 'T': 4, 'P': 5}
+
+_STATS_NAME_REGEX = re.compile(r'"Name":\s*"([^"]*)"')
+
+def _parse_size(size):
+    """ Converts a size like '1.5MiB' or '648B' to a number of bytes. """
+    match = SIZE_REGEX.search(size or '')
+    if not match:
+        return 0
+    number, unit, binary = match.groups()
+    return float(number) * (1024 if binary else 1000) ** _SIZE_UNITS[unit]
+
+def _parse_percent(percent):
+    """
+    Converts a percentage like '12.5%' to a float, or returns None for
+    the '--' that `docker stats` shows when it has no valid sample (ex.
+    for a stopped container).
+    """
+    try:
+        return float((percent or '').rstrip('%'))
+    except ValueError:
+        return None
+
+def _parse_pair(pair):
+    """ Converts a pair of sizes like '1.2kB / 648B' to bytes. """
+    first, _, second = (pair or '').partition('/')
+    return _parse_size(first), _parse_size(second)
+
+def _format_size(size):
+    """ Formats a number of bytes like `docker stats` (ex. '1.5MiB'). """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    return '{:.1f}{}'.format(size, unit)
+
+
+class ContainerStats(object):
+    """
+    Resource usage of one container: a ring buffer of the most recent
+    `Sample`, plus the peak and mean CPU and memory use over every sample
+    taken, including those that have since left the buffer.
+    """
+
+    def __init__(self, name, size=STATS_BUFFER_SIZE):
+        self.name = name
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.cpu_total = 0.0
+        self.cpu_peak = 0.0
+        self.mem_total = 0.0
+        self.mem_peak = 0.0
+        self.next_due = 0
+
+    def add(self, sample):
+        self.samples.append(sample)
+        self.count += 1
+        self.cpu_total += sample.cpu
+        self.cpu_peak = max(self.cpu_peak, sample.cpu)
+        self.mem_total += sample.mem
+        self.mem_peak = max(self.mem_peak, sample.mem)
+
+    @property
+    def cpu_mean(self):
+        return self.cpu_total / self.count if self.count else 0.0
+
+    @property
+    def mem_mean(self):
+        return self.mem_total / self.count if self.count else 0.0
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+
+class StatsSampler(object):
+    """
+    Streams `docker stats` in the background and keeps a `ContainerStats`
+    for each running container whose name starts with `prefix` (a string
+    or tuple of strings; every container if it's empty), including
+    containers started later. Lines
+    arriving less than `interval` seconds after the last kept sample of a
+    container are dropped before being parsed. If parsing uses more than
+    `max_overhead` of a CPU the interval is doubled, and the CPU time of
+    the sampler and of the `docker stats` process are reported as
+    `overhead` once it's stopped.
+    """
+
+    def __init__(self, prefix='', interval=1.0, size=STATS_BUFFER_SIZE,
+                 max_overhead=STATS_MAX_OVERHEAD):
+        self.prefix = prefix
+        self.interval = interval
+        self.size = size
+        self.max_overhead = max_overhead
+        self.containers = OrderedDict()
+        self.lines = 0
+        self.dropped = 0
+        self.overhead = {}
+        self._lock = threading.Lock()
+        self._proc = None
+        self._thread = None
+        self._started = None
+
+    def start(self):
+        """ Starts the `docker stats` process and the reader thread. """
+        self._started = time.monotonic()
+        self._proc = subprocess.Popen(
+            [DOCKER, 'stats', '--format', '{{json .}}'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _read(self):
+        thread_time = getattr(time, 'thread_time', time.process_time)
+        cpu_origin = cpu_start = thread_time()
+        window_start = self._started
+        for line in self._proc.stdout:
+            self.lines += 1
+            # the stream redraws the screen with escape codes
+            # before each round of samples
+            name = _STATS_NAME_REGEX.search(line)
+            if not name or not name.group(1).startswith(self.prefix):
+                continue
+            now = time.monotonic()
+            with self._lock:
+                stats = self.containers.get(name.group(1))
+                if stats is None:
+                    stats = ContainerStats(name.group(1), self.size)
+                    self.containers[stats.name] = stats
+                if now < stats.next_due:
+                    self.dropped += 1
+                    continue
+                stats.next_due = now + self.interval
+            try:
+                row = json.loads(line[line.index('{'):])
+                cpu_percent = _parse_percent(row.get('CPUPerc'))
+                if cpu_percent is None:
+                    # no valid stats, ex. the container was stopped
+                    continue
+                sample = Sample(time.time(), cpu_percent,
+                                _parse_pair(row.get('MemUsage'))[0],
+                                *(_parse_pair(row.get('NetIO')) +
+                                  _parse_pair(row.get('BlockIO'))))
+            except (ValueError, TypeError, AttributeError) as ex:
+                # one malformed row mustn't stop the sampler
+                log.debug('skipping docker stats line %r: %s', line, ex)
+                continue
+            with self._lock:
+                stats.add(sample)
+            cpu = thread_time() - cpu_start
+            if (now - window_start > 5 and
+                    cpu / (now - window_start) > self.max_overhead):
+                self.interval *= 2
+                cpu_start = thread_time()
+                window_start = now
+        self.overhead['sampler_cpu'] = thread_time() - cpu_origin
+
+    def stop(self):
+        """
+        Stops sampling and records the CPU time used by the sampler
+        thread and by the `docker stats` process in `overhead`.
+        """
+        if not self._proc:
+            return
+        self._proc.kill()
+        try:
+            _, status, usage = os.wait4(self._proc.pid, 0)
+            self._proc.returncode = -9
+            self.overhead['docker_stats_cpu'] = usage.ru_utime + usage.ru_stime
+        except (AttributeError, ChildProcessError):
+            self._proc.wait()
+        self._thread.join(5)
+        self._proc.stdout.close()
+        self._proc = None
+
+    def summary(self):
+        """
+        Returns a list of the `ContainerStats` for every container that
+        was sampled, sorted by name.
+        """
+        with self._lock:
+            return sorted((s for s in self.containers.values() if s.count),
+                          key=lambda s: s.name)
+
+
+# -----------------------------------------
+# recording and replaying tests
+
+CASSETTE_MODE = os.environ.get('CASSETTE_MODE', '')
+"""
+Optionally set CASSETTE_MODE=record to record every instrumented docker,
+compose, Docker API and HTTP call and Consul request of each test to a
+cassette file, or CASSETTE_MODE=replay to serve them from the cassette
+instead, without Docker (see `Cassette`).
+"""
+
+CASSETTE_DIR = os.environ.get('CASSETTE_DIR', 'cassettes')
+""" Optionally override the directory of cassette files via CASSETTE_DIR """
+
+_CONSUL_IGNORED_PARAMS = frozenset(['wait'])
+
+
+class CassetteError(Exception):
+    """
+    Raised when a replayed test diverges from its cassette by making a
+    call that wasn't recorded, or by not making all the recorded calls.
+    """
+    pass
+
+
+def _cassette_args(value):
+    """
+    Converts the arguments of a call to plain JSON values so that they
+    can be compared with the recorded calls of a cassette.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_cassette_args(v) for v in value]
+    if hasattr(value, 'pattern'):
+        return value.pattern
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+def _cassette_key(name, args):
+    """
+    Returns the key of an instrumented call in a cassette: the name of
+    the call and its arguments, minus those that vary between runs like
+    the path of the docker client and the log file of `stream_output`.
+    """
+    args = _cassette_args(args)
+    if name == 'stream_output':
+        args = args[:1]
+    if args and isinstance(args[0], list) and args[0]:
+        args[0][0] = os.path.basename(args[0][0])
+    return [_TIMING_ALIASES.get(name, name)] + args
+
+def _encode_result(value):
+    """ Converts the result of an instrumented call to a JSON value. """
+    if isinstance(value, subprocess.CompletedProcess):
+        return ['completed', value.returncode, value.stdout,
+                getattr(value, 'output_size', None)]
+    if isinstance(value, bytes):
+        import base64
+        return ['bytes', base64.b64encode(value).decode('ascii')]
+    if isinstance(value, tuple):
+        return ['tuple', [_encode_result(v) for v in value]]
+    return ['json', value]
+
+def _decode_result(args, encoded):
+    """ Converts a result encoded by `_encode_result` back again. """
+    kind, value = encoded[0], encoded[1]
+    if kind == 'completed':
+        result = subprocess.CompletedProcess(args[0], value,
+                                             stdout=encoded[2])
+        if encoded[3] is not None:
+            result.output_size = encoded[3]
+        return result
+    if kind == 'bytes':
+        import base64
+        return base64.b64decode(value)
+    if kind == 'tuple':
+        return tuple(_decode_result(args, v) for v in value)
+    return value
+
+def _encode_error(ex):
+    """ Converts an exception raised by an instrumented call to JSON. """
+    error = {'type': type(ex).__name__, 'message': str(ex)}
+    if isinstance(ex, subprocess.CalledProcessError):
+        error.update(returncode=ex.returncode, output=ex.output,
+                     cmd=_cassette_args(ex.cmd),
+                     output_size=getattr(ex, 'output_size', None))
+    return ['error', error]
+
+def _decode_error(error):
+    """
+    Returns the exception encoded by `_encode_error`, falling back to
+    OSError for exceptions other than CalledProcessError,
+    WaitTimeoutError and the builtin and `http.client` errors.
+    """
+    if 'returncode' in error:
+        ex = subprocess.CalledProcessError(error['returncode'], error['cmd'],
+                                           output=error['output'])
+        if error['output_size'] is not None:
+            ex.output_size = error['output_size']
+        return ex
+    import builtins
+    cls = (globals().get(error['type']) or
+           getattr(builtins, error['type'], None) or
+           getattr(http.client, error['type'], None))
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        cls = OSError
+    return cls(error['message'])
+
+
+class Cassette(object):
+    """
+    The calls made by one test and their results, timings and errors,
+    stored as gzipped JSON in `filename`. When recording, calls are
+    appended with `record` and written by `save`. When replaying, each
+    call is answered by `replay` with the first recorded call that has
+    the same key and hasn't been replayed yet, so that concurrent calls
+    (ex. from `fan_out`) can be replayed in any order. A call that
+    wasn't recorded raises CassetteError.
+    """
+
+    def __init__(self, filename, mode):
+        self.filename = filename
+        self.mode = mode
+        self.calls = []
+        self.diverged = False
+        self._replayed = []
+        self._lock = threading.Lock()
+        if mode == 'replay':
+            try:
+                with gzip.open(filename, 'rt') as f:
+                    self.calls = json.load(f)['calls']
+            except (OSError, ValueError, KeyError) as ex:
+                raise CassetteError('Could not load cassette {}: {}'
+                                    .format(filename, ex))
+            self._replayed = [False] * len(self.calls)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def record(self, key, elapsed, result):
+        """ Appends a call and its JSON encoded result. """
+        with self._lock:
+            self.calls.append({'call': key, 'elapsed': round(elapsed, 6),
+                               'result': result})
+
+    def replay(self, key):
+        """
+        Returns the recorded result of the call `key`, or raises
+        CassetteError naming the next recorded call if there's none.
+        """
+        with self._lock:
+            expected = None
+            for i, call in enumerate(self.calls):
+                if self._replayed[i]:
+                    continue
+                if call['call'] == key:
+                    self._replayed[i] = True
+                    return call['result']
+                if expected is None:
+                    expected = call['call']
+        raise self.divergence('unexpected call {}, expected {}'.format(
+            key, expected or 'no more calls'))
+
+    def divergence(self, message):
+        """
+        Marks the replay as diverged and returns a CassetteError with
+        `message` to raise.
+        """
+        self.diverged = True
+        return CassetteError('{} diverged: {}'.format(self.filename, message))
+
+    def unplayed(self):
+        """ Returns the keys of the recorded calls not yet replayed. """
+        with self._lock:
+            return [call['call'] for call, replayed
+                    in zip(self.calls, self._replayed) if not replayed]
+
+    def save(self):
+        """ Writes the recorded calls to the cassette file. """
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            calls = list(self.calls)
+        with gzip.open(self.filename, 'wt') as f:
+            json.dump({'version': 1, 'calls': calls}, f,
+                      separators=(',', ':'))
+
+
+class _CassetteConsulHTTP(object):
+    """
+    Stands in for the HTTP client of a `consul.Consul` to record its
+    requests to a `Cassette`, or to answer them from the cassette when
+    replaying (in which case `http` may be None). The `wait` parameter of
+    blocking queries is left out of the keys because it depends on the
+    time remaining.
+    """
+
+    def __init__(self, http, cassette):
+        self.http = http
+        self.cassette = cassette
+
+    def _call(self, method, callback, path, params=None, **kwargs):
+        import consul.base
+        # python-consul passes a dict of params before 1.0 and a list of
+        # pairs since
+        pairs = params.items() if isinstance(params, dict) else params
+        key = ['consul', method, path] + [
+            [str(k), _cassette_args(v)] for k, v in pairs or []
+            if k not in _CONSUL_IGNORED_PARAMS]
+        if 'data' in kwargs:
+            key.append(_cassette_args(kwargs['data']))
+        if self.cassette.replaying:
+            code, headers, body = self.cassette.replay(key)[1]
+            return callback(consul.base.Response(code, headers, body))
+
+        start = time.time()
+        responses = []
+
+        def capture(response):
+            responses.append(response)
+            return callback(response)
+
+        try:
+            return getattr(self.http, method)(capture, path, params, **kwargs)
+        finally:
+            if responses:
+                response = responses[0]
+                headers = {k: v for k, v in response.headers.items()
+                           if k.lower().startswith('x-consul')}
+                self.cassette.record(
+                    key, time.time() - start,
+                    ['json', [response.code, headers, response.body]])
+
+    def get(self, callback, path, params=None):
+        return self._call('get', callback, path, params)
+
+    def put(self, callback, path, params=None, data=''):
+        return self._call('put', callback, path, params, data=data)
+
+    def delete(self, callback, path, params=None):
+        return self._call('delete', callback, path, params)
+
+    def post(self, callback, path, params=None, data=''):
+        return self._call('post', callback, path, params, data=data)
+
+
 __pdoc__ = {}
 
 # -----------------------------------------
@@ -75,21 +1701,104 @@ class AutopilotPatternTest(unittest.TestCase):
     """
 
     _consul = None
+    _shared_consul = None
+    _consul_snapshot = None
 
     # futzes with pdoc fields so that we don't dump all the methods
     # for unittest.TestCase when we generate docs.
     for _field in unittest.TestCase.__dict__.keys():
         __pdoc__['AutopilotPatternTest.%s' % _field] = None
 
+    reuse_environment = False
+    """
+    Set to True in a test subclass to bring up the Compose environment
+    once in `setUpClass` and reuse it for every test method of the class,
+    rather than recreating all containers before each test. Between tests
+    only the services a test declared it mutated (see `mutates` and
+    `mark_mutated`) are reset via `reset_environment`.
+    """
+
+    docker_backend = DOCKER_BACKEND
+    """
+    Either 'cli' to run the docker client for each call, or 'api' to
+    make the calls of `docker_exec`, `docker_inspect`, `docker_logs` and
+    `docker_stop` over a pooled connection to the Docker Engine API (see
+    DOCKER_BACKEND). The docker client is used as a fallback if the API
+    can't be reached.
+    """
+
+    max_workers = 8
+    """
+    Maximum number of commands run concurrently by `fan_out` and the
+    helpers that use it.
+    """
+
+    snapshot_environment = False
+    """
+    Set to True in a test subclass to snapshot the environment once it's
+    booted and `environment_ready`: each service's container is committed
+    to an image and its data volumes are exported. Later runs with an
+    unchanged compose file and images start from the snapshot instead of
+    a cold boot. Snapshots are kept in SNAPSHOT_DIR and evicted by age and total
+    size (see `evict_snapshots`).
+    """
+
+    stats_interval = STATS_INTERVAL
+    """
+    Set to a number of seconds in a test subclass to sample the resource
+    usage of the project's containers with a `StatsSampler` during each
+    test, and add their mean and peak CPU and memory use to the report
+    (see STATS_INTERVAL). Disabled when 0.
+    """
+
+    cassette_mode = CASSETTE_MODE
+    """
+    Set to 'record' in a test subclass to record the docker, compose and
+    Consul calls of each test to a `Cassette` in CASSETTE_DIR, or to
+    'replay' to answer them from the cassette without running Docker, so
+    that the assertions of a test can be iterated on quickly (see
+    CASSETTE_MODE). A replayed test fails with CassetteError if it
+    doesn't make the same calls as the recording.
+    """
+
+    diagnostics_timeout = DIAGNOSTICS_TIMEOUT
+    """
+    Seconds to spend collecting diagnostics with `collect_diagnostics`
+    when a test fails (see DIAGNOSTICS_TIMEOUT). Disabled when 0.
+    """
+
+    _compose_overrides = ()
+    _dirty_services = None
+    _timeline = None
+    _cassette = None
+    _cassette_consul = None
+    _docker_api_unavailable = False
+
+    def __init__(self, methodName='runTest'):
+        super().__init__(methodName)
+        _configure_logging()
+        self.instrumented_commands = []
+        # each TestCase instance runs a single test, so this caches
+        # `docker_inspect` results for the duration of one test
+        self._inspect_cache = {}
+        self._inspect_lock = threading.Lock()
+        self._inspect_hits = 0
+        self._inspect_misses = 0
+        self._stats_sampler = None
+
     @classmethod
     def setUpClass(cls):
         """
         Ensure that the base class setUp/tearDown is called in all child
         TestCases so that the caller doesn't have to worry about creating
-        and tearing down containers between test runs.
+        and tearing down containers between test runs. If the subclass
+        sets `reuse_environment`, the containers are started here once
+        for the whole class. A test's cassette (see `cassette_mode`) also
+        covers the calls made by the subclass's setUp and tearDown.
         """
         child_setUp = cls.setUp
         def setUp_override(self, *args, **kwargs):
+            self._start_cassette()
             val = child_setUp(self, *args, **kwargs)
             AutopilotPatternTest._setUp(self)
             return val
@@ -97,32 +1806,282 @@ class AutopilotPatternTest(unittest.TestCase):
 
         child_tearDown = cls.tearDown
         def tearDown_override(self, *args, **kwargs):
-            AutopilotPatternTest._tearDown(self)
-            return child_tearDown(self, *args, **kwargs)
+            try:
+                AutopilotPatternTest._tearDown(self)
+                return child_tearDown(self, *args, **kwargs)
+            finally:
+                self._stop_cassette()
         cls.tearDown = tearDown_override
 
+        cls._dirty_services = set()
+        if cls.reuse_environment:
+            # unittest lets us construct a TestCase without a test method,
+            # which gives us an instance with the instrumented helpers
+            env = cls()
+            env._start_cassette()
+            try:
+                env._start_environment()
+            except Exception:
+                env._collect_on_failure(traceback.format_exc())
+                raise
+            finally:
+                env._report()
+                env._stop_cassette()
+
     def _setUp(self):
         """
         AutopilotPatternTest._setUp will be called after a subclass's
         own setUp. First asserts that there are not running containers,
         then starts the containers and waits for them all to be
-        marked with Status 'Up'
+        marked with Status 'Up'. If the class reuses its environment,
+        only the services dirtied by previous tests are reset.
         """
         self.instrumented_commands = []
+        self._timeline = None
+        if self.stats_interval and not (self._cassette and
+                                        self._cassette.replaying):
+            self._start_stats()
+        if self.reuse_environment:
+            dirty = type(self)._dirty_services
+            if dirty:
+                services = sorted(dirty)
+                dirty.clear()
+                self.reset_environment(services)
+            return
+        self._start_environment()
+
+    def _start_environment(self):
+        """
+        Removes any existing containers for the project and then starts
+        all the services, waiting for them to be marked 'Up' and then for
+        `environment_ready`. If the class sets `snapshot_environment`, the
+        services are started from the snapshot of an earlier run if there
+        is one, or a snapshot is taken once the environment is ready.
+        """
+        type(self)._compose_overrides = ()
         self.compose('stop')
         self.compose('rm', '-f')
 
         try:
-            self.compose('up', '-d')
-            self.wait_for_containers()
+            restored = self.snapshot_environment and self._restore_snapshot()
+            if not restored:
+                self.compose('up', '-d')
+                self.wait_for_containers()
+            self.environment_ready()
+            if self.snapshot_environment and not restored:
+                try:
+                    self.take_snapshot()
+                except (subprocess.CalledProcessError, OSError) as ex:
+                    log.warning('could not snapshot environment: %s', ex)
         except subprocess.CalledProcessError as ex:
             self.fail('{} failed: {}'.format(ex.cmd, ex.output))
-            self.compose_logs()
-            self.stop()
         except WaitTimeoutError as ex:
             self.fail(ex)
-            self.compose_logs()
-            self.stop()
+
+    def environment_ready(self):
+        """
+        Called once the containers of a new environment are all 'Up'.
+        Subclasses can override this to wait until the application is
+        ready (ex. with `wait_for_service`), so that a snapshot taken for
+        `snapshot_environment` captures a fully bootstrapped environment.
+        """
+        pass
+
+    def _snapshot_dir(self):
+        """
+        Returns the directory for the snapshot of this project, keyed by
+        the hash of the compose file and of the IDs of the images its
+        services run (see `_source_images`), so that editing the file or
+        rebuilding or pulling an image makes the snapshot stale.
+        """
+        digest = hashlib.sha256()
+        with open(self.compose_file, 'rb') as source:
+            digest.update(source.read())
+        digest.update(json.dumps(sorted(self._source_images().items()))
+                      .encode('utf-8'))
+        return os.path.join(SNAPSHOT_DIR, '{}-{}'.format(
+            self._project_label(), digest.hexdigest()[:12]))
+
+    def _source_images(self):
+        """
+        Returns a dict of {service: image ID} for the image that each
+        service of the compose file runs, as resolved by `docker-compose
+        config` and `docker inspect`. Services built by Compose use the
+        image Compose names after the project and service. Services whose
+        image doesn't exist yet map to None.
+        """
+        try:
+            import yaml
+            config = yaml.safe_load(self.compose('config'))
+        except ImportError:
+            config = json.loads(self.compose('config', '--format', 'json'))
+        config = config or {}
+        services = config.get('services', config)
+        label = self._project_label()
+        refs = {}
+        for service, options in services.items():
+            if not isinstance(options, dict):
+                continue
+            refs[service] = ([options['image']] if options.get('image') else
+                             ['{}_{}'.format(label, service),
+                              '{}-{}'.format(label, service)])
+
+        def image_id(service):
+            for ref in refs[service]:
+                try:
+                    return self.docker('inspect', '--type', 'image',
+                                       '--format', '{{.Id}}', ref).strip()
+                except subprocess.CalledProcessError:
+                    continue
+            return None
+
+        return self.fan_out(image_id, sorted(refs))
+
+    def take_snapshot(self):
+        """
+        Commits the first running container of each service to an image
+        and exports the contents of its data volumes to tarballs in
+        SNAPSHOT_DIR, so that later runs with the same compose file and
+        images can start from them. Evicts old snapshots first (see
+        `evict_snapshots`). Does nothing if the environment was restored
+        from a snapshot, which is still current.
+        """
+        if self._compose_overrides:
+            return
+        self.evict_snapshots()
+        path = self._snapshot_dir()
+        key = path.rsplit('-', 1)[1]
+        partial = path + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+
+        containers = OrderedDict()
+        for container in self.container_inventory():
+            if container.state == 'Up':
+                containers.setdefault(container.service, container)
+
+        def snapshot_service(service):
+            container = containers[service]
+            tag = 'testcases-snapshot/{}_{}:{}'.format(
+                self._project_label(), re.sub(r'[^a-z0-9_.-]', '',
+                                              service.lower()), key)
+            self.docker('commit', container.id, tag)
+            volumes = []
+            for mount in self.docker_inspect(container.id)[0].get('Mounts',
+                                                                  []):
+                if mount.get('Type', 'volume') != 'volume':
+                    continue
+                archive = '{}-{}.tar.gz'.format(service, len(volumes))
+                self.instrument(export_path, container.id,
+                                mount['Destination'],
+                                os.path.join(partial, archive))
+                volumes.append(dict(destination=mount['Destination'],
+                                    archive=archive))
+            return dict(image=tag, volumes=volumes)
+
+        services = self.fan_out(snapshot_service, list(containers))
+        images = [services[service]['image'] for service in services]
+        size = sum(int(line) for line in self.docker(
+            'inspect', '--type', 'image', '--format', '{{.Size}}',
+            *images).split())
+        size += sum(os.path.getsize(os.path.join(partial, name))
+                    for name in os.listdir(partial))
+
+        # Compose reads JSON as YAML, so the override file can be JSON
+        overrides = {service: {'image': services[service]['image']}
+                     for service in services}
+        version = _compose_file_version(self.compose_file)
+        if version:
+            overrides = {'version': version, 'services': overrides}
+        with open(os.path.join(partial, 'docker-compose.override.yml'),
+                  'w') as override:
+            json.dump(overrides, override, indent=2)
+        with open(os.path.join(partial, 'manifest.json'), 'w') as manifest:
+            json.dump(dict(created=time.time(), size=size,
+                           compose_file=os.path.abspath(self.compose_file),
+                           services=services), manifest, indent=2)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(partial, path)
+
+    def _restore_snapshot(self):
+        """
+        Creates the containers from the images of the snapshot for this
+        compose file (if there is an unexpired one), restores their data
+        volumes and starts them. Returns True if the environment was
+        restored, or False (after cleaning up) if it needs a cold boot.
+        """
+        path = self._snapshot_dir()
+        try:
+            with open(os.path.join(path, 'manifest.json'), 'r') as source:
+                manifest = json.load(source)
+        except (OSError, ValueError):
+            return False
+        if time.time() - manifest['created'] > SNAPSHOT_MAX_AGE:
+            return False
+
+        services = manifest['services']
+        try:
+            self.docker('inspect', '--type', 'image',
+                        *[services[service]['image'] for service in services])
+        except subprocess.CalledProcessError:
+            # the images have been removed from under us
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+
+        type(self)._compose_overrides = (
+            os.path.join(path, 'docker-compose.override.yml'),)
+        try:
+            self.compose('create')
+            for service, snapshot in services.items():
+                if not snapshot['volumes']:
+                    continue
+                for container in self.container_inventory(service):
+                    for volume in snapshot['volumes']:
+                        self.instrument(import_path, container.id,
+                                        volume['destination'],
+                                        os.path.join(path, volume['archive']))
+            self.compose('up', '-d')
+            self.wait_for_containers()
+        except (subprocess.CalledProcessError, WaitTimeoutError) as ex:
+            log.warning('could not restore snapshot %s: %s', path, ex)
+            type(self)._compose_overrides = ()
+            self.compose('stop')
+            self.compose('rm', '-f')
+            return False
+        return True
+
+    def evict_snapshots(self, max_age=None, max_size=None):
+        """
+        Removes the snapshots (images and volume archives) in SNAPSHOT_DIR
+        older than `max_age` seconds, and then the oldest snapshots until
+        the total size is no more than `max_size` bytes. Defaults to
+        SNAPSHOT_MAX_AGE and SNAPSHOT_MAX_SIZE.
+        """
+        max_age = SNAPSHOT_MAX_AGE if max_age is None else max_age
+        max_size = SNAPSHOT_MAX_SIZE if max_size is None else max_size
+        snapshots = []
+        if os.path.isdir(SNAPSHOT_DIR):
+            for name in os.listdir(SNAPSHOT_DIR):
+                path = os.path.join(SNAPSHOT_DIR, name)
+                try:
+                    with open(os.path.join(path, 'manifest.json'), 'r') as source:
+                        snapshots.append((json.load(source), path))
+                except (OSError, ValueError):
+                    continue
+        snapshots.sort(key=lambda snapshot: snapshot[0]['created'])
+        total = sum(manifest['size'] for manifest, _ in snapshots)
+        now = time.time()
+        for manifest, path in snapshots:
+            if now - manifest['created'] <= max_age and total <= max_size:
+                continue
+            images = [snapshot['image']
+                      for snapshot in manifest['services'].values()]
+            try:
+                self.docker('rmi', *images)
+            except subprocess.CalledProcessError as ex:
+                log.warning('could not remove snapshot images: %s', ex.output)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= manifest['size']
 
     def _tearDown(self):
         """
@@ -131,38 +2090,335 @@ class AutopilotPatternTest(unittest.TestCase):
         pass --failfast to the test runner and leave the containers in place
         for postmortem debugging.
         """
+        if self.reuse_environment:
+            test_method = getattr(self, self._testMethodName, None)
+            self.mark_mutated(*getattr(test_method, 'mutated_services', ()))
+        if self._stats_sampler:
+            self._stats_sampler.stop()
         self._report()
-        self.instrumented_commands = []
+        # kept for `collect_diagnostics` in case the test failed
+        self._timeline, self.instrumented_commands = \
+            self.instrumented_commands, []
+        self._stats_sampler = None
+
+    def run(self, result=None):
+        """
+        Runs the test, collecting diagnostics with `collect_diagnostics`
+        if it fails or raises an error. The failures are caught by
+        wrapping the `addFailure` and `addError` methods of the result,
+        which needn't be a `unittest.TestResult` (ex. under pytest); no
+        diagnostics are collected if it lacks them.
+        """
+        if result is None:
+            return super().run(result)
+        failed = []
+
+        def wrap(name):
+            add = getattr(result, name, None)
+            if add is None:
+                return None
+            own = getattr(result, '__dict__', {}).get(name)
+
+            def add_failure(test, err, *args, **kwargs):
+                if test is self:
+                    failed.append(''.join(traceback.format_exception(*err))
+                                  if isinstance(err, tuple) else str(err))
+                return add(test, err, *args, **kwargs)
+
+            try:
+                setattr(result, name, add_failure)
+            except AttributeError:
+                return None
+            return name, own
+
+        wrapped = [wrap(name) for name in ('addFailure', 'addError')]
+        try:
+            outcome = super().run(result)
+        finally:
+            for name, own in filter(None, wrapped):
+                if own is None:
+                    delattr(result, name)
+                else:
+                    setattr(result, name, own)
+        if failed:
+            self._collect_on_failure('\n'.join(failed))
+        self._timeline = None
+        return outcome
+
+    def _collect_on_failure(self, failure):
+        """
+        Calls `collect_diagnostics` for a failure unless diagnostics are
+        disabled or the test was replayed from a cassette, and reports
+        any error rather than raising it.
+        """
+        if not self.diagnostics_timeout or self.cassette_mode == 'replay':
+            return
+        try:
+            self.collect_diagnostics(failure)
+        except Exception as ex:
+            log.warning('could not collect diagnostics: %s', ex)
+
+    def collect_diagnostics(self, failure=None, timeout=None):
+        """
+        Writes what's needed to debug a failed test to a gzipped tarball
+        in the test's log directory (see `log_path`) and returns its
+        path. It includes the last DIAGNOSTICS_LOG_LINES lines of the
+        logs of each of the project's containers, their `docker inspect`
+        output, the health checks and KV store of Consul, the timeline of
+        the test's instrumented calls, and the `failure` message if
+        given. These are collected concurrently, and anything not
+        collected within `timeout` seconds (default:
+        `diagnostics_timeout`) is left out and listed in errors.txt.
+        """
+        timeout = self.diagnostics_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        timeline = list(self._timeline if self._timeline is not None
+                        else self.instrumented_commands)
+        results = {}
+
+        def collect(name, fn, *args):
+            try:
+                results[name] = fn(*args)
+            except Exception as ex:
+                results[name] = ex
+
+        def container_logs(pending):
+            while True:
+                try:
+                    container = pending.get_nowait()
+                except queue.Empty:
+                    return
+                collect('logs/{}.log'.format(container.name),
+                        self.docker_logs, container.id, None, False, False,
+                        DIAGNOSTICS_LOG_LINES)
+
+        def containers():
+            inventory = self.container_inventory()
+            results['containers.json'] = [c._asdict() for c in inventory]
+            pending = queue.Queue()
+            for container in inventory:
+                pending.put(container)
+            workers = [_start_thread(container_logs, pending) for _ in
+                       range(min(self.max_workers, len(inventory)))]
+            self._invalidate_inspect()
+            collect('inspect.json', self._inspect_all,
+                    [c.id for c in inventory], True)
+            for worker in workers:
+                worker.join()
+
+        def consul_kv():
+            entries = self.consul.kv.get('', recurse=True)[1] or []
+            return [dict(entry, Value=entry['Value'].decode('utf-8', 'replace')
+                         if entry.get('Value') is not None else None)
+                    for entry in entries]
+
+        tasks = OrderedDict([
+            ('containers', (collect, 'containers', containers)),
+            ('consul-health', (collect, 'consul-health.json',
+                               lambda: self.consul.health.state('any')[1])),
+            ('consul-kv', (collect, 'consul-kv.json', consul_kv)),
+        ])
+        threads = OrderedDict((name, _start_thread(*task))
+                              for name, task in tasks.items())
+        for thread in threads.values():
+            thread.join(max(0, deadline - time.monotonic()))
+        collected = dict(results)
+
+        members = OrderedDict()
+        errors = ['{}: not finished after {}s'.format(name, timeout)
+                  for name, thread in threads.items() if thread.is_alive()]
+        if failure:
+            members['failure.txt'] = failure
+        members['timeline.jsonl'] = ''.join(
+            json.dumps(row) + '\n' for row in _timing_rows(timeline))
+        for name in sorted(collected):
+            value = collected[name]
+            if isinstance(value, Exception):
+                errors.append('{}: {}: {}{}'.format(
+                    name, type(value).__name__, value,
+                    '\n' + value.output if getattr(value, 'output', None)
+                    else ''))
+            elif value is not None:
+                members[name] = (value if isinstance(value, str) else
+                                 json.dumps(value, indent=2, default=str))
+        if errors:
+            members['errors.txt'] = '\n'.join(errors) + '\n'
+
+        path = self.log_path('diagnostics', '.tar.gz')
+        _write_tarball(path, re.sub(r'[^\w.-]+', '_', self.id()), members)
+        print('diagnostics: {} ({:.1f}s)'.format(path,
+                                                 time.monotonic() - start))
+        return path
+
+    def _start_cassette(self):
+        """
+        Loads the `Cassette` of this test to replay it, or starts a new
+        one to record it, depending on `cassette_mode`.
+        """
+        self._cassette = self._cassette_consul = None
+        if self.cassette_mode:
+            filename = os.path.join(CASSETTE_DIR, '{}.json.gz'.format(
+                re.sub(r'[^\w.-]+', '_', self.id())))
+            self._cassette = Cassette(filename, self.cassette_mode)
+
+    def _stop_cassette(self):
+        """
+        Saves the cassette of a recorded test. Raises CassetteError if a
+        replayed test didn't make all the recorded calls, unless it has
+        already diverged.
+        """
+        cassette, self._cassette = self._cassette, None
+        self._cassette_consul = None
+        if cassette is None:
+            return
+        if not cassette.replaying:
+            cassette.save()
+            return
+        unplayed = cassette.unplayed()
+        if unplayed and not cassette.diverged:
+            raise cassette.divergence('{} recorded calls were not made, '
+                                      'starting with {}'.format(
+                                          len(unplayed), unplayed[0]))
+
+    def _start_stats(self):
+        """
+        Starts a `StatsSampler` for the project's containers, which
+        `_tearDown` stops before the report.
+        """
+        prefix = ''
+        if self.project_name:
+            # Compose v1 and v2 separate the parts of names differently
+            prefix = tuple(self._project_label() + sep for sep in '_-')
+        try:
+            self._stats_sampler = StatsSampler(
+                prefix, self.stats_interval).start()
+        except OSError as ex:
+            log.warning('could not start docker stats: %s', ex)
+
+    def mark_mutated(self, *services):
+        """
+        Declares that the current test changed the state of `services`
+        (ex. stopped or scaled them) so that they'll be reset before the
+        next test when the class sets `reuse_environment`. Has no effect
+        when each test gets a fresh environment.
+        """
+        if self._dirty_services is not None:
+            self._dirty_services.update(services)
+
+    def reset_environment(self, services):
+        """
+        Resets the `services` mutated by previous tests in a reused
+        environment by removing and recreating their containers.
+        Subclasses can override this to provide a cheaper reset for
+        their application (ex. restarting a process or truncating a
+        table).
+        """
+        try:
+            self.compose('stop', *services)
+            self.compose('rm', '-f', *services)
+            self.compose('up', '-d', *services)
+            self.wait_for_containers()
+        except subprocess.CalledProcessError as ex:
+            self.fail('{} failed: {}'.format(ex.cmd, ex.output))
+        except WaitTimeoutError as ex:
+            self.fail(ex)
 
     def instrument(self, fn, *args, **kwargs):
+        """
+        Calls `fn` with `args` and `kwargs` and records a `Timing` for the
+        call in this test's timing report. Returns the result of `fn` and
+        allows any exception to bubble up.
+        """
         start = time.time()
+        status = 0
+        output = None
+        cassette = self._cassette
         try:
-            return fn(*args, **kwargs)
+            if cassette and cassette.replaying:
+                output = self._replay(fn, args)
+            else:
+                output = fn(*args, **kwargs)
+                if cassette:
+                    cassette.record(_cassette_key(fn.__name__, args),
+                                    time.time() - start,
+                                    _encode_result(output))
+            status = getattr(output, 'returncode', 0)
+            return output
         except Exception as ex:
+            if cassette and not cassette.replaying:
+                cassette.record(_cassette_key(fn.__name__, args),
+                                time.time() - start, _encode_error(ex))
+            status = getattr(ex, 'returncode', type(ex).__name__)
+            output = ex if hasattr(ex, 'output_size') else \
+                getattr(ex, 'output', None)
             raise
         finally:
-            end = time.time()
-            elapsed = end - start
-            self.instrumented_commands.append((fn.__name__, args, elapsed))
+            elapsed = time.time() - start
+            self.instrumented_commands.append(
+                Timing(_timing_name(fn), args, elapsed, start, status,
+                       _output_size(output), self.id()))
+
+    def _replay(self, fn, args):
+        """
+        Returns the result of the call `fn(*args)` recorded in the
+        cassette, or raises the recorded error.
+        """
+        result = self._cassette.replay(_cassette_key(fn.__name__, args))
+        if result[0] == 'error':
+            raise _decode_error(result[1])
+        output = _decode_result(args, result)
+        if fn is stream_output:
+            # the caller expects the log file to exist
+            with open(args[1], 'a') as f:
+                f.write(output.stdout)
+        return output
 
     def _report(self):
         """
-        Prints a simple timing report at the end of a test run
+        Prints a simple timing report at the end of a test run, and
+        appends the timing records to the TIMING_REPORT file if set.
         """
+        _configure_logging()
         _bar = '-' * 70
         print('{}\n{}\n{}'.format(_bar,
                                   self.id().replace('__main__.', '', 1), _bar))
         _report.info('', extra=dict(elapsed='elapsed', task='task'))
-        for cmd in self.instrumented_commands:
-            if cmd[0] == 'run':
-                task = " ".join([str(arg) for arg in cmd[1][0]])
-            else:
-                # we don't want check_output to appear for our external
-                # calls to docker and docker-compose, but if a subclass
-                # instruments a function we want to catch that name
-                task = " ".join([str(arg) for arg in cmd[1]])
-                task = '{}: {}'.format(cmd[0], task)
-            _report.info('', extra=dict(elapsed=str(cmd[2]), task=task))
+        for timing in self.instrumented_commands:
+            _report.info('', extra=dict(elapsed=str(timing.elapsed),
+                                        task=timing_task(timing)))
+        if self._inspect_hits or self._inspect_misses:
+            print('docker_inspect cache: {} hits, {} misses'.format(
+                self._inspect_hits, self._inspect_misses))
+        if self._stats_sampler:
+            self._report_stats(self._stats_sampler)
+        if TIMING_REPORT:
+            write_timings(TIMING_REPORT, self.instrumented_commands)
+
+    def _report_stats(self, sampler):
+        """
+        Prints the mean and peak CPU and memory use of each container
+        sampled by `sampler`, its network and block I/O, and the
+        sampler's own overhead.
+        """
+        print('{:<32} {:>8} {:>8} {:>10} {:>10} {:>19} {:>19}'.format(
+            'container', 'cpu% avg', 'cpu% max', 'mem avg', 'mem max',
+            'net rx / tx', 'block r / w'))
+        for stats in sampler.summary():
+            last = stats.last
+            print('{:<32} {:>8.1f} {:>8.1f} {:>10} {:>10} {:>19} {:>19}'
+                  .format(stats.name[:32], stats.cpu_mean, stats.cpu_peak,
+                          _format_size(stats.mem_mean),
+                          _format_size(stats.mem_peak),
+                          '{} / {}'.format(_format_size(last.net_rx),
+                                           _format_size(last.net_tx)),
+                          '{} / {}'.format(_format_size(last.block_read),
+                                           _format_size(last.block_write))))
+        print('docker stats: {} lines, {} dropped, sampler {:.3f}s CPU, '
+              'docker stats {:.3f}s CPU'.format(
+                  sampler.lines, sampler.dropped,
+                  sampler.overhead.get('sampler_cpu', 0),
+                  sampler.overhead.get('docker_stats_cpu', 0)))
 
     @property
     def consul(self):
@@ -170,14 +2426,48 @@ class AutopilotPatternTest(unittest.TestCase):
         Lazily constructs a Consul client pointing to the first Consul
         instance. We can't configure Consul during `setupClass` because
         we don't necessarily have Consul up and running at that point.
+        The client is shared by the tests of a class.
         """
         if not self._consul:
             insp = self.docker_inspect('consul_1')
             ip = insp[0]['NetworkSettings']['IPAddress']
             consul_host = ip if ip else os.environ.get('CONSUL', 'consul')
-            self._consul = pyconsul.Consul(host=consul_host)
+            # share the client (and its connection pool) with the other
+            # tests of the class for as long as Consul keeps its address
+            cls = type(self)
+            host, client = cls._shared_consul or (None, None)
+            if host != consul_host:
+                import consul as pyconsul
+                client = pyconsul.Consul(host=consul_host)
+                cls._shared_consul = (consul_host, client)
+            self._consul = client
+        if self._cassette:
+            if self._cassette_consul is None:
+                import consul as pyconsul
+                http = self._consul.http
+                client = pyconsul.Consul(
+                    host=http.host, port=http.port, token=self._consul.token,
+                    scheme=self._consul.scheme, dc=self._consul.dc,
+                    consistency=self._consul.consistency)
+                client.http = _CassetteConsulHTTP(http, self._cassette)
+                self._cassette_consul = client
+            return self._cassette_consul
         return self._consul
 
+    def consul_snapshot(self):
+        """
+        Returns a `ConsulSnapshot` of the current health of all services,
+        checks and nodes. The last snapshot is reused (without querying
+        the catalog again) if the Consul index hasn't changed since.
+        """
+        index, checks = self.consul.health.state('any')
+        snapshot = self._consul_snapshot
+        if snapshot is None or snapshot.index != index:
+            services = self.consul.catalog.services()[1]
+            snapshot = ConsulSnapshot(self.consul, index, checks, services)
+            self._consul_snapshot = snapshot
+        return snapshot
+
     def get_container_name(self, *args):
         """
         Given an incomplete container identifier, construct the name
@@ -195,6 +2485,13 @@ class AutopilotPatternTest(unittest.TestCase):
                 return name
         return '{}_{}'.format(self.project_name, name)
 
+    def _project_label(self):
+        """
+        Returns the project name as Compose normalizes it for the
+        `com.docker.compose.project` container label.
+        """
+        return re.sub(r'[^a-z0-9]', '', self.project_name.lower())
+
     def compose(self, *args, **kwargs):
         """
         Runs `docker-compose` with the project and file flag set for this
@@ -204,15 +2501,21 @@ class AutopilotPatternTest(unittest.TestCase):
         than calling `subprocess.run` so that the call is instrumented.
         Kwargs:
           - verbose=True: print stdout to console
+          - stream=True: write the output to a log file for this test
+            (see `log_path`) as it's produced and return only its last
+            OUTPUT_TAIL_LINES lines; pass a string to name the log file
         """
         _compose_args = [COMPOSE, '-f', self.compose_file]
+        for override in self._compose_overrides:
+            _compose_args.extend(['-f', override])
         if self.project_name:
             _compose_args.extend(['-p', self.project_name])
-            _compose_args = _compose_args + [arg for arg in args if arg]
+        _compose_args = _compose_args + [arg for arg in args if arg]
 
-        proc = self.instrument(subprocess.run, _compose_args,
-                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                               check=True, universal_newlines=True)
+        if args and args[0] in LIFECYCLE_COMMANDS:
+            self._invalidate_inspect()
+        proc = self._run_command(_compose_args, kwargs.get('stream', False),
+                                 'compose', *args)
         if kwargs.get('verbose', False):
             print(proc.stdout)
         return proc.stdout
@@ -226,75 +2529,103 @@ class AutopilotPatternTest(unittest.TestCase):
         call is instrumented.
         Kwargs:
           - verbose=True: print stdout to console
+          - stream=True: stream the output to a log file, as for `compose`
         """
         _docker_args = [DOCKER] + [arg for arg in args if arg]
-        proc = self.instrument(subprocess.run, _docker_args,
-                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                               check=True, universal_newlines=True)
+        if args and args[0] in LIFECYCLE_COMMANDS:
+            self._invalidate_inspect(*[arg for arg in args[1:]
+                                       if arg and not arg.startswith('-')])
+        proc = self._run_command(_docker_args, kwargs.get('stream', False),
+                                 'docker', *args)
         if kwargs.get('verbose', False):
             print(proc.stdout)
         return proc.stdout
 
+    def _run_command(self, args, stream, *name):
+        """
+        Runs the command `args` with instrumentation, capturing all of its
+        output or, if `stream` is set, streaming it to the log file named
+        by `stream` (or by the words of `name` if `stream` is True).
+        """
+        if not stream:
+            return self.instrument(subprocess.run, args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   check=True, universal_newlines=True)
+        if not isinstance(stream, str):
+            stream = '-'.join([str(word) for word in name if word])
+        return self.instrument(stream_output, args, self.log_path(stream))
+
+    def log_path(self, name, extension='.log'):
+        """
+        Returns the path of the log file `name` (ex. 'mysql' becomes
+        'mysql.log') for the current test, in a directory for the test
+        under TEST_LOG_DIR which is created if needed.
+        """
+        directory = os.path.join(TEST_LOG_DIR,
+                                 re.sub(r'[^\w.-]+', '_', self.id()))
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, '{}{}'.format(
+            re.sub(r'[^\w.-]+', '_', name), extension))
+
+
+    def container_inventory(self, service_name=None, ips=False,
+                            verbose=False):
+        """
+        Lists the project's containers (or just those of `service_name`)
+        with a single `docker ps` call filtered by the Compose labels,
+        and returns a list of `Container` including each container's
+        service, number and health. Pass `ips=True` to also fill in the
+        IP addresses of all containers with one batched `docker inspect`.
+        """
+        output = self.docker(*self._inventory_args(service_name),
+                             verbose=verbose)
+        containers = _containers_from_ps(output)
+        if ips and containers:
+            insp = self.docker_inspect(*[c.id for c in containers])
+            addresses = {i['Id']: _inspect_ips(i) for i in insp}
+            containers = [c._replace(ips=addresses.get(c.id, []))
+                          for c in containers]
+        return containers
+
+    def _inventory_args(self, service_name=None):
+        """
+        Returns the `docker ps` arguments used by `container_inventory`
+        to list the project's containers, or just those of `service_name`.
+        """
+        args = ['ps', '-a', '--no-trunc', '--format', '{{json .}}',
+                '--filter', 'label={}={}'.format(PROJECT_LABEL,
+                                                 self._project_label()),
+                '--filter', 'label={}=False'.format(ONEOFF_LABEL)]
+        if service_name:
+            args.extend(['--filter',
+                         'label={}={}'.format(SERVICE_LABEL, service_name)])
+        return args
 
     def compose_ps(self, service_name=None, verbose=False):
         """
-        Runs `docker-compose ps`, filtered by `service_name` and dumping
-        results to stdout if the `verbose` param is included. Returns a
-        list of field dicts.
-        """
-        output = self.compose('ps', verbose=verbose)
-
-        # trim header and any warning text
-        lines = re.split('-+\n', output, re.S|re.M)[1].splitlines()
-
-        # Because the output of `docker-compose ps` isn't line-oriented
-        # we have to do a bunch of ugly parsing/regex to force it into lines.
-
-        def _find_column_windows(line):
-            """
-            Figure out where compose split the column. we need to make
-            sure we catch the last bit so add 2 trailing spaces to the line
-            """
-            segments = re.findall('.*?\s\s+', line+'  ')
-            windows = [0]
-            for i, seg in enumerate(segments):
-                windows.append(windows[i] + len(seg))
-            return windows
-
-        def _find_rows_from_lines(lines):
-            """
-            Combined associated lines into rows (each 'row' is itself still
-            a list of strings) which each represent one running container.
-            """
-            rows = []
-            i = -1
-            for line in lines:
-                if not line.startswith(' '):
-                    rows.append([line])
-                    i += 1
-                else:
-                    rows[i].append(line)
-            return rows
-
-        def _find_fields_from_row(row, windows):
-            """
-            Takes a multi-line row of columized text output and returns the
-            text grouped into a list of strings where each string is the
-            cleaned-up text of a single column.
-            """
-            output = [''] * (len(windows) - 1)
-            for line in row:
-                for i in range(len(windows) - 1):
-                    output[i] += line[windows[i]:windows[i+1]]
-
-            # this last scrubbing makes sure we don't have big gaps or
-            # split IP addresses with spaces
-            return [re.sub('\. ', '.', re.sub('  +', ' ', field).strip())
-                    for field in output]
-
-        windows = _find_column_windows(lines[0])
-        rows = _find_rows_from_lines(lines)
-        return [Container(*_find_fields_from_row(row, windows)) for row in rows]
+        Lists the containers of the project, filtered by `service_name`
+        and dumping results to stdout if the `verbose` param is included.
+        Returns a list of `Container`. This uses `container_inventory`,
+        falling back to parsing the output of `docker-compose ps` if
+        there's no project name to filter on or if the Docker client
+        can't format its output as JSON.
+        """
+        if self.project_name:
+            try:
+                return self.container_inventory(service_name,
+                                                verbose=verbose)
+            except (subprocess.CalledProcessError, ValueError, KeyError):
+                pass
+        return self._compose_ps_text(service_name, verbose)
+
+    def _compose_ps_text(self, service_name=None, verbose=False):
+        """
+        Runs `docker-compose ps`, filtered by `service_name` and parses
+        the columns of its output into a list of `Container`.
+        """
+        output = self.compose('ps', service_name, verbose=verbose)
+        return _parse_compose_ps(output)
 
 
     def compose_scale(self, service_name, count, verbose=False):
@@ -305,12 +2636,166 @@ class AutopilotPatternTest(unittest.TestCase):
         self.compose('scale',
                      '{}={}'.format(service_name, count), verbose=verbose)
 
-    def compose_logs(self):
+    def scale_and_converge(self, service_name, count, timeout=60,
+                           consul_service=None):
+        """
+        Scales `service_name` to `count` containers and waits until
+        exactly `count` healthy instances of the service are registered
+        in Consul (as `consul_service`, if it's registered under another
+        name) with the addresses of its running containers. The scale
+        command, a poll of the container inventory and a watch of the
+        service's health in Consul all run concurrently, and the time
+        each phase finished is recorded in the timing report and
+        returned in a `Convergence`. Raises WaitTimeoutError if the
+        service hasn't converged within `timeout` seconds, or
+        CalledProcessError if the scale command fails.
+        """
+        consul_service = consul_service or service_name
+        start = time.time()
+        deadline = time.monotonic() + timeout
+        timings = OrderedDict()
+        stopped = threading.Event()
+        scale_arg = '{}={}'.format(service_name, count)
+
+        def phase(name):
+            timings[name] = time.time() - start
+            self.instrumented_commands.append(
+                Timing('scale_and_converge {}'.format(name), (scale_arg,),
+                       timings[name], start, 0, None, self.id()))
+
+        def scale():
+            self.compose_scale(service_name, count)
+            phase('scale')
+
+        def containers_ready():
+            if stopped.is_set():
+                return True
+            running = [c for c in self.container_inventory(service_name)
+                       if c.state == 'Up']
+            if len(running) == count and all(
+                    c.health in (None, 'healthy') for c in running):
+                # wrapped so that no containers (count=0) ends the poll
+                return (running,)
+            return None
+
+        def watch_containers():
+            ready = self.poll(containers_ready, timeout, max_interval=1.0,
+                              description='{} containers of {}'.format(
+                                  count, service_name))
+            if stopped.is_set():
+                return None
+            containers = ready[0]
+            addresses = {insp['Id']: _inspect_ips(insp) for insp in
+                         self.docker_inspect(*[c.id for c in containers])}
+            containers = [c._replace(ips=addresses.get(c.id, []))
+                          for c in containers]
+            phase('containers')
+            return containers
+
+        def watch_consul():
+            nodes = self._watch_service(
+                consul_service,
+                lambda nodes: stopped.is_set() or len(nodes) == count,
+                timeout, max_wait=1.0)
+            if nodes is None or stopped.is_set():
+                return None
+            phase('registered')
+            return nodes
+
+        import concurrent.futures
+        pool = concurrent.futures.ThreadPoolExecutor(3)
+        futures = []
+        try:
+            futures = [pool.submit(scale), pool.submit(watch_containers),
+                       pool.submit(watch_consul)]
+            # raises as soon as any of the phases fails
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+            containers, nodes = futures[1].result(), futures[2].result()
+            if nodes is None:
+                raise WaitTimeoutError(
+                    'Timed out waiting for {} healthy instances of {} in '
+                    'Consul'.format(count, consul_service))
+
+            def converged(nodes):
+                registered = set(node['Service']['Address'] or
+                                 node['Node']['Address'] for node in nodes)
+                return len(nodes) == count and all(
+                    set(c.ips) & registered for c in containers)
+
+            if not converged(nodes):
+                # Consul may still list instances of replaced containers
+                nodes = self._watch_service(consul_service, converged,
+                                            deadline - time.monotonic())
+                if nodes is None:
+                    raise WaitTimeoutError(
+                        'Timed out waiting for the Consul instances of {} to '
+                        'match its containers'.format(consul_service))
+            phase('converged')
+            return Convergence(containers, nodes, timings)
+        finally:
+            stopped.set()
+            # the watchers see `stopped` within a second, and the scale
+            # command is given until the deadline, so that none of them
+            # are still running (and recording timings) once we return
+            concurrent.futures.wait(
+                futures, timeout=max(2.0, deadline - time.monotonic()))
+            pool.shutdown(wait=False)
+
+    def compose_logs(self, *services):
+        """
+        Streams the logs of each of the `services` (default: all the
+        services of the project) to its own log file for this test (see
+        `log_path`), and prints the tail of each. Returns a dict of
+        {service: log file path}. Services whose logs can't be read are
+        reported and skipped.
+        """
+        if not services:
+            services = self.compose('config', '--services').split()
+
+        def service_logs(service):
+            name = 'logs-{}'.format(service)
+            try:
+                tail = self.compose('logs', '--no-color', service,
+                                    stream=name)
+            except subprocess.CalledProcessError as ex:
+                tail = ex.output
+            path = self.log_path(name)
+            print('{}: {}\n{}'.format(service, path, tail))
+            return path
+
+        return self.fan_out(service_logs, services)
+
+    def docker_api(self):
+        """
+        Returns the shared `DockerClient` for the current Docker
+        environment if this test uses the 'api' `docker_backend`,
+        otherwise None. Also None for the rest of the test once the
+        daemon couldn't be reached.
+        """
+        if self.docker_backend == 'api' and not self._docker_api_unavailable:
+            return DockerClient.from_env()
+        return None
+
+    def _call_docker_api(self, fn, *args, **kwargs):
+        """
+        Calls the instrumented `DockerClient` method `fn`, printing the
+        output if `verbose` is set. Returns None if the daemon can't be
+        reached so that the caller can fall back to the docker client,
+        which is then used for the rest of the test.
+        """
+        verbose = kwargs.pop('verbose', False)
         try:
-            print(self.compose('logs'))
-        except docker.errors.APIError as ex:
-            # TODO: figure out why this gets cut off
-            print(ex)
+            output = self.instrument(fn, *args)
+        except subprocess.CalledProcessError:
+            raise
+        except OSError as ex:
+            log.debug('Docker API unavailable, using docker client: %s', ex)
+            self._docker_api_unavailable = True
+            return None
+        if verbose:
+            print(output)
+        return output
 
     def docker_exec(self, container, command_line, verbose=False):
         """
@@ -323,112 +2808,511 @@ class AutopilotPatternTest(unittest.TestCase):
             args = command_line.split()
         except AttributeError:
             args = command_line
+        api = self.docker_api()
+        if api:
+            output = self._call_docker_api(api.exec, name, *args,
+                                           verbose=verbose)
+            if output is not None:
+                return output
         args = ['exec', name] + args
         return self.docker(*args, verbose=verbose)
 
+    def fan_out(self, fn, containers, *args, **kwargs):
+        """
+        Calls `fn(container, *args, **kwargs)` for each of `containers`
+        concurrently on a pool of at most `max_workers` threads, and
+        returns a dict of {container: result}. `fn` will typically be one
+        of the instrumented methods like `docker_exec`. If any call raises
+        CalledProcessError, the calls that haven't started are cancelled
+        and the first failure is raised as a `ContainerCommandError`.
+        """
+        results = {}
+        if not containers:
+            return results
+        import concurrent.futures
+        workers = min(self.max_workers, len(containers))
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(fn, container, *args, **kwargs): container
+                       for container in containers}
+            for future in concurrent.futures.as_completed(futures):
+                container = futures[future]
+                try:
+                    results[container] = future.result()
+                except subprocess.CalledProcessError as ex:
+                    for pending in futures:
+                        pending.cancel()
+                    raise ContainerCommandError(container, ex) from ex
+        return results
+
+    def service_containers(self, service, running=True):
+        """
+        Returns the names of the containers for `service` in the form
+        accepted by `get_container_name` (ex. 'nginx_1'), optionally
+        including containers that aren't running.
+        """
+        return ['{}_{}'.format(c.service, c.number)
+                for c in self.container_inventory(service)
+                if not running or c.state == 'Up']
+
+    def docker_exec_all(self, service, command_line, verbose=False):
+        """
+        Runs `docker exec <command_line>` concurrently on all the running
+        containers of `service`, returning a dict of the combined
+        stdout/stderr keyed by container name (ex. 'nginx_1').
+        """
+        return self.fan_out(self.docker_exec, self.service_containers(service),
+                            command_line, verbose=verbose)
+
     def docker_stop(self, container, verbose=False):
         """ Stops a specific instance. """
         name = self.get_container_name(container)
+        api = self.docker_api()
+        if api:
+            self._invalidate_inspect(name)
+            output = self._call_docker_api(api.stop, name, verbose=verbose)
+            if output is not None:
+                return output
         return self.docker('stop', name, verbose=verbose)
 
-    def docker_logs(self, container, since=None, verbose=True):
-        """ Returns logs from a given container. """
+    def docker_logs(self, container, since=None, verbose=True, stream=False,
+                    tail=None):
+        """
+        Returns logs from a given container, or only their last `tail`
+        lines. Pass `stream` to write them to a log file for this test
+        and return only their tail (see `compose`).
+        """
         name = self.get_container_name(container)
+        api = self.docker_api()
+        timestamp = _since_timestamp(since) if since else None
+        if api and not stream and (timestamp is not None or not since):
+            output = self._call_docker_api(api.logs, name, timestamp, tail,
+                                           verbose=verbose)
+            if output is not None:
+                return output
         args = ['logs', name] + \
-               (['--since', since] if since else [])
-        return self.docker(*args, verbose=verbose)
+               (['--since', since] if since else []) + \
+               (['--tail', str(tail)] if tail is not None else [])
+        return self.docker(*args, verbose=verbose, stream=stream)
 
-    def docker_inspect(self, container):
+    def docker_inspect(self, *containers, refresh=False):
         """
-        Runs `docker inspect` on a given container and parses the JSON.
+        Runs `docker inspect` on one or more containers and parses the
+        JSON, returning a list with an entry for each container. Results
+        are cached for the rest of the test until the container is
+        stopped or the project changes via `compose` (ex. `compose_scale`);
+        pass `refresh=True` to always inspect the containers again.
         """
-        name = self.get_container_name(container)
-        output = self.docker('inspect', name)
-        return json.loads(output)
-
-    def get_service_ips(self, service, ignore_errors=False):
+        names = [self.get_container_name(c) for c in containers]
+        missing = []
+        with self._inspect_lock:
+            for name in names:
+                if refresh or name not in self._inspect_cache:
+                    if name not in missing:
+                        missing.append(name)
+            self._inspect_hits += len(names) - len(missing)
+            self._inspect_misses += len(missing)
+        if missing:
+            inspected = None
+            api = self.docker_api()
+            if api:
+                inspected = self._call_docker_api(api.inspect, *missing)
+            if inspected is None:
+                inspected = json.loads(self.docker('inspect', *missing))
+            with self._inspect_lock:
+                self._inspect_cache.update(zip(missing, inspected))
+        with self._inspect_lock:
+            return [self._inspect_cache[name] for name in names]
+
+    def _invalidate_inspect(self, *names):
+        """
+        Drops the cached `docker_inspect` results for the containers
+        `names` (matching container names or IDs), or all of the cached
+        results if no names are given.
+        """
+        with self._inspect_lock:
+            if not names:
+                self._inspect_cache.clear()
+                return
+            for key, insp in list(self._inspect_cache.items()):
+                if (key in names or insp.get('Name', '').lstrip('/') in names
+                        or any(insp.get('Id', '').startswith(name)
+                               for name in names)):
+                    del self._inspect_cache[key]
+
+    def get_service_ips(self, service, ignore_errors=False, method='exec'):
         """
         Gets a list of IPs for a service by checking each of its containers.
-        Returns a pair of lists (public, private).
+        Returns a pair of lists (public, private). By default each container
+        is asked for its addresses via `docker exec`. Pass `method='inspect'`
+        to read the addresses of all the containers from a single
+        `docker inspect` instead; this is much faster for scaled services
+        but only sees the addresses Docker assigned to the container.
         """
         out = self.compose('ps', '-q', service)
         containers = out.splitlines()
         private_ips = []
         public_ips = []
 
+        if method == 'inspect':
+            addresses = [_classify_ips(_inspect_ips(insp)) for insp in
+                         self._inspect_all(containers, ignore_errors)]
+        else:
+            addresses = []
+            for container in containers:
+                # we have the "real" name here and not the container-only name
+                try:
+                    addresses.append(self.get_ips(container))
+                except subprocess.CalledProcessError:
+                    if not ignore_errors:
+                        # sometimes we've stopped an instance or have updated
+                        # the service a container reports to Consul so we want
+                        # to skip CalledProcessError. In this case the caller
+                        # should be comparing the length of the lists returned
+                        # vs the expected length.
+                        raise
+
+        for public_ip, private_ip in addresses:
+            if private_ip:
+                private_ips.append(private_ip)
+            if public_ip:
+                public_ips.append(public_ip)
+        return public_ips, private_ips
+
+    def _inspect_all(self, containers, ignore_errors=False):
+        """
+        Runs a single `docker inspect` for all the `containers`. If one of
+        them has gone away and `ignore_errors` is set, falls back to
+        inspecting each container so that we can skip the missing ones.
+        """
+        if not containers:
+            return []
+        try:
+            return self.docker_inspect(*containers)
+        except subprocess.CalledProcessError:
+            if not ignore_errors:
+                raise
+        found = []
         for container in containers:
-            # we have the "real" name here and not the container-only name
             try:
-                public_ip, private_ip = self.get_ips(container)
-                if private_ip:
-                    private_ips.append(private_ip)
-                if public_ip:
-                    public_ips.append(public_ip)
+                found.extend(self.docker_inspect(container))
             except subprocess.CalledProcessError:
-                if not ignore_errors:
-                    # sometimes we've stopped an instance or have updated
-                    # the service a container reports to Consul so we want
-                    # to skip CalledProcessError. In this case the caller
-                    # should be comparing the length of the lists returned
-                    # vs the expected length.
-                    raise
-
-        return public_ips, private_ips
+                pass
+        return found
 
     def get_ips(self, container):
-
+        """
+        Asks the container for its addresses via `docker exec` and
+        returns a pair of `IPy.IP` (public, private), either of which
+        may be None.
+        """
         out = self.docker_exec(container, 'ip -o addr')
-        ips = set(IP_REGEX.findall(out))
-        ips.discard('127.0.0.1')
-        ips.discard('0.0.0.0')
-        ips = [IP(ip) for ip in ips]
-        private = None
-        public = None
-        for ip in ips:
-            if ip.iptype() == 'PRIVATE':
-                private = ip
-            elif ip.iptype() == 'PUBLIC':
-                public = ip
-        return public, private
-
-    def watch_docker_logs(self, name, val, timeout=60):
-        """ TODO """
-        pass
+        return _classify_ips(IP_REGEX.findall(out))
+
+    def watch_docker_logs(self, name, val, timeout=60, since=None):
+        """
+        Follows the logs of the container `name` with a single
+        `docker logs -f` until a line matches `val`, which can be a
+        substring or a compiled regex, and returns the matching line.
+        Pass `since` (a timestamp or duration like '1m') to skip older
+        log lines. Raises WaitTimeoutError if no line matches within
+        `timeout` seconds.
+        """
+        name = self.get_container_name(name)
+        args = [DOCKER, 'logs', '-f', name] + \
+               (['--since', since] if since else [])
+        return self.instrument(wait_for_output, args, val, timeout)
 
     def wait_for_containers(self, timeout=30):
         """
-        Waits for all containers to be marked as 'Up' for all services.
+        Waits for all containers to be marked as 'Up' for all services,
+        and 'healthy' for containers with a healthcheck. Watches the
+        `docker events` stream for the project so that we return as soon
+        as the last container is ready. Falls back to polling
+        `docker-compose ps` when there's no project name to filter on or
+        the event stream can't be used, and when recording or replaying a
+        cassette, which can't capture the event stream.
         """
-        while timeout > 0:
-            containers = self.compose_ps()
-            if all([container.state == 'Up'
-                    for container in containers]):
-                break
-            time.sleep(1)
-            timeout -= 1
-        else:
-            raise WaitTimeoutError("Timed out waiting for containers to start.")
+        if not self.project_name or self._cassette:
+            return self._poll_for_containers(timeout)
+
+        deadline = time.monotonic() + timeout
+        # replaying events from before we subscribed closes the window
+        # between starting the stream and inspecting the containers
+        since = '{:.6f}'.format(time.time())
+        try:
+            events = subprocess.Popen(
+                [DOCKER, 'events', '--since', since,
+                 '--format', '{{json .}}',
+                 '--filter', 'type=container',
+                 '--filter', 'label={}={}'.format(PROJECT_LABEL,
+                                                  self._project_label())],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True)
+        except OSError:
+            return self._poll_for_containers(timeout)
+
+        reader = None
+        try:
+            try:
+                pending, healthchecked = self._pending_containers()
+            except (subprocess.CalledProcessError, ValueError, KeyError):
+                return self._poll_for_containers(
+                    deadline - time.monotonic())
+            if not pending:
+                return
+            received = queue.Queue()
+            reader = threading.Thread(target=_enqueue_lines,
+                                      args=(events.stdout, received))
+            reader.daemon = True
+            reader.start()
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WaitTimeoutError(
+                        "Timed out waiting for containers to start.")
+                try:
+                    line = received.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    # the event stream went away under us
+                    return self._poll_for_containers(
+                        deadline - time.monotonic())
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                container_id = event.get('id', '')
+                action = event.get('Action', event.get('status', ''))
+                if action == 'start' and container_id not in healthchecked:
+                    pending.discard(container_id)
+                elif action == 'health_status: healthy':
+                    pending.discard(container_id)
+                elif action in ('die', 'stop', 'kill',
+                                'health_status: unhealthy'):
+                    pending.add(container_id)
+        finally:
+            events.kill()
+            events.wait()
+            if reader:
+                # the reader sees EOF once the process is gone
+                reader.join(1)
+            events.stdout.close()
+
+    def _pending_containers(self):
+        """
+        Returns the set of IDs for the project's containers which aren't
+        ready yet, and the set of IDs for containers that have a
+        healthcheck (which aren't ready until they report healthy).
+        """
+        pending = set()
+        healthchecked = set()
+        for container in self.container_inventory():
+            if container.health:
+                healthchecked.add(container.id)
+            if container.state != 'Up' or container.health not in (
+                    None, 'healthy'):
+                pending.add(container.id)
+        return pending, healthchecked
+
+    def _poll_for_containers(self, timeout):
+        """
+        Polls `docker-compose ps` until all containers are marked 'Up'.
+        """
+        self.poll(lambda: all([container.state == 'Up'
+                               for container in self.compose_ps()]),
+                  timeout, description='containers to start')
+
+    def poll(self, predicate, timeout=30, interval=0.1, backoff=1.5,
+             max_interval=2.0, jitter=0.1, description='condition'):
+        """
+        Calls `predicate()` until it returns a truthy value, and returns
+        that value. Between attempts it sleeps for `interval` seconds,
+        multiplied by `backoff` after each attempt up to `max_interval`,
+        and randomized by +/- the `jitter` fraction. The `timeout` is a
+        deadline on the monotonic clock, so the time spent in `predicate`
+        counts against it. Raises WaitTimeoutError naming `description`
+        if the deadline passes. The number of attempts and the time taken
+        are recorded in the test's timing report. When replaying a
+        cassette the predicate is called as many times as it was in the
+        recording, without sleeping. Ex.
+
+        self.poll(lambda: self.get_consul_key('mysql-primary'),
+                  timeout=60, description='mysql primary election')
+        """
+        start = time.time()
+        deadline = time.monotonic() + timeout
+        delay = interval
+        attempts = 0
+        status = 0
+        timed_out = False
+        cassette = self._cassette
+        recorded = None
+        if cassette and cassette.replaying:
+            recorded = cassette.replay(['poll', description])[1]
+        try:
+            while True:
+                attempts += 1
+                result = predicate()
+                if result:
+                    return result
+                remaining = deadline - time.monotonic()
+                if recorded:
+                    if attempts < recorded['attempts']:
+                        continue
+                    if not recorded['timed_out']:
+                        raise cassette.divergence(
+                            '{} not met after {} attempts'.format(
+                                description, attempts))
+                    remaining = 0
+                if remaining <= 0:
+                    timed_out = True
+                    raise WaitTimeoutError('Timed out waiting for {}.'
+                                           .format(description))
+                if delay > 0:
+                    time.sleep(min(remaining, delay * random.uniform(
+                        1 - jitter, 1 + jitter)))
+                    delay = min(delay * backoff, max_interval)
+        except Exception as ex:
+            status = type(ex).__name__
+            raise
+        finally:
+            if cassette and not cassette.replaying:
+                cassette.record(['poll', description], time.time() - start,
+                                ['poll', {'attempts': attempts,
+                                          'timed_out': timed_out}])
+            self.instrumented_commands.append(
+                Timing('poll', (description,), time.time() - start, start,
+                       status, None, self.id(), attempts))
 
     def wait_for_service(self, service_name, count=0, timeout=30):
         """
-        Polls Consul for the service to become healthy, and optionally
+        Watches Consul for the service to become healthy, and optionally
         for a particular `count` of container instances to be healthy.
+        Uses Consul blocking queries so that we return as soon as the
+        set of healthy instances changes.
         """
-        while timeout > 0:
-            try:
-                nodes = self.consul.health.service(service_name, passing=True)[1]
-                if nodes:
-                    if not count or len(nodes) == count:
-                        break
-            except (ValueError, IndexError):
-                pass
-            timeout -= 1
-            time.sleep(1)
-        else:
+        nodes = self._watch_service(
+            service_name,
+            lambda nodes: nodes and (not count or len(nodes) == count),
+            timeout)
+        if nodes is None:
             raise WaitTimeoutError("Timeout waiting for {} to be started"
                                    .format(service_name))
         return nodes
 
+    def _watch_service(self, service_name, ready, timeout, max_wait=None):
+        """
+        Watches the passing nodes of `service_name` with `_watch_consul`.
+        Returns the list of nodes once `ready(nodes)` is true, or None if
+        the `timeout` expires first.
+        """
+        return self._watch_consul(
+            lambda index, wait: self.consul.health.service(
+                service_name, passing=True, index=index, wait=wait),
+            ready, timeout, 'service {}'.format(service_name), max_wait)
+
+    def _watch_consul(self, query, ready, timeout, description,
+                      max_wait=None):
+        """
+        Makes Consul blocking queries by calling `query(index, wait)`,
+        passing the index of the previous response so that each query
+        returns only once the result changes (or the wait expires).
+        Returns the result (defaulting to an empty list) once
+        `ready(result)` is true, or None if the `timeout` expires first.
+        Pass `max_wait` to limit how many seconds each query blocks for,
+        so that `ready` is checked again at least that often.
+        """
+        deadline = time.monotonic() + timeout
+        index = None
+
+        def attempt():
+            nonlocal index
+            remaining = deadline - time.monotonic()
+            wait = remaining if max_wait is None else min(remaining, max_wait)
+            try:
+                new_index, result = query(
+                    index, '{}ms'.format(max(1, int(wait * 1000))))
+            except (ValueError, IndexError):
+                time.sleep(max(0, min(1, remaining)))
+                return None
+            result = result or []
+            if ready(result):
+                # wrapped so that an empty result still ends the poll
+                return (result,)
+            # Consul can reset its index (ex. on leader change) in which
+            # case we need to start over without an index
+            try:
+                index = new_index if int(new_index) >= int(index or 0) else None
+            except (TypeError, ValueError):
+                index = None
+            return None
+
+        # each query blocks until something changes, so we don't sleep
+        try:
+            return self.poll(attempt, timeout, interval=0,
+                             description=description)[0]
+        except WaitTimeoutError:
+            return None
+
+    def wait_for_services(self, services, timeout=30):
+        """
+        Watches Consul until all the `services` are healthy, where
+        `services` is a dict of {service name: count} and a count of 0
+        means any number of healthy instances (like `wait_for_service`).
+        All the services share a single deadline and a single watch of
+        Consul's health state. Returns a dict of {service name: nodes}
+        once the last service is healthy, or raises WaitTimeoutError
+        listing the services that weren't and their last-seen counts.
+        The nodes are read once the watch is satisfied, so if an instance
+        flapped in between and they no longer match the counts, the
+        watch resumes until they do.
+        """
+        deadline = time.monotonic() + timeout
+        seen = dict.fromkeys(services, 0)
+        # services without checks of their own are read from the catalog,
+        # whose changes don't wake a watch of the health state, so until
+        # they're healthy each query blocks for at most a second
+        unwatched = set()
+
+        def healthy(name, count):
+            return seen[name] == count if count else seen[name]
+
+        def query(index, wait):
+            if unwatched:
+                wait = '{}ms'.format(min(int(wait[:-2]), 1000))
+            index, checks = self.consul.health.state('any', index=index,
+                                                     wait=wait)
+            return index, ConsulSnapshot(self.consul, index, checks, None)
+
+        def ready(snapshot):
+            unwatched.clear()
+            for name, count in services.items():
+                seen[name] = len(snapshot.passing_instances(name))
+                if not (snapshot.has_service_checks(name) or
+                        healthy(name, count)):
+                    unwatched.add(name)
+            return all(healthy(name, count)
+                       for name, count in services.items())
+
+        while True:
+            result = self._watch_consul(
+                query, ready, deadline - time.monotonic(),
+                'services {}'.format(', '.join(sorted(services))))
+            if result is None:
+                missing = ['{} ({} of {} healthy)'.format(
+                               name, seen[name], count or 'any')
+                           for name, count in sorted(services.items())
+                           if not healthy(name, count)]
+                raise WaitTimeoutError("Timeout waiting for services: {}"
+                                       .format(', '.join(missing)))
+            found = {name: self.consul.health.service(
+                         name, passing=True)[1] or []
+                     for name in services}
+            seen.update((name, len(nodes)) for name, nodes in found.items())
+            if all(healthy(name, count) for name, count in services.items()):
+                return found
+
     def get_consul_key(self, key):
         """
         Return the Value field for a given Consul key. Handles None
@@ -439,12 +3323,17 @@ class AutopilotPatternTest(unittest.TestCase):
             return result[1]['Value']
         return None
 
-    def get_service_instances_from_consul(self, service_name):
+    def get_service_instances_from_consul(self, service_name,
+                                          snapshot=None):
         """
         Asks Consul for list of containers for a service. Relies on
         the naming convention for services done by ContainerPilot
         which injects the container hostname into the service ID.
+        Pass a `snapshot` from `consul_snapshot` to answer from it
+        rather than making a request.
         """
+        if snapshot:
+            return snapshot.service_instances(service_name)
         # https://www.consul.io/docs/agent/http/health.html#health_service
         nodes = self.consul.health.service(service_name, passing=True)[1]
         if nodes:
@@ -454,11 +3343,15 @@ class AutopilotPatternTest(unittest.TestCase):
             return node_ids
         return []
 
-    def get_service_addresses_from_consul(self, service_name):
+    def get_service_addresses_from_consul(self, service_name,
+                                          snapshot=None):
         """
         Asks Consul for a list of addresses for a service (compare to
         `get_service_ips` which asks the containers via `inspect`).
+        Pass a `snapshot` from `consul_snapshot` to answer from it.
         """
+        if snapshot:
+            return snapshot.service_addresses(service_name)
         # https://www.consul.io/docs/agent/http/health.html#health_service
         nodes = self.consul.health.service(service_name, passing=True)[1]
         if nodes:
@@ -466,30 +3359,82 @@ class AutopilotPatternTest(unittest.TestCase):
             return ips
         return []
 
-    def is_check_passing(self, key):
+    def is_check_passing(self, key, snapshot=None):
         """
-        Queries consul for whether a check is passing.
+        Queries consul for whether a check is passing. Pass a `snapshot`
+        from `consul_snapshot` to answer from it rather than making a
+        request.
         """
+        if snapshot:
+            return snapshot.is_check_passing(key)
         check = self.consul.agent.checks()[key]
         if check['Status'] == 'passing':
             return True
         return False
 
-    def assertHttpOk(self, container_id, path, port):
-        """ TODO """
-        pass
+    def assertHttpOk(self, container_id, path, port, timeout=0, msg=None):
+        """
+        Asserts that a GET request for `path` on `port` of the container
+        returns a 2xx status. The container's address is looked up with
+        `docker_inspect`. `container_id` and `path` can each also be a
+        list, in which case every path is checked on every container
+        concurrently. Pass a `timeout` to retry each check until it
+        succeeds or the timeout expires.
+        """
+        containers = ([container_id] if isinstance(container_id, str)
+                      else list(container_id))
+        paths = [path] if isinstance(path, str) else list(path)
+        addresses = {}
+        for container, insp in zip(containers,
+                                   self.docker_inspect(*containers)):
+            ips = _inspect_ips(insp)
+            if not ips:
+                self.fail(self._formatMessage(
+                    msg, '{} has no IP address'.format(container)))
+            addresses[container] = ips[0]
+
+        targets = [(addresses[c], p) for c in containers for p in paths]
+        statuses = self.fan_out(self._http_status, targets, port, timeout)
+        failed = ['{} ({}:{}{}) returned {}'.format(c, addresses[c], port, p,
+                                                    statuses[(addresses[c], p)])
+                  for c in containers for p in paths
+                  if not _is_ok(statuses[(addresses[c], p)])]
+        if failed:
+            self.fail(self._formatMessage(msg, 'HTTP check failed: {}'
+                                          .format(', '.join(failed))))
+
+    def _http_status(self, target, port, timeout=0):
+        """
+        Makes an instrumented GET request for the (address, path) `target`
+        and returns the status, or the error if the request failed.
+        Retries until a 2xx status or the `timeout` expires.
+        """
+        address, path = target
+        statuses = []
+
+        def attempt():
+            try:
+                status, _ = self.instrument(http_get, address, port, path)
+            except (OSError, http.client.HTTPException) as ex:
+                status = repr(ex)
+            statuses.append(status)
+            return _is_ok(status)
+
+        try:
+            self.poll(attempt, timeout, max_interval=1.0,
+                      description='{}:{}{}'.format(address, port, path))
+        except WaitTimeoutError:
+            pass
+        return statuses[-1]
 
     def wait_for_service_removed(self, service_name, timeout=30):
         """
-        Polls Consul for the service to be removed.
+        Watches Consul for the service to be removed, using blocking
+        queries so that we return as soon as the last instance is gone.
         """
-        while timeout > 0:
-            nodes = self.consul.health.service(service_name, passing=True)[1]
-            if not nodes:
-                break
-            timeout -= 1
-            time.sleep(1)
-        else:
+        nodes = self._watch_service(service_name, lambda nodes: not nodes,
+                                    timeout)
+        if nodes is None:
             raise WaitTimeoutError("Timeout waiting for {} to be removed"
                                    .format(service_name))
         return True
@@ -546,17 +3491,7 @@ class AutopilotPatternTest(unittest.TestCase):
         """
         Reads the environment file and returns a dict of {variables: values}
         """
-        env = {}
-        with open(filename, 'r') as source:
-            lines = source.readlines()
-        for line in lines:
-            if not line.startswith('#') and not line == "\n":
-                try:
-                    var, val = line.strip().split('=', 1)
-                except ValueError:
-                    log.error('env file line "%s" is invalid, skipping' % line)
-                env[var] = val
-        return env
+        return dict(env_file(filename).items())
 
     def update_env_file(self, filename, substitutions):
         """
@@ -568,56 +3503,243 @@ class AutopilotPatternTest(unittest.TestCase):
                         ('MYSQL_USER', 'me'))
         )
         """
-        fns = []
-        for sub in substitutions:
-            variable = sub[0]
-            value = '{}={}\n'.format(variable, sub[1])
-            fn = lambda line, var=variable, val=value: \
-                 val if line.startswith(var) else line
-            fns.append(fn)
+        env_file(filename).update(substitutions)
 
-        with open(filename, 'r') as source:
-            lines = source.readlines()
 
-        with open(filename, 'w') as source:
-            for line in lines:
-                for fn in fns:
-                    line = fn(line)
-                source.write(line)
+# -----------------------------------------
+# parallel test runner
+
+TEST_WORKERS = os.environ.get('TEST_WORKERS', '')
+"""
+Optionally set the number of worker processes used by `main` via the
+TEST_WORKERS env var (default: the number of CPUs).
+"""
+
+_worker_suffix = ''
+
+def _init_worker(suffixes):
+    """
+    Process pool initializer that claims a unique project name suffix
+    for the worker process, and points the TIMING_REPORT at the worker's
+    own file for `run_parallel` to merge.
+    """
+    global _worker_suffix, TIMING_REPORT
+    _worker_suffix = suffixes.get()
+    if TIMING_REPORT:
+        TIMING_REPORT = _worker_report_file(_worker_suffix)
+
+def _worker_report_file(suffix):
+    """ Returns the per-worker file name for the TIMING_REPORT. """
+    base, ext = os.path.splitext(TIMING_REPORT)
+    return '{}.{}{}'.format(base, suffix, ext)
+
+class _DeferredErrorsResult(unittest.TextTestResult):
+    """
+    Test result for worker processes which leaves printing the failure
+    tracebacks to `run_parallel` once all the workers are done.
+    """
+    def printErrors(self):
+        pass
+
+def _run_test_class(module_name, class_name, verbosity):
+    """
+    Runs all the tests of a TestCase class in a worker process against
+    its own Compose project, and returns the results as a dict that can
+    be sent back to the parent process.
+    """
+    cls = getattr(sys.modules.get(module_name) or
+                  importlib.import_module(module_name), class_name)
+    base_name = cls.project_name or os.path.basename(os.getcwd())
+    cls.project_name = re.sub(r'[^a-z0-9]', '', base_name.lower()) + \
+                       _worker_suffix
+
+    # capture the printed output and timing reports for this class so
+    # that they don't interleave with the reports from other workers
+    output = io.StringIO()
+    _configure_logging()
+    saved = [(handler, handler.stream)
+             for handler in (_print_handler, _report_handler)]
+    for handler, _ in saved:
+        handler.stream = output
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(cls)
+        runner = unittest.TextTestRunner(stream=output, verbosity=verbosity,
+                                         resultclass=_DeferredErrorsResult)
+        result = runner.run(suite)
+    finally:
+        for handler, stream in saved:
+            handler.stream = stream
+
+    return dict(name='{}.{}'.format(module_name, class_name),
+                project_name=cls.project_name,
+                output=output.getvalue(),
+                tests_run=result.testsRun,
+                failures=[(str(t), tb) for t, tb in result.failures],
+                errors=[(str(t), tb) for t, tb in result.errors],
+                skipped=len(result.skipped),
+                was_successful=result.wasSuccessful())
+
+def run_parallel(test_classes, workers=None, verbosity=1):
+    """
+    Runs each of the `test_classes` in a pool of `workers` processes.
+    Each worker derives its own `project_name` (ex. 'mysqlw2') so that
+    the classes run in isolated Compose projects on the same Docker
+    host. The output and timing reports of each class are printed as
+    each class finishes and the per-worker TIMING_REPORT files are merged
+    at the end. Returns True if all the tests passed.
+    """
+    workers = workers or int(TEST_WORKERS or 0) or os.cpu_count() or 1
+    workers = min(workers, len(test_classes)) or 1
+    import multiprocessing
+    suffixes = multiprocessing.Queue()
+    for i in range(workers):
+        suffixes.put('w{}'.format(i + 1))
+
+    start = time.time()
+    results = []
+    pool = multiprocessing.Pool(workers, _init_worker, (suffixes,))
+    try:
+        jobs = [pool.apply_async(_run_test_class,
+                                 (cls.__module__, cls.__name__, verbosity))
+                for cls in test_classes]
+        for job in jobs:
+            result = job.get()
+            sys.stderr.write(result['output'])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    if TIMING_REPORT:
+        for i in range(workers):
+            worker_file = _worker_report_file('w{}'.format(i + 1))
+            if os.path.exists(worker_file):
+                _write_timing_rows(TIMING_REPORT, read_timings(worker_file))
+                os.remove(worker_file)
+
+    _bar = '=' * 70
+    for result in results:
+        for flavor in ('errors', 'failures'):
+            for test, tb in result[flavor]:
+                sys.stderr.write('{}\n{}: {} [{}]\n{}\n{}\n'.format(
+                    _bar, flavor[:-1].upper(), test, result['project_name'],
+                    '-' * 70, tb))
+    tests_run = sum(r['tests_run'] for r in results)
+    failures = sum(len(r['failures']) for r in results)
+    errors = sum(len(r['errors']) for r in results)
+    skipped = sum(r['skipped'] for r in results)
+    ok = all(r['was_successful'] for r in results)
+    sys.stderr.write('{}\nRan {} tests in {} classes on {} workers in '
+                     '{:.3f}s\n\n'.format('-' * 70, tests_run, len(results),
+                                          workers, elapsed))
+    details = ', '.join('{}={}'.format(name, count) for name, count in
+                        (('failures', failures), ('errors', errors),
+                         ('skipped', skipped)) if count)
+    sys.stderr.write('{}{}\n'.format('OK' if ok else 'FAILED',
+                                      ' ({})'.format(details) if details
+                                      else ''))
+    return ok
+
+def main(workers=None, module='__main__', verbosity=1):
+    """
+    Alternative to `unittest.main` for a tests.py which runs all of the
+    `AutopilotPatternTest` classes in `module` in parallel with
+    `run_parallel`, and exits with the result.
+    """
+    module = sys.modules[module]
+    test_classes = [obj for _, obj in sorted(vars(module).items())
+                    if isinstance(obj, type)
+                    and issubclass(obj, AutopilotPatternTest)
+                    and obj.__module__ == module.__name__
+                    and unittest.defaultTestLoader.getTestCaseNames(obj)]
+    ok = run_parallel(test_classes, workers=workers, verbosity=verbosity)
+    sys.exit(0 if ok else 1)
 
 
 # -----------------------------------------
 # set up logging
 
-logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s',
-                    stream=sys.stdout,
-                    level=logging.getLevelName(
-                        os.environ.get('LOG_LEVEL', 'INFO')))
-_requests_logger = logging.getLogger('requests')
-_requests_logger.setLevel(logging.ERROR)
-
-# dummy logger so that we can print w/o interleaving
+# dummy loggers so that we can print w/o interleaving; their handlers are
+# added by `_configure_logging`
 _print = logging.getLogger('testcases.print')
-_print.propagate = False
-_print_handler = logging.StreamHandler()
-_print.setLevel(logging.INFO)
-_print_handler.setFormatter(logging.Formatter('%(message)s'))
-_print.addHandler(_print_handler)
+_print_handler = None
+_report = logging.getLogger('testcases.report')
+_report_handler = None
+_logging_lock = threading.Lock()
+
+def _configure_logging():
+    """
+    Sets up logging when it's first needed rather than at import time:
+    configures the root logger with LOG_LEVEL (unless the application
+    already has) and adds the handlers for `print` and the timing report.
+    Safe to call repeatedly, including when the module has been imported
+    twice (ex. as both __main__ and testcases).
+    """
+    global _print_handler, _report_handler
+    if _report_handler is not None:
+        return
+    with _logging_lock:
+        if _report_handler is not None:
+            return
+        logging.basicConfig(
+            format='%(asctime)s %(levelname)s %(name)s %(message)s',
+            stream=sys.stdout,
+            level=logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO')))
+        logging.getLogger('requests').setLevel(logging.ERROR)
+        # IsolatedAsyncioTestCase runs its event loop in debug mode
+        logging.getLogger('asyncio').setLevel(logging.WARNING)
+        _print_handler = _add_handler(
+            _print, logging.Formatter('%(message)s'))
+        _report_handler = _add_handler(
+            _report, logging.Formatter('{elapsed:<8.8} | {task}', style='{'))
+
+def _add_handler(logger, formatter):
+    """
+    Adds a stream handler with `formatter` to `logger` and returns it,
+    or returns the handler added by an earlier import of the module.
+    """
+    for handler in logger.handlers:
+        if getattr(handler, 'testcases', False):
+            return handler
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    handler.testcases = True
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return handler
 
 def print(message):
+    _configure_logging()
     _print.info(message)
 
-_report = logging.getLogger('testcases.report')
-_report.propagate = False
-_report_handler = logging.StreamHandler()
-_report.setLevel(logging.INFO)
-_report_handler.setFormatter(logging.Formatter('{elapsed:<8.8} | {task}',
-                                               style="{"))
-_report.addHandler(_report_handler)
-
 log = logging.getLogger('tests')
 """
 Logger that should be used by test implementations so that the testcases
 lib logging shares the same format as the tests. Accepts LOG_LEVEL from
 environment variables.
 """
+
+def _main(argv):
+    """
+    Prints a summary of the slowest command types across the timing
+    reports passed on the command line, ex:
+
+        python testcases.py timings1.jsonl timings2.jsonl
+    """
+    if not argv:
+        sys.stderr.write('usage: testcases.py TIMING_REPORT...\n')
+        return 2
+    summary = summarize_timings(*argv)
+    rows = sorted(summary.items(), key=lambda row: row[1]['p95'],
+                  reverse=True)
+    sys.stdout.write('{:<8} {:<10} {:<10} {:<10} {}\n'.format(
+        'count', 'p50', 'p95', 'max', 'type'))
+    for cmd_type, stats in rows:
+        sys.stdout.write('{count:<8} {p50:<10.4f} {p95:<10.4f} {max:<10.4f} '
+                         '{cmd_type}\n'.format(cmd_type=cmd_type, **stats))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,924 @@
+"""
+The testcases_async module provides `AsyncAutopilotPatternTest`, an
+asyncio variant of `testcases.AutopilotPatternTest`. It's kept apart
+from testcases so that importing testcases doesn't import asyncio; the
+names defined here can also be imported from testcases.
+"""
+import asyncio
+import base64
+import http.client
+import inspect
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import unittest
+import urllib.parse
+
+from testcases import (
+    AutopilotPatternTest, COMPOSE, COMPOSE_FILE, ConsulSnapshot,
+    ContainerCommandError, DOCKER, DURATION_REGEX, IP_REGEX,
+    LIFECYCLE_COMMANDS, MAX_LINE_LENGTH, Timing, WaitTimeoutError,
+    _DURATION_UNITS, _TIMING_ALIASES, _classify_ips, _configure_logging,
+    _containers_from_ps, _inspect_ips, _is_ok, _output_size,
+    _OutputTail, _parse_compose_ps, print)
+
+__pdoc__ = {}
+
+async def run_process(args):
+    """
+    Runs the command `args` with asyncio and returns a
+    `subprocess.CompletedProcess` with the combined stdout/stderr as a
+    string. Raises CalledProcessError if the command exits non-zero. The
+    process is killed if the calling task is cancelled.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        stdout, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    output = stdout.decode('utf-8', 'replace')
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args,
+                                            output=output)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout=output)
+
+async def async_stream_output(args, filename, tail_lines=None):
+    """
+    asyncio equivalent of `stream_output`: runs the command `args`,
+    appending its combined stdout/stderr to the file `filename` as it's
+    written, and returns a `subprocess.CompletedProcess` with only the
+    last `tail_lines` lines of the output. Raises CalledProcessError if
+    the command exits non-zero. The process is killed if the calling
+    task is cancelled.
+    """
+    tail = _OutputTail(tail_lines)
+    with open(filename, 'ab') as f:
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk:
+                    break
+                f.write(chunk)
+                tail.add(chunk)
+            returncode = await proc.wait()
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    return tail.result(args, returncode)
+
+async def async_wait_for_output(args, match, timeout):
+    """
+    asyncio equivalent of `wait_for_output`: runs the command `args` and
+    returns the first line of its combined stdout/stderr that matches
+    `match` (a substring or a compiled regex), killing the process once
+    a line matches or the `timeout` expires. Lines longer than
+    MAX_LINE_LENGTH are skipped.
+    """
+    if hasattr(match, 'search'):
+        matches = lambda line: match.search(line) is not None
+    else:
+        matches = lambda line: match in line
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        limit=MAX_LINE_LENGTH)
+
+    async def read():
+        while True:
+            try:
+                line = await proc.stdout.readline()
+            except ValueError:
+                continue
+            if not line:
+                raise WaitTimeoutError(
+                    'Output of `{}` ended without matching {!r}'.format(
+                        ' '.join(args), match))
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if matches(line):
+                return line
+
+    try:
+        return await asyncio.wait_for(read(), timeout)
+    except asyncio.TimeoutError:
+        raise WaitTimeoutError('Timed out waiting for {!r} in output of `{}`'
+                               .format(match, ' '.join(args)))
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+
+async def _read_http_response(reader):
+    """
+    Reads an HTTP/1.1 response from the stream `reader` and returns the
+    tuple (status, headers, body), with the header names lower-cased.
+    """
+    status_line = await reader.readline()
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        raise http.client.BadStatusLine(status_line)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+    return status, headers, body
+
+async def async_http_request(host, port, method, path, timeout=10):
+    """
+    Makes an HTTP/1.1 request with asyncio streams and returns the tuple
+    (status, headers, body). Each request uses a new connection, so that
+    concurrent requests (ex. Consul blocking queries) don't wait on each
+    other. Raises asyncio.TimeoutError if there's no complete response
+    within `timeout` seconds.
+    """
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(str(host), int(port)), timeout)
+    try:
+        writer.write('{} {} HTTP/1.1\r\nHost: {}:{}\r\nConnection: close'
+                     '\r\n\r\n'.format(method, path, host, port)
+                     .encode('latin-1'))
+        return await asyncio.wait_for(_read_http_response(reader), timeout)
+    finally:
+        writer.close()
+
+async def async_http_get(host, port, path, timeout=10):
+    """
+    asyncio equivalent of `http_get`: makes a GET request for `path` to
+    `host`:`port` and returns the pair (status, body).
+    """
+    status, _, body = await async_http_request(host, port, 'GET', path,
+                                               timeout)
+    return status, body
+
+
+class AsyncConsul(object):
+    """
+    Minimal asyncio client for the parts of the Consul HTTP API used by
+    `AsyncAutopilotPatternTest`. Each method returns the same result as
+    the python-consul call it's named after (ex. `health_service` for
+    `consul.health.service`), and errors are raised as ConsulException.
+    Pass `index` and `wait` to make a blocking query.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8500, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    async def _get(self, path, params=None, index=None, wait=None):
+        """
+        Makes a GET request for the API `path`, returning the pair
+        (index, data) where data is None if there's nothing at `path`.
+        """
+        params = dict(params or {})
+        timeout = self.timeout
+        if index:
+            params['index'] = index
+            if wait:
+                params['wait'] = wait
+                match = DURATION_REGEX.match(str(wait))
+                if match:
+                    timeout += (float(match.group(1)) *
+                                _DURATION_UNITS[match.group(2)])
+        if params:
+            path = '{}?{}'.format(path, urllib.parse.urlencode(params))
+        status, headers, body = await async_http_request(
+            self.host, self.port, 'GET', path, timeout)
+        index = headers.get('x-consul-index')
+        if status == 404:
+            return index, None
+        if status >= 400:
+            from consul import ConsulException
+            raise ConsulException('{} {}'.format(
+                status, body.decode('utf-8', 'replace')))
+        return index, json.loads(body.decode('utf-8'))
+
+    async def health_service(self, service, passing=False, index=None,
+                             wait=None):
+        params = {'passing': 1} if passing else None
+        return await self._get('/v1/health/service/{}'.format(service),
+                               params, index, wait)
+
+    async def health_state(self, state, index=None, wait=None):
+        return await self._get('/v1/health/state/{}'.format(state),
+                               None, index, wait)
+
+    async def catalog_services(self, index=None, wait=None):
+        return await self._get('/v1/catalog/services', None, index, wait)
+
+    async def catalog_service(self, service, index=None, wait=None):
+        return await self._get('/v1/catalog/service/{}'.format(service),
+                               None, index, wait)
+
+    async def kv_get(self, key, index=None, wait=None):
+        index, items = await self._get(
+            '/v1/kv/{}'.format(urllib.parse.quote(key)), None, index, wait)
+        if not items:
+            return index, None
+        item = items[0]
+        if item.get('Value') is not None:
+            item['Value'] = base64.b64decode(item['Value'])
+        return index, item
+
+    async def agent_checks(self):
+        return (await self._get('/v1/agent/checks'))[1]
+
+
+class AsyncAutopilotPatternTest(getattr(unittest, 'IsolatedAsyncioTestCase',
+                                        unittest.TestCase)):
+    """
+    asyncio variant of `AutopilotPatternTest`, for tests that need to do
+    several things at once. Its compose, docker, wait and Consul methods
+    are coroutines that run commands with `asyncio.create_subprocess_exec`
+    and query Consul with `AsyncConsul`, so that a test can ex. stop a
+    container while watching Consul and the logs of another container:
+
+        await asyncio.gather(
+            self.docker_stop('mysql_1'),
+            self.wait_for_service('mysql', count=1),
+            self.watch_docker_logs('mysql_2', 'promoted to primary'))
+
+    Calls are instrumented and reported the same way as those of
+    `AutopilotPatternTest`. Requires Python 3.8 or later.
+    """
+
+    project_name = ''
+    """ Test subclasses should override this project_name """
+
+    compose_file = COMPOSE_FILE
+    """
+    Field for an alternate compose file (default: docker-compose.yml).
+    """
+
+    _consul = None
+    _consul_snapshot = None
+
+    for _field in getattr(unittest, 'IsolatedAsyncioTestCase',
+                          unittest.TestCase).__dict__.keys():
+        __pdoc__['AsyncAutopilotPatternTest.%s' % _field] = None
+
+    def __init__(self, methodName='runTest'):
+        super().__init__(methodName)
+        _configure_logging()
+        self.instrumented_commands = []
+        self._inspect_cache = {}
+        self._inspect_lock = threading.Lock()
+        self._inspect_hits = 0
+        self._inspect_misses = 0
+        self._stats_sampler = None
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Ensure that the base class asyncSetUp/asyncTearDown is called in
+        all child TestCases, like `AutopilotPatternTest.setUpClass`.
+        """
+        if not hasattr(unittest, 'IsolatedAsyncioTestCase'):
+            raise RuntimeError('AsyncAutopilotPatternTest requires '
+                               'Python 3.8 or later')
+        child_setUp = cls.asyncSetUp
+        async def asyncSetUp_override(self, *args, **kwargs):
+            val = await child_setUp(self, *args, **kwargs)
+            await AsyncAutopilotPatternTest._asyncSetUp(self)
+            return val
+        cls.asyncSetUp = asyncSetUp_override
+
+        child_tearDown = cls.asyncTearDown
+        async def asyncTearDown_override(self, *args, **kwargs):
+            AsyncAutopilotPatternTest._asyncTearDown(self)
+            return await child_tearDown(self, *args, **kwargs)
+        cls.asyncTearDown = asyncTearDown_override
+
+    async def _asyncSetUp(self):
+        """
+        Called after a subclass's own asyncSetUp. Removes any existing
+        containers for the project and then starts all the services,
+        waiting for them to be marked 'Up' and then for
+        `environment_ready`.
+        """
+        self.instrumented_commands = []
+        try:
+            await self.compose('stop')
+            await self.compose('rm', '-f')
+            await self.compose('up', '-d')
+            await self.wait_for_containers()
+            await self.environment_ready()
+        except subprocess.CalledProcessError as ex:
+            self.fail('{} failed: {}'.format(ex.cmd, ex.output))
+        except WaitTimeoutError as ex:
+            self.fail(ex)
+
+    async def environment_ready(self):
+        """
+        Called once the containers are all 'Up'. Subclasses can override
+        this to wait until the application is ready.
+        """
+        pass
+
+    def _asyncTearDown(self):
+        """
+        Called before a subclass's own asyncTearDown. As with
+        `AutopilotPatternTest`, the containers are left in place for
+        postmortem debugging.
+        """
+        self._report()
+        self.instrumented_commands = []
+
+    # these don't do any I/O, so they're shared with the sync class
+    get_container_name = AutopilotPatternTest.get_container_name
+    _project_label = AutopilotPatternTest._project_label
+    _inventory_args = AutopilotPatternTest._inventory_args
+    log_path = AutopilotPatternTest.log_path
+    _invalidate_inspect = AutopilotPatternTest._invalidate_inspect
+    _report = AutopilotPatternTest._report
+    read_env_file = AutopilotPatternTest.read_env_file
+    update_env_file = AutopilotPatternTest.update_env_file
+
+    async def instrument(self, fn, *args, **kwargs):
+        """
+        Awaits the coroutine function `fn` with `args` and `kwargs` and
+        records a `Timing` for the call in this test's timing report.
+        Returns the result of `fn` and allows any exception to bubble up.
+        """
+        start = time.time()
+        status = 0
+        output = None
+        try:
+            output = await fn(*args, **kwargs)
+            status = getattr(output, 'returncode', 0)
+            return output
+        except Exception as ex:
+            status = getattr(ex, 'returncode', type(ex).__name__)
+            output = getattr(ex, 'output', None)
+            raise
+        finally:
+            elapsed = time.time() - start
+            self.instrumented_commands.append(
+                Timing(_TIMING_ALIASES.get(fn.__name__, fn.__name__), args,
+                       elapsed, start, status, _output_size(output),
+                       self.id()))
+
+    async def poll(self, predicate, timeout=30, interval=0.1, backoff=1.5,
+                   max_interval=2.0, jitter=0.1, description='condition'):
+        """
+        Like `AutopilotPatternTest.poll`, but `predicate` may return an
+        awaitable, and other tasks run while we sleep between attempts.
+        """
+        start = time.time()
+        deadline = time.monotonic() + timeout
+        delay = interval
+        attempts = 0
+        status = 0
+        try:
+            while True:
+                attempts += 1
+                result = predicate()
+                if inspect.isawaitable(result):
+                    result = await result
+                if result:
+                    return result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WaitTimeoutError('Timed out waiting for {}.'
+                                           .format(description))
+                if delay > 0:
+                    await asyncio.sleep(min(remaining, delay * random.uniform(
+                        1 - jitter, 1 + jitter)))
+                    delay = min(delay * backoff, max_interval)
+        except Exception as ex:
+            status = type(ex).__name__
+            raise
+        finally:
+            self.instrumented_commands.append(
+                Timing('poll', (description,), time.time() - start, start,
+                       status, None, self.id(), attempts))
+
+    async def compose(self, *args, **kwargs):
+        """
+        Runs `docker-compose` with the project and file flag set for this
+        test run, using `args` as its parameters. Returns the combined
+        stdout/stderr and allows CalledProcessError to bubble up.
+        Kwargs:
+          - verbose=True: print stdout to console
+          - stream=True: write the output to a log file for this test
+            (see `log_path`) as it's produced and return only its last
+            OUTPUT_TAIL_LINES lines; pass a string to name the log file
+        """
+        _compose_args = [COMPOSE, '-f', self.compose_file]
+        if self.project_name:
+            _compose_args.extend(['-p', self.project_name])
+        _compose_args = _compose_args + [arg for arg in args if arg]
+
+        if args and args[0] in LIFECYCLE_COMMANDS:
+            self._invalidate_inspect()
+        proc = await self._run_command(
+            _compose_args, kwargs.get('stream', False), 'compose', *args)
+        if kwargs.get('verbose', False):
+            print(proc.stdout)
+        return proc.stdout
+
+    async def docker(self, *args, **kwargs):
+        """
+        Runs `docker` with `args` as its parameters. Returns the combined
+        stdout/stderr and allows CalledProcessError to bubble up.
+        Kwargs:
+          - verbose=True: print stdout to console
+          - stream=True: stream the output to a log file, as for `compose`
+        """
+        _docker_args = [DOCKER] + [arg for arg in args if arg]
+        if args and args[0] in LIFECYCLE_COMMANDS:
+            self._invalidate_inspect(*[arg for arg in args[1:]
+                                       if arg and not arg.startswith('-')])
+        proc = await self._run_command(
+            _docker_args, kwargs.get('stream', False), 'docker', *args)
+        if kwargs.get('verbose', False):
+            print(proc.stdout)
+        return proc.stdout
+
+    async def _run_command(self, args, stream, *name):
+        """
+        See `AutopilotPatternTest._run_command`.
+        """
+        if not stream:
+            return await self.instrument(run_process, args)
+        if not isinstance(stream, str):
+            stream = '-'.join([str(word) for word in name if word])
+        return await self.instrument(async_stream_output, args,
+                                     self.log_path(stream))
+
+    async def container_inventory(self, service_name=None, ips=False,
+                                  verbose=False):
+        """
+        See `AutopilotPatternTest.container_inventory`.
+        """
+        output = await self.docker(*self._inventory_args(service_name),
+                                   verbose=verbose)
+        containers = _containers_from_ps(output)
+        if ips and containers:
+            insp = await self.docker_inspect(*[c.id for c in containers])
+            addresses = {i['Id']: _inspect_ips(i) for i in insp}
+            containers = [c._replace(ips=addresses.get(c.id, []))
+                          for c in containers]
+        return containers
+
+    async def compose_ps(self, service_name=None, verbose=False):
+        """
+        See `AutopilotPatternTest.compose_ps`.
+        """
+        if self.project_name:
+            try:
+                return await self.container_inventory(service_name,
+                                                      verbose=verbose)
+            except (subprocess.CalledProcessError, ValueError, KeyError):
+                pass
+        output = await self.compose('ps', service_name, verbose=verbose)
+        return _parse_compose_ps(output)
+
+    async def compose_scale(self, service_name, count, verbose=False):
+        """
+        Runs `docker-compose scale <service>=<count>`.
+        """
+        await self.compose('scale', '{}={}'.format(service_name, count),
+                           verbose=verbose)
+
+    async def docker_exec(self, container, command_line, verbose=False):
+        """
+        Runs `docker exec <command_line>` on the container and returns
+        the combined stdout/stderr. The `command_line` parameter can be
+        a list of arguments of a single string.
+        """
+        name = self.get_container_name(container)
+        try:
+            args = command_line.split()
+        except AttributeError:
+            args = command_line
+        return await self.docker('exec', name, *args, verbose=verbose)
+
+    async def fan_out(self, fn, containers, *args, **kwargs):
+        """
+        Awaits `fn(container, *args, **kwargs)` for each of `containers`
+        concurrently and returns a dict of {container: result}. If any
+        call raises CalledProcessError, the other calls are cancelled and
+        the failure is raised as a `ContainerCommandError`.
+        """
+        async def call(container):
+            try:
+                return await fn(container, *args, **kwargs)
+            except subprocess.CalledProcessError as ex:
+                raise ContainerCommandError(container, ex) from ex
+
+        tasks = [asyncio.ensure_future(call(container))
+                 for container in containers]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return dict(zip(containers, results))
+
+    async def service_containers(self, service, running=True):
+        """
+        See `AutopilotPatternTest.service_containers`.
+        """
+        return ['{}_{}'.format(c.service, c.number)
+                for c in await self.container_inventory(service)
+                if not running or c.state == 'Up']
+
+    async def docker_exec_all(self, service, command_line, verbose=False):
+        """
+        Runs `docker exec <command_line>` concurrently on all the running
+        containers of `service`, returning a dict of the combined
+        stdout/stderr keyed by container name (ex. 'nginx_1').
+        """
+        return await self.fan_out(self.docker_exec,
+                                  await self.service_containers(service),
+                                  command_line, verbose=verbose)
+
+    async def docker_stop(self, container, verbose=False):
+        """ Stops a specific instance. """
+        name = self.get_container_name(container)
+        return await self.docker('stop', name, verbose=verbose)
+
+    async def docker_logs(self, container, since=None, verbose=True,
+                          stream=False):
+        """
+        Returns logs from a given container. Pass `stream` to write them
+        to a log file for this test and return only their tail (see
+        `compose`).
+        """
+        name = self.get_container_name(container)
+        args = ['logs', name] + \
+               (['--since', since] if since else [])
+        return await self.docker(*args, verbose=verbose, stream=stream)
+
+    async def docker_inspect(self, *containers, refresh=False):
+        """
+        See `AutopilotPatternTest.docker_inspect`.
+        """
+        names = [self.get_container_name(c) for c in containers]
+        missing = []
+        for name in names:
+            if (refresh or name not in self._inspect_cache) and \
+                    name not in missing:
+                missing.append(name)
+        self._inspect_hits += len(names) - len(missing)
+        self._inspect_misses += len(missing)
+        if missing:
+            inspected = json.loads(await self.docker('inspect', *missing))
+            self._inspect_cache.update(zip(missing, inspected))
+        return [self._inspect_cache[name] for name in names]
+
+    async def get_ips(self, container):
+        """
+        Asks the container for its addresses via `docker exec` and
+        returns a pair of `IPy.IP` (public, private).
+        """
+        out = await self.docker_exec(container, 'ip -o addr')
+        return _classify_ips(IP_REGEX.findall(out))
+
+    async def get_service_ips(self, service, ignore_errors=False,
+                              method='exec'):
+        """
+        See `AutopilotPatternTest.get_service_ips`. With the default
+        'exec' method the containers are asked concurrently.
+        """
+        containers = (await self.compose('ps', '-q', service)).splitlines()
+        if method == 'inspect':
+            addresses = []
+            if containers:
+                try:
+                    inspected = await self.docker_inspect(*containers)
+                except subprocess.CalledProcessError:
+                    if not ignore_errors:
+                        raise
+                    inspected = []
+                    for container in containers:
+                        try:
+                            inspected.extend(
+                                await self.docker_inspect(container))
+                        except subprocess.CalledProcessError:
+                            pass
+                addresses = [_classify_ips(_inspect_ips(insp))
+                             for insp in inspected]
+        else:
+            results = await asyncio.gather(
+                *[self.get_ips(container) for container in containers],
+                return_exceptions=True)
+            addresses = []
+            for result in results:
+                if isinstance(result, subprocess.CalledProcessError):
+                    if not ignore_errors:
+                        raise result
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    addresses.append(result)
+
+        public_ips = [public for public, _ in addresses if public]
+        private_ips = [private for _, private in addresses if private]
+        return public_ips, private_ips
+
+    async def watch_docker_logs(self, name, val, timeout=60, since=None):
+        """
+        See `AutopilotPatternTest.watch_docker_logs`.
+        """
+        name = self.get_container_name(name)
+        args = [DOCKER, 'logs', '-f', name] + \
+               (['--since', since] if since else [])
+        return await self.instrument(async_wait_for_output, args, val,
+                                     timeout)
+
+    async def wait_for_containers(self, timeout=30):
+        """
+        Polls the project's containers until they're all 'Up', and
+        'healthy' if they have a healthcheck.
+        """
+        async def ready():
+            return all(container.state == 'Up' and
+                       container.health in (None, 'healthy')
+                       for container in await self.compose_ps())
+
+        await self.poll(ready, timeout, description='containers to start')
+
+    async def get_consul(self):
+        """
+        Returns an `AsyncConsul` client for the first Consul instance,
+        constructed lazily like `AutopilotPatternTest.consul`.
+        """
+        if not self._consul:
+            insp = await self.docker_inspect('consul_1')
+            ip = insp[0]['NetworkSettings']['IPAddress']
+            self._consul = AsyncConsul(
+                ip if ip else os.environ.get('CONSUL', 'consul'))
+        return self._consul
+
+    async def consul_snapshot(self):
+        """
+        Returns a `ConsulSnapshot` of the current health of all services,
+        checks and nodes. Pass it to `get_service_addresses_from_consul`
+        and `get_service_instances_from_consul` rather than calling its
+        methods that read the catalog, which would block.
+        """
+        consul = await self.get_consul()
+        index, checks = await consul.health_state('any')
+        snapshot = self._consul_snapshot
+        if snapshot is None or snapshot.index != index:
+            services = (await consul.catalog_services())[1]
+            snapshot = ConsulSnapshot(None, index, checks, services)
+            self._consul_snapshot = snapshot
+        return snapshot
+
+    async def _snapshot_catalog(self, snapshot, service_name):
+        """
+        Reads the catalog instances of the service into the `snapshot`
+        (see `ConsulSnapshot.catalog_instances`) unless it has them.
+        """
+        if service_name in snapshot._catalog:
+            return
+        nodes = []
+        if snapshot.in_catalog(service_name):
+            consul = await self.get_consul()
+            nodes = (await consul.catalog_service(service_name))[1]
+        snapshot._set_catalog(service_name, nodes)
+
+    async def _watch_consul(self, query, ready, timeout, description):
+        """
+        See `AutopilotPatternTest._watch_consul`; `query` is a coroutine
+        function.
+        """
+        deadline = time.monotonic() + timeout
+        index = None
+
+        async def attempt():
+            nonlocal index
+            remaining = deadline - time.monotonic()
+            try:
+                new_index, result = await query(
+                    index, '{}ms'.format(max(1, int(remaining * 1000))))
+            except (ValueError, IndexError, OSError, asyncio.TimeoutError,
+                    http.client.HTTPException):
+                await asyncio.sleep(max(0, min(1, remaining)))
+                return None
+            result = result or []
+            if ready(result):
+                return (result,)
+            try:
+                index = new_index if int(new_index) >= int(index or 0) else None
+            except (TypeError, ValueError):
+                index = None
+            return None
+
+        try:
+            return (await self.poll(attempt, timeout, interval=0,
+                                    description=description))[0]
+        except WaitTimeoutError:
+            return None
+
+    async def _watch_service(self, service_name, ready, timeout):
+        consul = await self.get_consul()
+        return await self._watch_consul(
+            lambda index, wait: consul.health_service(
+                service_name, passing=True, index=index, wait=wait),
+            ready, timeout, 'service {}'.format(service_name))
+
+    async def wait_for_service(self, service_name, count=0, timeout=30):
+        """
+        See `AutopilotPatternTest.wait_for_service`.
+        """
+        nodes = await self._watch_service(
+            service_name,
+            lambda nodes: nodes and (not count or len(nodes) == count),
+            timeout)
+        if nodes is None:
+            raise WaitTimeoutError("Timeout waiting for {} to be started"
+                                   .format(service_name))
+        return nodes
+
+    async def wait_for_services(self, services, timeout=30):
+        """
+        See `AutopilotPatternTest.wait_for_services`.
+        """
+        consul = await self.get_consul()
+        deadline = time.monotonic() + timeout
+        seen = dict.fromkeys(services, 0)
+        unwatched = set()
+
+        def healthy(name, count):
+            return seen[name] == count if count else seen[name]
+
+        async def query(index, wait):
+            if unwatched:
+                wait = '{}ms'.format(min(int(wait[:-2]), 1000))
+            index, checks = await consul.health_state('any', index=index,
+                                                      wait=wait)
+            snapshot = ConsulSnapshot(None, index, checks, None)
+            for name in services:
+                if not snapshot.has_service_checks(name):
+                    await self._snapshot_catalog(snapshot, name)
+            return index, snapshot
+
+        def ready(snapshot):
+            unwatched.clear()
+            for name, count in services.items():
+                seen[name] = len(snapshot.passing_instances(name))
+                if not (snapshot.has_service_checks(name) or
+                        healthy(name, count)):
+                    unwatched.add(name)
+            return all(healthy(name, count)
+                       for name, count in services.items())
+
+        while True:
+            result = await self._watch_consul(
+                query, ready, deadline - time.monotonic(),
+                'services {}'.format(', '.join(sorted(services))))
+            if result is None:
+                missing = ['{} ({} of {} healthy)'.format(
+                               name, seen[name], count or 'any')
+                           for name, count in sorted(services.items())
+                           if not healthy(name, count)]
+                raise WaitTimeoutError("Timeout waiting for services: {}"
+                                       .format(', '.join(missing)))
+            found = await asyncio.gather(
+                *[consul.health_service(name, passing=True)
+                  for name in services])
+            found = {name: nodes or []
+                     for name, (_, nodes) in zip(services, found)}
+            seen.update((name, len(nodes)) for name, nodes in found.items())
+            if all(healthy(name, count) for name, count in services.items()):
+                return found
+
+    async def wait_for_service_removed(self, service_name, timeout=30):
+        """
+        See `AutopilotPatternTest.wait_for_service_removed`.
+        """
+        nodes = await self._watch_service(service_name,
+                                          lambda nodes: not nodes, timeout)
+        if nodes is None:
+            raise WaitTimeoutError("Timeout waiting for {} to be removed"
+                                   .format(service_name))
+        return True
+
+    async def get_consul_key(self, key):
+        """
+        Return the Value field for a given Consul key, or None.
+        """
+        consul = await self.get_consul()
+        result = await consul.kv_get(key)
+        if result[1]:
+            return result[1]['Value']
+        return None
+
+    async def get_service_instances_from_consul(self, service_name,
+                                                snapshot=None):
+        """
+        See `AutopilotPatternTest.get_service_instances_from_consul`.
+        """
+        if snapshot:
+            if not snapshot.has_service_checks(service_name):
+                await self._snapshot_catalog(snapshot, service_name)
+            return snapshot.service_instances(service_name)
+        consul = await self.get_consul()
+        nodes = (await consul.health_service(service_name, passing=True))[1]
+        prefix = '{}-'.format(service_name)
+        return [service['Service']['ID'].replace(prefix, '', 1)
+                for service in nodes or []]
+
+    async def get_service_addresses_from_consul(self, service_name,
+                                                snapshot=None):
+        """
+        See `AutopilotPatternTest.get_service_addresses_from_consul`.
+        """
+        if snapshot:
+            await self._snapshot_catalog(snapshot, service_name)
+            return snapshot.service_addresses(service_name)
+        consul = await self.get_consul()
+        nodes = (await consul.health_service(service_name, passing=True))[1]
+        return [service['Service']['Address'] for service in nodes or []]
+
+    async def is_check_passing(self, key, snapshot=None):
+        """
+        See `AutopilotPatternTest.is_check_passing`.
+        """
+        if snapshot:
+            return snapshot.is_check_passing(key)
+        consul = await self.get_consul()
+        check = (await consul.agent_checks())[key]
+        return check['Status'] == 'passing'
+
+    async def assertHttpOk(self, container_id, path, port, timeout=0,
+                           msg=None):
+        """
+        See `AutopilotPatternTest.assertHttpOk`.
+        """
+        containers = ([container_id] if isinstance(container_id, str)
+                      else list(container_id))
+        paths = [path] if isinstance(path, str) else list(path)
+        addresses = {}
+        for container, insp in zip(containers,
+                                   await self.docker_inspect(*containers)):
+            ips = _inspect_ips(insp)
+            if not ips:
+                self.fail(self._formatMessage(
+                    msg, '{} has no IP address'.format(container)))
+            addresses[container] = ips[0]
+
+        targets = [(addresses[c], p) for c in containers for p in paths]
+        statuses = await self.fan_out(self._http_status, targets, port,
+                                      timeout)
+        failed = ['{} ({}:{}{}) returned {}'.format(c, addresses[c], port, p,
+                                                    statuses[(addresses[c], p)])
+                  for c in containers for p in paths
+                  if not _is_ok(statuses[(addresses[c], p)])]
+        if failed:
+            self.fail(self._formatMessage(msg, 'HTTP check failed: {}'
+                                          .format(', '.join(failed))))
+
+    async def _http_status(self, target, port, timeout=0):
+        """
+        See `AutopilotPatternTest._http_status`.
+        """
+        address, path = target
+        statuses = []
+
+        async def attempt():
+            try:
+                status, _ = await self.instrument(async_http_get, address,
+                                                  port, path)
+            except (OSError, asyncio.TimeoutError,
+                    http.client.HTTPException) as ex:
+                status = repr(ex)
+            statuses.append(status)
+            return _is_ok(status)
+
+        try:
+            await self.poll(attempt, timeout, max_interval=1.0,
+                            description='{}:{}{}'.format(address, port, path))
+        except WaitTimeoutError:
+            pass
+        return statuses[-1]
@@ -0,0 +1,190 @@
+"""
+Round-trip tests for recording and replaying a test with a `Cassette`:
+a test is recorded against stub docker and docker-compose executables
+and a stub Consul agent, then replayed with no docker binaries and
+nothing listening for Consul.
+"""
+import http.server
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import testcases
+
+PROJECT = 'cassette'
+
+DOCKER_STUB = """#!/bin/sh
+case "$1" in
+  ps) cat {fixtures}/docker_ps.jsonl ;;
+esac
+"""
+
+COMPOSE_STUB = """#!/bin/sh
+exit 0
+"""
+
+
+def _container_row(number):
+    labels = ','.join(['com.docker.compose.project={}'.format(PROJECT),
+                       'com.docker.compose.service=app',
+                       'com.docker.compose.container-number={}'
+                       .format(number),
+                       'com.docker.compose.oneoff=False'])
+    return json.dumps({'ID': '{:064x}'.format(number),
+                       'Names': '{}_app_{}'.format(PROJECT, number),
+                       'Command': '"/usr/local/bin/containerpilot"',
+                       'Status': 'Up 5 seconds',
+                       'Ports': '80/tcp',
+                       'Labels': labels})
+
+def _write_stubs(directory):
+    """ Writes the stub executables, returning (docker, docker-compose). """
+    fixtures = os.path.join(directory, 'fixtures')
+    os.makedirs(fixtures)
+    with open(os.path.join(fixtures, 'docker_ps.jsonl'), 'w') as f:
+        f.write('\n'.join(_container_row(n) for n in (1, 2)) + '\n')
+    paths = []
+    for name, stub in (('docker', DOCKER_STUB), ('docker-compose',
+                                                 COMPOSE_STUB)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(stub.format(fixtures=fixtures))
+        os.chmod(path, stat.S_IRWXU)
+        paths.append(path)
+    return paths
+
+def _serve_consul():
+    """ Starts a stub Consul agent with two healthy `app` instances. """
+    nodes = [{'Node': {'Node': 'node{}'.format(n),
+                       'Address': '10.0.0.{}'.format(n)},
+              'Service': {'ID': 'app-{}'.format(n), 'Service': 'app',
+                          'Address': '10.0.0.{}'.format(n), 'Port': 80},
+              'Checks': [{'Node': 'node{}'.format(n), 'CheckID': 'serfHealth',
+                          'Status': 'passing', 'ServiceID': ''}]}
+             for n in (1, 2)]
+    body = json.dumps(nodes).encode('utf-8')
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            found = self.path.split('?')[0] == '/v1/health/service/app'
+            self.send_response(200 if found else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Consul-Index', '7')
+            self.send_header('X-Consul-Knownleader', 'true')
+            self.send_header('X-Consul-Lastcontact', '0')
+            self.end_headers()
+            if found:
+                self.wfile.write(body)
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _project_test(mode, consul_port, extra_call=False, tear_down=True):
+    """
+    Returns a suite with the test of a new `AutopilotPatternTest` class
+    for the stub project, which records or replays as `mode`. The class
+    has the same name each time so that it uses the same cassette. Its
+    own setUp and tearDown make docker calls too, unless `tear_down` is
+    false.
+    """
+    import consul as pyconsul
+
+    def setUp(self):
+        self.docker('info')
+
+    def tearDown(self):
+        if tear_down:
+            self.docker('system', 'df')
+
+    def test_project(self):
+        inventory = self.container_inventory('app')
+        self.assertEqual([c.name for c in inventory],
+                         ['cassette_app_1', 'cassette_app_2'])
+        nodes = self.wait_for_service('app', count=2, timeout=5)
+        self.assertEqual(len(nodes), 2)
+        self.assertEqual(self.get_service_addresses_from_consul('app'),
+                         ['10.0.0.1', '10.0.0.2'])
+        if extra_call:
+            self.docker('version')
+
+    cls = type('CassetteProject', (testcases.AutopilotPatternTest,), dict(
+        project_name=PROJECT, cassette_mode=mode, diagnostics_timeout=0,
+        _consul=pyconsul.Consul(host='127.0.0.1', port=consul_port),
+        test_project=test_project, setUp=setUp, tearDown=tearDown))
+    return unittest.defaultTestLoader.loadTestsFromTestCase(cls)
+
+
+class CassetteRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.docker, self.compose = _write_stubs(self.directory)
+        self.consul = _serve_consul()
+        self.saved = (testcases.DOCKER, testcases.COMPOSE,
+                      testcases.CASSETTE_DIR)
+        testcases.CASSETTE_DIR = os.path.join(self.directory, 'cassettes')
+
+    def tearDown(self):
+        testcases.DOCKER, testcases.COMPOSE, testcases.CASSETTE_DIR = \
+            self.saved
+        self.consul.shutdown()
+        self.consul.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run_project(self, mode, consul_port, **kwargs):
+        result = unittest.TestResult()
+        _project_test(mode, consul_port, **kwargs).run(result)
+        return result
+
+    def record(self):
+        testcases.DOCKER, testcases.COMPOSE = self.docker, self.compose
+        result = self.run_project('record', self.consul.server_address[1])
+        self.assertTrue(result.wasSuccessful(),
+                        result.errors + result.failures)
+        # replay without docker or Consul
+        missing = os.path.join(self.directory, 'missing')
+        testcases.DOCKER = os.path.join(missing, 'docker')
+        testcases.COMPOSE = os.path.join(missing, 'docker-compose')
+        self.consul.shutdown()
+
+    def test_replay_without_docker(self):
+        self.record()
+        result = self.run_project('replay', 1)
+        self.assertTrue(result.wasSuccessful(),
+                        result.errors + result.failures)
+
+    def test_replay_divergence(self):
+        self.record()
+        result = self.run_project('replay', 1, extra_call=True)
+        self.assertEqual(len(result.errors), 1)
+        self.assertIn('CassetteError', result.errors[0][1])
+        self.assertIn("unexpected call ['run', ['docker', 'version']]",
+                      result.errors[0][1])
+
+    def test_replay_tear_down(self):
+        # the calls of the class's own tearDown are part of the cassette
+        self.record()
+        result = self.run_project('replay', 1, tear_down=False)
+        self.assertEqual(len(result.errors), 1)
+        self.assertIn("1 recorded calls were not made, starting with "
+                      "['run', ['docker', 'system', 'df']]",
+                      result.errors[0][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
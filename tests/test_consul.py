@@ -0,0 +1,281 @@
+"""
+Tests for the Consul watches of `AutopilotPatternTest` against a stub
+Consul agent, which answers each path with a scripted series of
+responses and records the query parameters of every request.
+"""
+import http.server
+import json
+import os
+import sys
+import threading
+import unittest
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import testcases
+
+
+def _node(service, number, checks=True):
+    """
+    Returns an entry of `/v1/health/service/<service>` for the instance
+    `number` of `service`, with a passing service check if `checks`.
+    """
+    node = 'node{}'.format(number)
+    service_id = '{}-{}'.format(service, number)
+    entry = {'Node': {'Node': node, 'Address': '10.0.0.{}'.format(number)},
+             'Service': {'ID': service_id, 'Service': service,
+                         'Address': '10.0.0.{}'.format(number), 'Port': 80},
+             'Checks': [{'Node': node, 'CheckID': 'serfHealth',
+                         'Status': 'passing', 'ServiceID': '',
+                         'ServiceName': ''}]}
+    if checks:
+        entry['Checks'].append({'Node': node,
+                                'CheckID': 'service:{}'.format(service_id),
+                                'Status': 'passing', 'ServiceID': service_id,
+                                'ServiceName': service})
+    return entry
+
+
+class StubConsul(object):
+    """
+    Stub Consul agent on a local port. `responses` maps a path to a list
+    of (index, body) pairs which are returned in turn, the last one for
+    all the remaining requests. `requests` lists the (path, params) of
+    every request.
+    """
+
+    def __init__(self, responses):
+        self.responses = {path: list(answers)
+                          for path, answers in responses.items()}
+        self.requests = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query,
+                                                     keep_blank_values=True))
+                stub.requests.append((url.path, params))
+                answers = stub.responses.get(url.path)
+                if not answers:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                index, body = answers.pop(0) if len(answers) > 1 \
+                    else answers[0]
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('X-Consul-Index', str(index))
+                self.send_header('X-Consul-Knownleader', 'true')
+                self.send_header('X-Consul-Lastcontact', '0')
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def params(self, path):
+        """ Returns the query parameters of each request for `path`. """
+        return [params for request_path, params in self.requests
+                if request_path == path]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ConsulTest(unittest.TestCase):
+    """ Runs each test against its own `StubConsul`. """
+
+    def start_consul(self, responses):
+        import consul as pyconsul
+        self.stub = StubConsul(responses)
+        self.addCleanup(self.stub.close)
+        cls = type('ConsulProject', (testcases.AutopilotPatternTest,), dict(
+            project_name='consul',
+            _consul=pyconsul.Consul(host='127.0.0.1', port=self.stub.port)))
+        # an instance without a test method, which isn't run but gives us
+        # the Consul helpers
+        return cls()
+
+    def start_async_consul(self, responses):
+        """
+        Returns an `AsyncAutopilotPatternTest` for the stub and a function
+        that runs a coroutine to completion.
+        """
+        import asyncio
+        import testcases_async
+        self.stub = StubConsul(responses)
+        self.addCleanup(self.stub.close)
+        cls = type('AsyncConsulProject',
+                   (testcases_async.AsyncAutopilotPatternTest,),
+                   dict(project_name='consul'))
+        harness = cls()
+        harness._consul = testcases_async.AsyncConsul('127.0.0.1',
+                                                      self.stub.port)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return harness, loop.run_until_complete
+
+
+def _check(node, status='passing', service_id='', service_name=''):
+    """ Returns an entry of `/v1/health/state/any`. """
+    check_id = 'service:{}'.format(service_id) if service_id else 'serfHealth'
+    return {'Node': node, 'CheckID': check_id, 'Status': status,
+            'ServiceID': service_id, 'ServiceName': service_name}
+
+def _catalog_node(node, service_id, address):
+    """ Returns an entry of `/v1/catalog/service/<service>`. """
+    return {'Node': node, 'ServiceID': service_id, 'ServiceAddress': address}
+
+# Consul's own `consul` service has no checks of its own, only the node
+# checks of the node it's registered on; the second `app` instance is
+# failing its service check
+HEALTH_STATE = [_check('node1'), _check('node2'),
+                _check('node1', service_id='app-1', service_name='app'),
+                _check('node2', 'critical', 'app-2', 'app')]
+
+CATALOG = {
+    '/v1/health/state/any': [(3, HEALTH_STATE)],
+    '/v1/catalog/services': [(3, {'consul': [], 'app': []})],
+    '/v1/catalog/service/consul': [(3, [_catalog_node('node1', 'consul',
+                                                      '10.0.0.1')])],
+    '/v1/catalog/service/app': [(3, [_catalog_node('node1', 'app-1',
+                                                   '10.0.0.1'),
+                                     _catalog_node('node2', 'app-2',
+                                                   '10.0.0.2')])],
+}
+
+
+class ConsulSnapshotTest(ConsulTest):
+
+    def test_service_checks(self):
+        snapshot = self.start_consul(CATALOG).consul_snapshot()
+        self.assertEqual(snapshot.passing_instances('app'),
+                         [('node1', 'app-1')])
+        self.assertEqual(snapshot.service_addresses('app'), ['10.0.0.1'])
+        self.assertEqual(snapshot.service_instances('app'), ['1'])
+
+    def test_node_checks_only(self):
+        snapshot = self.start_consul(CATALOG).consul_snapshot()
+        self.assertFalse(snapshot.has_service_checks('consul'))
+        self.assertEqual(snapshot.passing_instances('consul'),
+                         [('node1', 'consul')])
+        self.assertEqual(snapshot.service_addresses('consul'), ['10.0.0.1'])
+
+    def test_failing_node_check(self):
+        state = [_check('node1', 'critical')] + HEALTH_STATE[1:]
+        responses = dict(CATALOG)
+        responses['/v1/health/state/any'] = [(3, state)]
+        snapshot = self.start_consul(responses).consul_snapshot()
+        self.assertEqual(snapshot.passing_instances('consul'), [])
+        self.assertEqual(snapshot.passing_instances('app'), [])
+
+    def test_unknown_service(self):
+        snapshot = self.start_consul(CATALOG).consul_snapshot()
+        self.assertEqual(snapshot.passing_instances('missing'), [])
+        # known not to be in the catalog, so it isn't queried
+        self.assertFalse(self.stub.params('/v1/catalog/service/missing'))
+
+    def test_async(self):
+        harness, run = self.start_async_consul(CATALOG)
+
+        async def snapshot_services():
+            snapshot = await harness.consul_snapshot()
+            return (await harness.get_service_instances_from_consul(
+                        'consul', snapshot=snapshot),
+                    await harness.get_service_addresses_from_consul(
+                        'consul', snapshot=snapshot))
+
+        self.assertEqual(run(snapshot_services()),
+                         (['consul'], ['10.0.0.1']))
+
+
+class WaitForServicesTest(ConsulTest):
+
+    RESPONSES = dict(CATALOG, **{
+        '/v1/health/service/consul': [(3, [_node('consul', 1,
+                                                 checks=False)])],
+        '/v1/health/service/app': [(3, [_node('app', 1)])]})
+
+    def test_service_without_checks(self):
+        harness = self.start_consul(self.RESPONSES)
+        found = harness.wait_for_services({'consul': 1, 'app': 1}, timeout=5)
+        self.assertEqual({name: len(nodes) for name, nodes in found.items()},
+                         {'consul': 1, 'app': 1})
+
+    def test_registered_later(self):
+        # the consul service is only in the catalog on the second query,
+        # which doesn't change the index of the health state, so the
+        # watch has to re-read the catalog
+        responses = dict(self.RESPONSES)
+        responses['/v1/catalog/service/consul'] = [
+            (3, []), (4, [_catalog_node('node1', 'consul', '10.0.0.1')])]
+        harness = self.start_consul(responses)
+        harness.wait_for_services({'consul': 1}, timeout=5)
+        waits = [p.get('wait') for p in
+                 self.stub.params('/v1/health/state/any')]
+        self.assertEqual(waits[1], '1000ms')
+
+    def test_timeout(self):
+        harness = self.start_consul(self.RESPONSES)
+        with self.assertRaises(testcases.WaitTimeoutError) as cm:
+            harness.wait_for_services({'consul': 1, 'app': 2}, timeout=0.5)
+        self.assertEqual(str(cm.exception), 'Timeout waiting for services: '
+                         'app (1 of 2 healthy)')
+
+    def test_async(self):
+        harness, run = self.start_async_consul(self.RESPONSES)
+        found = run(harness.wait_for_services({'consul': 1, 'app': 1},
+                                              timeout=5))
+        self.assertEqual({name: len(nodes) for name, nodes in found.items()},
+                         {'consul': 1, 'app': 1})
+
+
+class WatchConsulTest(ConsulTest):
+
+    PATH = '/v1/health/service/app'
+
+    def test_passes_back_index(self):
+        harness = self.start_consul({self.PATH: [
+            (5, []), (7, [_node('app', 1)]), (9, [_node('app', 1),
+                                                  _node('app', 2)])]})
+        nodes = harness.wait_for_service('app', count=2, timeout=5)
+        self.assertEqual([n['Service']['ID'] for n in nodes],
+                         ['app-1', 'app-2'])
+        params = self.stub.params(self.PATH)
+        self.assertEqual([p.get('index') for p in params], [None, '5', '7'])
+        # python-consul only sends the wait along with an index
+        self.assertTrue(all(p['wait'].endswith('ms') for p in params[1:]))
+
+    def test_resets_index(self):
+        # Consul's index went backwards (ex. on a leader change), so the
+        # next query starts over without an index
+        harness = self.start_consul({self.PATH: [
+            (10, []), (3, []), (4, [_node('app', 1)])]})
+        nodes = harness.wait_for_service('app', timeout=5)
+        self.assertEqual(len(nodes), 1)
+        self.assertEqual([p.get('index') for p in self.stub.params(self.PATH)],
+                         [None, '10', None])
+
+    def test_timeout(self):
+        harness = self.start_consul({self.PATH: [(5, [])]})
+        with self.assertRaises(testcases.WaitTimeoutError):
+            harness.wait_for_service('app', timeout=0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
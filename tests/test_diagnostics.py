@@ -0,0 +1,131 @@
+"""
+Tests that `AutopilotPatternTest` collects diagnostics for the failed
+tests only, with unittest's and other test results, against the stub
+docker and docker-compose executables of test_cassette.
+"""
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import testcases
+from test_cassette import _write_stubs
+
+PROJECT_TESTS = """
+import testcases
+
+class DiagnosedProject(testcases.AutopilotPatternTest):
+
+    project_name = 'cassette'
+    diagnosed = []
+
+    def collect_diagnostics(self, failure=None, timeout=None):
+        type(self).diagnosed.append((self._testMethodName, failure))
+        with open({log!r}, 'a') as f:
+            f.write(self._testMethodName + '\\n')
+
+    def test_fails(self):
+        self.assertEqual(1, 2)
+
+    def test_passes(self):
+        pass
+"""
+
+
+class _Result(object):
+    """
+    Stand-in for a test result that isn't a `unittest.TestResult`, like
+    pytest's, which has no `failures` or `errors` lists.
+    """
+
+    def __init__(self):
+        self.reported = []
+
+    def startTest(self, test):
+        pass
+
+    def stopTest(self, test):
+        pass
+
+    def addSuccess(self, test):
+        self.reported.append((test._testMethodName, 'success'))
+
+    def addFailure(self, test, err):
+        self.reported.append((test._testMethodName, 'failure'))
+
+    def addError(self, test, err):
+        self.reported.append((test._testMethodName, 'error'))
+
+
+class DiagnosticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.docker, self.compose = _write_stubs(self.directory)
+        self.log = os.path.join(self.directory, 'diagnosed.log')
+        saved = (testcases.DOCKER, testcases.COMPOSE)
+        self.addCleanup(self.restore, saved)
+        testcases.DOCKER, testcases.COMPOSE = self.docker, self.compose
+
+        module = os.path.join(self.directory, 'test_project.py')
+        with open(module, 'w') as f:
+            f.write(PROJECT_TESTS.format(log=self.log))
+        spec = importlib.util.spec_from_file_location('test_project', module)
+        self.project = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.project)
+
+    def restore(self, saved):
+        testcases.DOCKER, testcases.COMPOSE = saved
+
+    def diagnosed(self):
+        cls = self.project.DiagnosedProject
+        return [(name, 'AssertionError: 1 != 2' in failure)
+                for name, failure in cls.diagnosed]
+
+    def test_unittest_result(self):
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(
+            self.project.DiagnosedProject)
+        result = unittest.TestResult()
+        suite.run(result)
+        self.assertEqual((result.testsRun, len(result.failures)), (2, 1))
+        self.assertEqual(self.diagnosed(), [('test_fails', True)])
+        # the result's own methods are back in place
+        self.assertNotIn('addFailure', vars(result))
+
+    def test_other_result(self):
+        # run each test like pytest does, rather than in a suite
+        cls = self.project.DiagnosedProject
+        cls.setUpClass()
+        result = _Result()
+        for name in ('test_fails', 'test_passes'):
+            cls(name).run(result)
+        self.assertEqual(result.reported, [('test_fails', 'failure'),
+                                           ('test_passes', 'success')])
+        self.assertEqual(self.diagnosed(), [('test_fails', True)])
+
+    @unittest.skipUnless(importlib.util.find_spec('pytest'),
+                         'pytest is not installed')
+    def test_pytest(self):
+        env = dict(os.environ, DOCKER=self.docker, COMPOSE=self.compose,
+                   PYTHONPATH=ROOT)
+        proc = subprocess.run(
+            [sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider',
+             os.path.join(self.directory, 'test_project.py')],
+            cwd=self.directory, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+        self.assertIn('1 failed, 1 passed', proc.stdout)
+        self.assertNotIn('AttributeError', proc.stdout)
+        with open(self.log) as f:
+            self.assertEqual(f.read(), 'test_fails\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
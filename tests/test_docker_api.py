@@ -0,0 +1,218 @@
+"""
+Tests for `DockerClient` and `ConnectionPool` against stub servers: a
+stub Docker Engine API on a unix socket, and an HTTP server that drops
+each keep-alive connection after answering it.
+"""
+import http.client
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import testcases
+from test_cassette import _write_stubs
+
+
+def _frame(stream, data):
+    """ Returns a frame of a multiplexed stdout (1) or stderr (2) stream. """
+    return struct.pack('>BxxxI', stream, len(data)) + data
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Stub of the exec endpoints of the Docker Engine API. The exec'd
+    command writes 'out' to stdout and 'err' to stderr, and exits with
+    the status given as its first argument.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8') or 'null')
+        parts = self.path.split('/')
+        if self.path == '/containers/missing/exec':
+            self.reply(404, {'message': 'No such container: missing'})
+        elif parts[1] == 'containers' and parts[3] == 'exec':
+            exec_id = 'exec{}'.format(len(self.server.execs))
+            self.server.execs[exec_id] = body['Cmd']
+            self.reply(201, {'Id': exec_id})
+        elif parts[1] == 'exec' and parts[3] == 'start':
+            self.reply(200, _frame(1, b'out\n') + _frame(2, b'err\n'),
+                       'application/vnd.docker.raw-stream')
+        else:
+            self.reply(404, {'message': 'page not found'})
+
+    def do_GET(self):
+        parts = self.path.split('/')
+        if parts[1] == 'exec' and parts[3] == 'json':
+            cmd = self.server.execs[parts[2]]
+            self.reply(200, {'ExitCode': int(cmd[0]), 'Running': False})
+        else:
+            self.reply(404, {'message': 'page not found'})
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(path, _Handler)
+        self.execs = {}
+
+
+class DockerClientTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        server = _UnixServer(os.path.join(directory, 'docker.sock'))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.client = testcases.DockerClient(
+            'unix://' + server.server_address)
+        self.addCleanup(self.client.close)
+
+    def test_exec(self):
+        self.assertEqual(self.client.exec('app_1', '0', 'args'), 'out\nerr\n')
+        # the connection is kept alive for the next call
+        self.assertEqual(self.client.exec('app_1', '0'), 'out\nerr\n')
+
+    def test_exec_exit_code(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.client.exec('app_1', '3')
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.output, 'out\nerr\n')
+        self.assertEqual(cm.exception.cmd[1:], ['exec', 'app_1', '3'])
+
+    def test_error_status(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.client.exec('missing', '0')
+        self.assertEqual(cm.exception.output,
+                         'Error: No such container: missing\n')
+
+
+class _DroppingHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers as if keeping the connection alive, but then closes it like a
+    server whose keep-alive timeout expired.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+        self.close_connection = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                 _DroppingHandler)
+        server.daemon_threads = True
+        server.connections = set()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+
+    def connect(self):
+        return http.client.HTTPConnection(*self.server.server_address,
+                                          timeout=5)
+
+    def test_retries_stale_connection(self):
+        pool = testcases.ConnectionPool(self.connect)
+        self.addCleanup(pool.close)
+        for _ in range(3):
+            response, data = pool.request('GET', '/')
+            self.assertEqual((response.status, data), (200, b'ok'))
+        # each request after the first found its idle connection closed
+        # and was retried once on a new one
+        self.assertEqual(len(self.server.connections), 3)
+
+    def test_new_connection_not_retried(self):
+        address = self.server.server_address
+        self.server.server_close()
+        connects = []
+
+        def connect():
+            connects.append(1)
+            return http.client.HTTPConnection(*address, timeout=5)
+
+        pool = testcases.ConnectionPool(connect)
+        with self.assertRaises(ConnectionError):
+            pool.request('GET', '/')
+        self.assertEqual(len(connects), 1)
+
+
+class DockerBackendTest(unittest.TestCase):
+    """ The 'api' backend of `AutopilotPatternTest` with no daemon. """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        saved = (testcases.DOCKER, os.environ.get('DOCKER_HOST'))
+        self.addCleanup(self.restore, saved)
+        testcases.DOCKER, _ = _write_stubs(directory)
+        os.environ['DOCKER_HOST'] = 'unix://{}'.format(
+            os.path.join(directory, 'missing.sock'))
+        cls = type('BackendProject', (testcases.AutopilotPatternTest,),
+                   dict(project_name='backend', docker_backend='api'))
+        self.harness = cls()
+
+    def restore(self, saved):
+        testcases.DOCKER = saved[0]
+        if saved[1] is None:
+            os.environ.pop('DOCKER_HOST', None)
+        else:
+            os.environ['DOCKER_HOST'] = saved[1]
+
+    def test_falls_back_to_docker_client(self):
+        self.harness.docker_exec('app_1', 'true')
+        self.harness.docker_exec('app_1', 'true')
+        timings = self.harness.instrumented_commands
+        # the API is only tried once, and is timed as the same type of
+        # command as the docker client
+        self.assertEqual([t.status for t in timings],
+                         ['FileNotFoundError', 0, 0])
+        self.assertEqual(set(testcases.timing_type(t) for t in timings),
+                         {'docker exec'})
+
+
+if __name__ == '__main__':
+    unittest.main()
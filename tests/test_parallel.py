@@ -0,0 +1,67 @@
+"""
+Tests for `run_parallel` against the stub docker and docker-compose
+executables of test_cassette.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import testcases
+from test_cassette import _write_stubs
+
+
+def _project_class(name):
+    """
+    Returns a new test class which is added to this module for the
+    duration of a test, so that `run_parallel` can find it but the test
+    loaders don't.
+    """
+    def test_version(self):
+        self.docker('version')
+
+    cls = type(name, (testcases.AutopilotPatternTest,), dict(
+        project_name='cassette', test_version=test_version,
+        __module__=__name__))
+    globals()[name] = cls
+    return cls
+
+
+class RunParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        saved = (testcases.DOCKER, testcases.COMPOSE, testcases.TIMING_REPORT)
+        self.addCleanup(self.restore, saved)
+        testcases.DOCKER, testcases.COMPOSE = _write_stubs(self.directory)
+        testcases.TIMING_REPORT = os.path.join(self.directory,
+                                               'timings.jsonl')
+
+    def restore(self, saved):
+        testcases.DOCKER, testcases.COMPOSE, testcases.TIMING_REPORT = saved
+
+    def test_merges_worker_timings(self):
+        classes = [_project_class(name) for name in
+                   ('FirstProject', 'SecondProject', 'ThirdProject')]
+        for cls in classes:
+            self.addCleanup(globals().pop, cls.__name__)
+        self.assertTrue(testcases.run_parallel(classes, workers=1,
+                                               verbosity=0))
+        # each worker writes a single file for all of its classes, which
+        # is merged and removed
+        self.assertEqual(os.listdir(self.directory).count('timings.jsonl'), 1)
+        self.assertFalse([f for f in os.listdir(self.directory)
+                          if f.startswith('timings.w')])
+        classes_timed = set(row['test_id'].split('.')[-2] for row in
+                            testcases.read_timings(testcases.TIMING_REPORT))
+        self.assertEqual(classes_timed, {'FirstProject', 'SecondProject',
+                                         'ThirdProject'})
+
+
+if __name__ == '__main__':
+    unittest.main()
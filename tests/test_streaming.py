@@ -0,0 +1,81 @@
+"""
+Tests for streaming command output to per-test log files, with the sync
+and async test cases, against a stub docker-compose that prints many
+lines.
+"""
+import asyncio
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import testcases
+import testcases_async
+
+COMPOSE_STUB = """#!/bin/sh
+for i in $(seq 1 250); do echo "line $i"; done
+case "$*" in
+  *fail*) exit 3 ;;
+esac
+"""
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        compose = os.path.join(directory, 'docker-compose')
+        with open(compose, 'w') as f:
+            f.write(COMPOSE_STUB)
+        os.chmod(compose, stat.S_IRWXU)
+        saved = (testcases.COMPOSE, testcases_async.COMPOSE,
+                 testcases.TEST_LOG_DIR)
+        self.addCleanup(self.restore, saved)
+        testcases.COMPOSE = testcases_async.COMPOSE = compose
+        testcases.TEST_LOG_DIR = os.path.join(directory, 'logs')
+
+    def restore(self, saved):
+        (testcases.COMPOSE, testcases_async.COMPOSE,
+         testcases.TEST_LOG_DIR) = saved
+
+    def check_streamed(self, harness, tail):
+        self.assertEqual(tail.splitlines(), ['line {}'.format(i)
+                                             for i in range(151, 251)])
+        with open(harness.log_path('compose-logs')) as f:
+            self.assertEqual(len(f.read().splitlines()), 250)
+        timing = harness.instrumented_commands[-1]
+        self.assertEqual(testcases.timing_type(timing), 'docker-compose logs')
+        self.assertEqual(timing.output_size, len(
+            ''.join('line {}\n'.format(i) for i in range(1, 251))))
+
+    def test_sync(self):
+        cls = type('StreamProject', (testcases.AutopilotPatternTest,),
+                   dict(project_name='stream'))
+        harness = cls()
+        self.check_streamed(harness, harness.compose('logs', stream=True))
+
+    def test_async(self):
+        cls = type('AsyncStreamProject',
+                   (testcases_async.AsyncAutopilotPatternTest,),
+                   dict(project_name='stream'))
+        harness = cls()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        tail = loop.run_until_complete(harness.compose('logs', stream=True))
+        self.check_streamed(harness, tail)
+
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            loop.run_until_complete(harness.compose('fail', stream='failed'))
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(len(cm.exception.output.splitlines()), 100)
+        self.assertTrue(os.path.exists(harness.log_path('failed')))
+
+
+if __name__ == '__main__':
+    unittest.main()